@@ -0,0 +1,341 @@
+'''
+Output backends for compress_hdf5.py and compress_gadget.py (`--backend`).
+
+Each backend is an output class that the scripts write one compressed
+snapshot file through:
+
+    out = Output(path)                   # a new output, at its .inprogress path
+    out.set_header(header)               # the /Header attributes (or input group)
+    out.set_info(compression_opts)       # /CompressionInfo, as JSON
+    out.write(name, data, opts, nthreads, max_memory, metrics)
+    out.close()
+    Output.annotate(path, key, value)    # one more /CompressionInfo entry, once closed
+    Output.size(path), Output.finish(path)
+
+`opts` is the per-dataset entry of the compression options: `opts['hdf5']`
+(the h5py dataset options, with the Blosc filter from hdf5plugin or the codec
+from `--tuning`) and `opts['truncbits']`, which both backends honour. A
+backend that needs its own settings derives them from those in `configure()`,
+so `--tuning` applies to every backend.
+
+hdf5 (the default): one HDF5 file, written with the Blosc filter of hdf5plugin,
+through h5py, the multi-threaded direct chunk writes of direct_chunk.py
+(`-t`), or slab by slab (`--max-memory`). SZ3 datasets (`--sz3`) are written
+by lossy.py.
+
+blosc2: a directory `snap_XXX.N.blosc2/` with one Blosc2 NDArray container
+per dataset, `PartType1/Coordinates.b2nd` etc., and empty `Header.b2nd` and
+`CompressionInfo.b2nd` containers whose vlmeta hold the same metadata as the
+HDF5 groups: 'attrs', with each header attribute as [dtype, value] (a
+container holds at most 16 vlmeta entries), and 'json'.
+The codec, level and shuffle are those of the HDF5 filter. Each super-chunk
+holds `SUPERCHUNK` HDF5 chunks, and each Blosc2 block is one HDF5 chunk's rows,
+so the blocks of a super-chunk are compressed in parallel by `-t` threads.
+Read it back with `Blosc2Output.open()`, or `blosc2.open()` on a container.
+'''
+
+import json
+from pathlib import Path
+import warnings
+
+import blosc2
+import h5py
+import numpy as np
+
+import direct_chunk
+import lossy
+from metrics import Metrics
+
+# HDF5 chunks per Blosc2 super-chunk
+SUPERCHUNK = 16
+
+# hdf5plugin.Blosc2, which --tuning can choose
+BLOSC2_FILTER_ID = 32026
+
+
+class HDF5Output:
+    '''A compressed HDF5 snapshot file.
+    '''
+    suffix = '.hdf5'
+
+    def __init__(self, path):
+        # fail if 'inprogress' exists
+        self.h5 = h5py.File(path, 'w-')
+        # SZ3 worker processes, started by the first SZ3 dataset
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def configure(compression_opts):
+        pass
+
+    def set_header(self, header):
+        '''Copy the `/Header` group `header` of an input file, or set the
+        attributes in the dict `header`.
+        '''
+        if isinstance(header, h5py.Group):
+            header.file.copy(header, self.h5['/'], 'Header')
+            return
+        self.h5.create_group('/Header')
+        for k in header:
+            self.h5['/Header'].attrs[k] = header[k]
+
+    def set_info(self, info):
+        if 'CompressionInfo' not in self.h5:
+            self.h5.create_group('/CompressionInfo')
+        self.h5['/CompressionInfo'].attrs['json'] = json.dumps(info)
+
+    def write(self, name, data, opts, nthreads=1, max_memory=None, metrics=None):
+        '''Compress `data` (an array or h5py Dataset) into dataset `name`,
+        truncated to `opts['truncbits']`. Direct chunk writes (`nthreads`)
+        need the Blosc filter; other filters, like the Blosc2 one that
+        `--tuning` can pick, go through h5py.
+        '''
+        if metrics is None:
+            metrics = Metrics()
+        if 'sz3' in opts:
+            if nthreads > 1 and self.pool is None:
+                self.pool = lossy.make_pool(nthreads)
+            lossy.write_dataset(self.h5, name, data, opts, nthreads, max_memory,
+                                metrics=metrics, pool=self.pool if nthreads > 1 else None)
+            return
+        if nthreads > 1 and opts['hdf5'].get('compression') == direct_chunk.BLOSC_FILTER_ID:
+            direct_chunk.write_dataset(self.h5, name, data, opts, nthreads, max_memory,
+                                       metrics=metrics)
+            return
+        if opts.get('blocksize'):
+            warnings.warn('The Blosc block size from --tuning only applies to direct chunk '
+                          'writes (--nthreads > 1 with the Blosc filter); the filter picks its own')
+        if max_memory is None:
+            with metrics.stage('read'):
+                p = data[:]
+            with metrics.stage('truncate'):
+                direct_chunk.truncate(p, opts['truncbits'])
+            with metrics.stage('compress'):
+                self.h5.create_dataset(name, data=p, **opts['hdf5'])
+        else:
+            write_streaming(data, self.h5, name, opts, max_memory, metrics=metrics)
+
+    def flush(self):
+        self.h5.flush()
+
+    def close(self):
+        self.h5.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    @staticmethod
+    def annotate(path, key, value):
+        with h5py.File(path, 'r+') as h5:
+            h5['/CompressionInfo'].attrs[key] = value
+
+    @staticmethod
+    def size(path):
+        return Path(path).stat().st_size
+
+    @classmethod
+    def finish(cls, path):
+        '''Make the complete output at `path` read-only, and give it its
+        final name. Returns that name.
+        '''
+        path = Path(path)
+        path.chmod(0o444)
+        return path.rename(path.with_suffix(cls.suffix))
+
+
+class Blosc2Output:
+    '''A directory of Blosc2 NDArray containers, one per dataset.
+    '''
+    suffix = '.blosc2'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # fail if 'inprogress' exists
+        self.path.mkdir()
+        self.meta = {}
+        for group in ['Header', 'CompressionInfo']:
+            self.meta[group] = blosc2.empty((0,), dtype=np.uint8,
+                                            urlpath=str(self.path / f'{group}.b2nd'), mode='w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def configure(compression_opts):
+        '''Add the Blosc2 settings equivalent to the HDF5 ones of each dataset.
+        '''
+        for opts in compression_opts.values():
+            if isinstance(opts, dict) and 'hdf5' in opts:
+                opts['blosc2'] = blosc2_opts(opts)
+
+    def set_header(self, header):
+        if isinstance(header, h5py.Group):
+            header = header.attrs
+        attrs = {}
+        for k in header:
+            v = np.asarray(header[k])
+            attrs[k] = [v.dtype.str, v.tolist()]
+        self.meta['Header'].vlmeta['attrs'] = attrs
+
+    def set_info(self, info):
+        self.meta['CompressionInfo'].vlmeta['json'] = json.dumps(info)
+
+    def write(self, name, data, opts, nthreads=1, max_memory=None, metrics=None):
+        '''Compress `data` (an array or h5py Dataset) into the container of
+        dataset `name`, truncated to `opts['truncbits']`, with `nthreads`
+        Blosc2 threads. With `max_memory`, a Dataset is copied in slabs of
+        whole super-chunks of at most that size (but at least one).
+        '''
+        if metrics is None:
+            metrics = Metrics()
+        b2 = opts['blosc2']
+        dtype = np.dtype(opts['hdf5'].get('dtype', data.dtype)).newbyteorder('=')
+        urlpath = self.path / f'{name.strip("/")}.b2nd'
+        urlpath.parent.mkdir(parents=True, exist_ok=True)
+        kwargs = dict(
+            chunks=(b2['chunkrows'],) + data.shape[1:],
+            blocks=(b2['blockrows'],) + data.shape[1:],
+            cparams=blosc2.CParams(
+                codec=blosc2.Codec[b2['codec'].upper()],
+                clevel=b2['clevel'],
+                filters=[blosc2.Filter[f.upper()] for f in b2['filters']],
+                typesize=dtype.itemsize,
+                nthreads=nthreads,
+            ),
+            urlpath=str(urlpath),
+            mode='w',
+        )
+
+        if max_memory is None:
+            with metrics.stage('read'):
+                p = data[:]
+            with metrics.stage('truncate'):
+                direct_chunk.truncate(p, opts['truncbits'])
+            with metrics.stage('compress'):
+                blosc2.asarray(np.ascontiguousarray(p, dtype=dtype), **kwargs)
+            return
+
+        out = blosc2.empty(data.shape, dtype=dtype, **kwargs)
+        rowbytes = dtype.itemsize * int(np.prod(data.shape[1:]))
+        chunkrows = b2['chunkrows']
+        slabrows = max(1, max_memory // (chunkrows * rowbytes)) * chunkrows
+        buf = np.empty((min(slabrows, max(len(data), 1)),) + data.shape[1:], dtype=data.dtype)
+        for start in range(0, len(data), slabrows):
+            n = min(slabrows, len(data) - start)
+            slab = buf[:n]
+            with metrics.stage('read'):
+                if isinstance(data, np.ndarray):
+                    slab[...] = data[start:start + n]
+                else:
+                    data.read_direct(slab, np.s_[start:start + n], np.s_[0:n])
+            with metrics.stage('truncate'):
+                direct_chunk.truncate(slab, opts['truncbits'])
+            with metrics.stage('compress'):
+                out[start:start + n] = slab
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.meta = {}
+
+    @staticmethod
+    def annotate(path, key, value):
+        meta = blosc2.open(str(Path(path) / 'CompressionInfo.b2nd'), mode='a')
+        meta.vlmeta[key] = value
+
+    @staticmethod
+    def size(path):
+        return sum(fn.stat().st_size for fn in Path(path).rglob('*') if fn.is_file())
+
+    @classmethod
+    def finish(cls, path):
+        path = Path(path)
+        for fn in path.rglob('*'):
+            fn.chmod(0o444 if fn.is_file() else 0o555)
+        path.chmod(0o555)
+        return path.rename(path.with_suffix(cls.suffix))
+
+    @staticmethod
+    def open(path):
+        '''Read a Blosc2 output: returns the header attributes, the
+        compression info and {'/PartTypeN/name': NDArray}.
+        '''
+        path = Path(path)
+        header = blosc2.open(str(path / 'Header.b2nd'))
+        attrs = {}
+        for k, (dtype, value) in header.vlmeta['attrs'].items():
+            v = np.asarray(value, dtype=dtype)
+            attrs[k] = v[()] if v.ndim == 0 else v
+        info = blosc2.open(str(path / 'CompressionInfo.b2nd'))
+        info = json.loads(info.vlmeta['json'])
+        arrays = {'/' + str(fn.relative_to(path).with_suffix('')): blosc2.open(str(fn))
+                  for fn in sorted(path.glob('PartType*/*.b2nd'))}
+        return attrs, info, arrays
+
+
+BACKENDS = dict(hdf5=HDF5Output, blosc2=Blosc2Output)
+
+
+def blosc2_opts(opts):
+    '''The Blosc2 settings of one dataset, from the Blosc or Blosc2 HDF5
+    filter in `opts['hdf5']` and its chunks (and `opts['blocksize']`, if set).
+    '''
+    hdf5_opts = opts['hdf5']
+    if hdf5_opts.get('compression') not in (direct_chunk.BLOSC_FILTER_ID, BLOSC2_FILTER_ID):
+        raise ValueError(f'No Blosc2 equivalent of the HDF5 filter {hdf5_opts.get("compression")}')
+    # both filters take the Blosc2 codec and filter codes
+    clevel, shuffle, compcode = hdf5_opts['compression_opts'][4:7]
+    chunkrows = hdf5_opts['chunks'][0]
+    blockrows = chunkrows
+    if opts.get('blocksize'):
+        rowbytes = np.dtype(hdf5_opts.get('dtype', 'f4')).itemsize * int(np.prod(hdf5_opts['chunks'][1:]))
+        blockrows = max(1, opts['blocksize'] // rowbytes)
+    return dict(
+        codec=blosc2.Codec(int(compcode)).name.lower(),
+        clevel=int(clevel),
+        filters=[blosc2.Filter(int(shuffle)).name.lower()],
+        chunkrows=SUPERCHUNK * chunkrows,
+        blockrows=blockrows,
+    )
+
+
+def write_streaming(dset, h5out, name, opts, max_memory, metrics=None):
+    '''Copy `dset` to `h5out[name]` one chunk-aligned slab at a time, so that
+    at most `max_memory` bytes of particle data are held at once (but never
+    less than one chunk).
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    hdf5_opts = opts['hdf5']
+    out = h5out.create_dataset(name, shape=dset.shape, dtype=dset.dtype,
+        **hdf5_opts,
+        )
+
+    chunkrows = hdf5_opts['chunks'][0]
+    rowbytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+    slabrows = max(1, max_memory // (chunkrows * rowbytes)) * chunkrows
+    slabrows = min(slabrows, max(len(dset), 1))
+
+    buf = np.empty((slabrows,) + dset.shape[1:], dtype=dset.dtype)
+    for start in range(0, len(dset), slabrows):
+        n = min(slabrows, len(dset) - start)
+        slab = buf[:n]
+        with metrics.stage('read'):
+            dset.read_direct(slab, np.s_[start:start + n], np.s_[0:n])
+        with metrics.stage('truncate'):
+            direct_chunk.truncate(slab, opts['truncbits'])
+        with metrics.stage('compress'):
+            out[start:start + n] = slab
+    with metrics.stage('compress'):
+        # the last chunks are compressed when they leave the chunk cache
+        out.id.flush()
@@ -1,29 +1,209 @@
 #!/usr/bin/env python3
+'''
+Benchmark reads of original and compressed snapshot files, to track how much
+slower downstream analysis gets on the compressed archive.
 
+Access patterns:
+    - full: read the whole dataset
+    - strided: read every `--stride`-th particle
+    - random: read randomly chosen chunk-aligned row ranges
+    - idrange: read the particles in randomly chosen ParticleID ranges
+
+Each pattern is run for every combination of dataset, chunk cache setting and
+thread count. Each thread opens its own file handle. Results, including
+latency percentiles per read and aggregate MB/s, are written as JSON.
+
+With `--engines h5py,reader`, each read is also done through reader.py, which
+decompresses chunks in parallel with `--reader-threads` threads (the chunk
+cache settings do not apply to it).
+'''
+
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import timeit
 
+import click
 import h5py
 import hdf5plugin
+import numpy as np
+
+import reader
+from compress_hdf5 import parse_size
+
+
+def csv(type):
+    return lambda ctx, param, value: [type(v) for v in value.split(',')]
+
+
+@click.command()
+@click.argument('files', nargs=-1, required=True)
+@click.option('--output', '-o', default='bench.json',
+    help='Where to write the JSON results',
+)
+@click.option('--datasets', default='Coordinates,Velocities,ParticleIDs', callback=csv(str))
+@click.option('--patterns', default='full,strided,random,idrange', callback=csv(str))
+@click.option('--cache', default='1M,64M', callback=csv(parse_size),
+    help='HDF5 chunk cache sizes (rdcc_nbytes) to try',
+)
+@click.option('--cache-slots', default='521,10007', callback=csv(int),
+    help='HDF5 chunk cache hash table sizes (rdcc_nslots) to try',
+)
+@click.option('--threads', default='1,4', callback=csv(int))
+@click.option('--engines', default='h5py', callback=csv(str),
+    help='Any of h5py, reader (reader.py parallel decompression)',
+)
+@click.option('--reader-threads', default=0,
+    help='Decompression threads per reader.py handle; 0 for all cores',
+)
+@click.option('--parttype', default=1)
+@click.option('--stride', default=64)
+@click.option('--nreads', default=32,
+    help='Number of reads for the random and idrange patterns',
+)
+@click.option('--read-rows', default=1<<16,
+    help='Rows (or IDs) per read for the random and idrange patterns',
+)
+@click.option('--repeat', default=3,
+    help='Number of times to repeat the full and strided patterns',
+)
+@click.option('--seed', default=123)
+@click.option('--verbose', '-V', is_flag=True, default=False)
+def main(files, output, datasets, patterns, cache, cache_slots, threads, engines,
+         reader_threads, parttype, stride, nreads, read_rows, repeat, seed,
+         verbose=False):
+    results = []
+    for fn in files:
+        info = layout(fn, parttype, datasets)
+        for engine, name, pattern, nbytes, nslots, nthreads in itertools.product(
+                engines, datasets, patterns, cache, cache_slots, threads):
+            if engine == 'reader':
+                if (nbytes, nslots) != (cache[0], cache_slots[0]):
+                    continue
+                nbytes = nslots = None
+            rng = np.random.default_rng(seed)
+            ops = make_ops(pattern, info, name, rng,
+                           stride=stride, nreads=nreads, read_rows=read_rows,
+                           repeat=repeat,
+                           )
+            res = bench(fn, parttype, name, ops, nbytes, nslots, nthreads,
+                        engine=engine, reader_threads=reader_threads or None,
+                        )
+            res.update(file=str(fn), filesize=info['filesize'],
+                       layout=info['datasets'][name],
+                       sorted=info['sorted'], dataset=name, pattern=pattern,
+                       engine=engine, rdcc_nbytes=nbytes, rdcc_nslots=nslots,
+                       threads=nthreads,
+                       )
+            results += [res]
+            if verbose:
+                print(f'{fn} {engine} {name} {pattern} cache={nbytes}/{nslots} '
+                      f'threads={nthreads}: {res["MBps"]:.4g} MB/s, '
+                      f'p50 {res["latency"]["p50"]*1e3:.3g} ms')
+
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=1)
+
+
+def layout(fn, parttype, datasets):
+    '''On-disk layout of each dataset, and whether the file is ID-sorted.
+    '''
+    info = dict(datasets={}, sorted=False)
+    with h5py.File(fn, 'r') as h5:
+        if 'CompressionInfo' in h5:
+            info['sorted'] = bool(json.loads(h5['/CompressionInfo'].attrs['json']).get('sort', False))
+        for name in datasets:
+            dset = h5[f'/PartType{parttype}/{name}']
+            info['datasets'][name] = dict(
+                shape=dset.shape,
+                chunks=dset.chunks,
+                filters=dset._filters,
+                stored_bytes=dset.id.get_storage_size(),
+                nbytes=dset.nbytes,
+            )
+        info['nrows'] = len(h5[f'/PartType{parttype}/ParticleIDs'])
+    info['filesize'] = Path(fn).stat().st_size
+    return info
 
 
-def bench(fn):
-    h = h5py.File(fn,
-        # rdcc_nbytes=0,
-    )
+def make_ops(pattern, info, name, rng, stride, nreads, read_rows, repeat):
+    '''A list of reads, each a function of the dataset (and the ID dataset).
+    '''
+    nrows = info['nrows']
+    chunkrows = (info['datasets'][name]['chunks'] or (read_rows,))[0]
+
+    if pattern == 'full':
+        return [lambda d, ids: d[:]] * repeat
+
+    if pattern == 'strided':
+        return [lambda d, ids: d[::stride]] * repeat
+
+    if pattern == 'random':
+        # read_rows, rounded to whole chunks
+        n = max(1, read_rows // chunkrows) * chunkrows
+        starts = rng.integers(0, max(nrows - n, 0) // chunkrows + 1, size=nreads) * chunkrows
+        return [lambda d, ids, s=s: d[s:s + n] for s in starts]
+
+    if pattern == 'idrange':
+        starts = rng.integers(0, max(nrows - read_rows, 0) + 1, size=nreads)
+        if info['sorted']:
+            def read(d, ids, s):
+                # dense sorted IDs: the ID range is a row range
+                return d[s : s + read_rows]
+        else:
+            def read(d, ids, s):
+                # need all the IDs to find the rows
+                allids = ids[:]
+                lo = allids.min() + s
+                return d[:][(allids >= lo) & (allids < lo + read_rows)]
+        return [lambda d, ids, s=s: read(d, ids, s) for s in starts]
+
+    raise ValueError(pattern)
+
+
+def bench(fn, parttype, name, ops, rdcc_nbytes, rdcc_nslots, nthreads,
+          engine='h5py', reader_threads=None):
+    '''Run `ops` split across `nthreads` threads, each with its own handle.
+    '''
+    def open_file():
+        if engine == 'reader':
+            return reader.Snapshot([fn], nthreads=reader_threads)
+        return h5py.File(fn, 'r', rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+
+    def worker(myops):
+        lat = []
+        size = 0
+        with open_file() as h:
+            d = h[f'/PartType{parttype}/{name}']
+            ids = h[f'/PartType{parttype}/ParticleIDs']
+            for op in myops:
+                t = -timeit.default_timer()
+                a = op(d, ids)
+                t += timeit.default_timer()
+                lat += [t]
+                size += a.nbytes
+        return lat, size
+
     elapsed = -timeit.default_timer()
-    size = 0
-    a = h['/PartType1/Coordinates'][:]
-    size += a.nbytes
-    # a = h['/PartType1/Velocities'][:]
-    # size += a.nbytes
-    # a = h['/PartType1/ParticleIDs'][:]
-    # size += a.nbytes
+    with ThreadPoolExecutor(nthreads) as pool:
+        res = list(pool.map(worker, [ops[i::nthreads] for i in range(nthreads)]))
     elapsed += timeit.default_timer()
-    print(f'Time: {elapsed:.4g} sec')
-    print(f'Rate: {size/elapsed/1e6:.4g} MB/s')
+
+    lat = np.concatenate([r[0] for r in res])
+    size = sum(r[1] for r in res)
+    return dict(nreads=len(lat),
+                bytes=size,
+                elapsed=elapsed,
+                MBps=size / elapsed / 1e6,
+                latency=dict(mean=float(lat.mean()),
+                             p50=float(np.percentile(lat, 50)),
+                             p90=float(np.percentile(lat, 90)),
+                             p99=float(np.percentile(lat, 99)),
+                             max=float(lat.max()),
+                             ),
+                )
+
 
 if __name__ == '__main__':
-    bench('data/snapdir_000/snap_000.1.hdf5')
-    bench('out/snap_000.1.hdf5')
-    # bench('/dev/shm/snap.hdf5')
-    # bench('/dev/shm/snap.comp.hdf5')
+    main()
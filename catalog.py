@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+'''
+Catalog of the compressed archive, in SQLite.
+
+`scan` lists the trees with `os.scandir` in a thread pool (see treescan.py),
+then reads only the metadata of each `.hdf5` file in a process pool: the
+`/Header` attributes, `/CompressionInfo['json']`, and the shape, chunk count
+and stored size of each particle dataset. Files already in the catalog with
+the same size and mtime are not opened again, and files that are gone are
+dropped, so a rescan only costs the directory listing plus the new files.
+
+The `files` table has one row per file, with indexed columns for the usual
+questions (box, n1d, redshift, truncation bits, sort, layout) and the full
+header and compression options as JSON, for `json_extract`. The `datasets`
+table has one row per particle dataset.
+
+    catalog.py scan ~/ceph/Quijote/SnapshotsCompressed -j 64
+    catalog.py ratio --by box,n1d,redshift
+    catalog.py find --truncpos 6 --truncvel 11
+    catalog.py sql "SELECT path FROM files WHERE sort AND nfiles > 1"
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+import sqlite3
+import sys
+from timeit import default_timer
+
+import click
+import h5py
+import hdf5plugin
+import numpy as np
+
+import treescan
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    snapshot TEXT,
+    box REAL,
+    n1d INTEGER,
+    redshift REAL,
+    nfiles INTEGER,
+    npart INTEGER,
+    raw_bytes INTEGER,
+    stored_bytes INTEGER,
+    ratio REAL,
+    truncpos INTEGER,
+    truncvel INTEGER,
+    sort INTEGER,
+    layout TEXT,
+    header TEXT,
+    compression TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    path TEXT,
+    name TEXT,
+    dtype TEXT,
+    rows INTEGER,
+    chunkrows INTEGER,
+    nchunks INTEGER,
+    filter INTEGER,
+    raw_bytes INTEGER,
+    stored_bytes INTEGER,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS files_sim ON files (box, n1d, redshift);
+CREATE INDEX IF NOT EXISTS files_trunc ON files (truncpos, truncvel);
+CREATE INDEX IF NOT EXISTS files_snapshot ON files (snapshot);
+'''
+
+FILE_COLUMNS = ['path', 'size', 'mtime_ns', 'snapshot', 'box', 'n1d', 'redshift', 'nfiles',
+                'npart', 'raw_bytes', 'stored_bytes', 'ratio', 'truncpos', 'truncvel',
+                'sort', 'layout', 'header', 'compression', 'error']
+
+
+class Catalog:
+    '''The SQLite catalog file.
+    '''
+
+    def __init__(self, fn):
+        self.db = sqlite3.connect(fn)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.db.commit()
+        self.db.close()
+
+    def known(self, root):
+        '''{path: (size, mtime_ns)} of the cataloged files under `root`.
+        '''
+        rows = self.db.execute("SELECT path, size, mtime_ns FROM files "
+                               "WHERE path >= ? AND path < ?",
+                               (f'{root}/', f'{root}0'))  # '0' sorts right after '/'
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def remove(self, paths):
+        self.db.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in paths])
+        self.db.executemany('DELETE FROM datasets WHERE path = ?', [(p,) for p in paths])
+
+    def add(self, row, datasets):
+        self.remove([row['path']])
+        self.db.execute(f'INSERT INTO files VALUES ({",".join("?" * len(FILE_COLUMNS))})',
+                        [row.get(c) for c in FILE_COLUMNS])
+        self.db.executemany('INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            [(row['path'], d['name'], d['dtype'], d['rows'], d['chunkrows'],
+                              d['nchunks'], d['filter'], d['raw_bytes'], d['stored_bytes'])
+                             for d in datasets])
+
+
+def jsonable(v):
+    return v.tolist() if isinstance(v, (np.ndarray, np.generic)) else v
+
+
+def read_metadata(path, size, mtime_ns):
+    '''The `files` row and `datasets` rows of one HDF5 file, reading only its
+    metadata. Errors are recorded in the row rather than raised.
+    '''
+    row = dict(path=path, size=size, mtime_ns=mtime_ns, snapshot=str(Path(path).parent))
+    datasets = []
+    try:
+        with h5py.File(path, 'r', rdcc_nbytes=0) as h5:
+            header = {k: jsonable(v) for k, v in h5['/Header'].attrs.items()}
+            info = (json.loads(h5['/CompressionInfo'].attrs['json'])
+                    if 'CompressionInfo' in h5 else None)
+
+            for group in h5:
+                if not group.startswith('PartType'):
+                    continue
+                for name, dset in h5[group].items():
+                    datasets += [dict(
+                        name=f'{group}/{name}',
+                        dtype=dset.dtype.str,
+                        rows=dset.shape[0],
+                        raw_bytes=dset.nbytes,
+                        **storage(dset),
+                    )]
+    except Exception as e:
+        row['error'] = f'{type(e).__name__}: {e}'
+        return row, []
+
+    npart_total = header.get('NumPart_Total', [0, 0])
+    raw = sum(d['raw_bytes'] for d in datasets)
+    stored = sum(d['stored_bytes'] for d in datasets)
+    row.update(
+        box=header.get('BoxSize'),
+        n1d=int(round(npart_total[1] ** (1/3))) if len(npart_total) > 1 else None,
+        redshift=header.get('Redshift'),
+        nfiles=header.get('NumFilesPerSnapshot'),
+        npart=int(np.sum(header.get('NumPart_ThisFile', 0))),
+        raw_bytes=raw,
+        stored_bytes=stored,
+        ratio=raw / stored if stored else None,
+        header=json.dumps(header),
+    )
+    if info is not None:
+        row.update(
+            truncpos=info.get('Coordinates', {}).get('truncbits'),
+            truncvel=info.get('Velocities', {}).get('truncbits'),
+            sort=info.get('sort', False),
+            layout=info.get('layout', 'file'),
+            compression=json.dumps(info),
+        )
+    return row, datasets
+
+
+def storage(dset):
+    '''The chunk rows, number of chunks, filter and stored bytes of `dset`. The
+    virtual datasets of a sharded snapshot's master file (see shards.py) store
+    nothing themselves, so theirs are those of their shards' datasets.
+    '''
+    if not dset.is_virtual:
+        plist = dset.id.get_create_plist()
+        return dict(
+            chunkrows=dset.chunks[0] if dset.chunks else None,
+            nchunks=dset.id.get_num_chunks() if dset.chunks else None,
+            filter=plist.get_filter(0)[0] if plist.get_nfilters() else None,
+            stored_bytes=dset.id.get_storage_size(),
+        )
+    out = dict(chunkrows=None, nchunks=0, filter=None, stored_bytes=0)
+    for vs in dset.virtual_sources():
+        # relative to the master file, as shards.py writes them
+        fn = Path(dset.file.filename).parent / vs.file_name
+        with h5py.File(fn, 'r', rdcc_nbytes=0) as h5:
+            d = storage(h5[vs.dset_name])
+        out['chunkrows'] = out['chunkrows'] or d['chunkrows']
+        out['nchunks'] += d['nchunks'] or 0
+        out['filter'] = out['filter'] or d['filter']
+        out['stored_bytes'] += d['stored_bytes']
+    return out
+
+
+def hdf5_files(root, threads):
+    '''{path: stat} of the .hdf5 files under `root`. The shards of a sharded
+    snapshot are left out: their master file is cataloged with their sizes.
+    '''
+    tree = treescan.scan_tree(root, prune=lambda d: d.endswith('.shards'), threads=threads)
+    return {str(root / rel / fn): st
+            for rel, (files, _, _) in tree.items()
+            for fn, st in files.items() if fn.endswith('.hdf5')}
+
+
+@click.group()
+@click.option('--catalog', '-c', default='catalog.sqlite',
+    help='The SQLite catalog file',
+)
+@click.pass_context
+def cli(ctx, catalog):
+    ctx.obj = catalog
+
+
+@cli.command()
+@click.argument('roots', nargs=-1, required=True)
+@click.option('--nprocs', '-j', default=len(os.sched_getaffinity(0)),
+    help='Number of processes reading file metadata',
+)
+@click.option('--threads', default=32,
+    help='Number of directories to list concurrently',
+)
+@click.option('--verbose', '-V', is_flag=True, default=False)
+@click.pass_obj
+def scan(catalog, roots, nprocs, threads, verbose=False):
+    '''Add the .hdf5 files under each ROOT to the catalog, or refresh them.'''
+    t = -default_timer()
+    nnew = nremoved = nerrors = nfiles = 0
+    with Catalog(catalog) as cat, ProcessPoolExecutor(nprocs) as pool:
+        for root in roots:
+            root = Path(root).resolve()
+            files = hdf5_files(root, threads)
+            known = cat.known(root)
+            nfiles += len(files)
+
+            gone = known.keys() - files.keys()
+            cat.remove(gone)
+            nremoved += len(gone)
+
+            todo = [(p, st.st_size, st.st_mtime_ns) for p, st in sorted(files.items())
+                    if known.get(p) != (st.st_size, st.st_mtime_ns)]
+            paths, sizes, mtimes = zip(*todo) if todo else ((), (), ())
+            for row, datasets in pool.map(read_metadata, paths, sizes, mtimes, chunksize=8):
+                cat.add(row, datasets)
+                nnew += 1
+                if row.get('error'):
+                    nerrors += 1
+                    print(f'{row["path"]}: {row["error"]}', file=sys.stderr)
+                elif verbose:
+                    print(row['path'])
+                if nnew % 1000 == 0:
+                    cat.db.commit()
+
+    t += default_timer()
+    print(f'{nfiles} files, {nnew} read, {nremoved} removed, {nerrors} unreadable, '
+          f'in {t:.4g} sec', file=sys.stderr)
+
+
+def print_rows(cursor):
+    names = [d[0] for d in cursor.description]
+    print('\t'.join(names))
+    for row in cursor:
+        print('\t'.join('' if v is None else f'{v:.4g}' if isinstance(v, float) else str(v)
+                        for v in row))
+
+
+@cli.command()
+@click.option('--by', default='box,n1d,redshift',
+    help='Comma-separated files columns to group by',
+)
+@click.pass_obj
+def ratio(catalog, by):
+    '''Compression ratio and sizes, grouped by the given columns.'''
+    cols = [c.strip() for c in by.split(',') if c.strip()]
+    for c in cols:
+        if c not in FILE_COLUMNS:
+            raise click.BadParameter(f'unknown column {c}', param_hint='--by')
+    keys = [f'ROUND({c}, 4) AS {c}' if c == 'redshift' else c for c in cols]
+    with Catalog(catalog) as cat:
+        print_rows(cat.db.execute(
+            f'SELECT {", ".join(keys)}, COUNT(*) AS files, '
+            'SUM(raw_bytes) / 1e9 AS raw_gb, SUM(stored_bytes) / 1e9 AS stored_gb, '
+            'CAST(SUM(raw_bytes) AS REAL) / SUM(stored_bytes) AS ratio '
+            f'FROM files WHERE error IS NULL GROUP BY {", ".join(cols)} ORDER BY {", ".join(cols)}'
+        ))
+
+
+@cli.command()
+@click.option('--truncpos', type=int, default=None)
+@click.option('--truncvel', type=int, default=None)
+@click.option('--box', type=float, default=None)
+@click.option('--n1d', type=int, default=None)
+@click.option('--redshift', type=float, default=None)
+@click.option('--sort/--no-sort', default=None)
+@click.option('--layout', default=None)
+@click.option('--errors', is_flag=True, default=False, help='Only files that could not be read')
+@click.pass_obj
+def find(catalog, errors, **where):
+    '''List the files matching all the given values.'''
+    clauses, args = [], []
+    for c, v in where.items():
+        if v is None:
+            continue
+        if c == 'redshift':
+            clauses += ['ABS(redshift - ?) < 1e-3']
+        else:
+            clauses += [f'{c} = ?']
+        args += [v]
+    if errors:
+        clauses += ['error IS NOT NULL']
+    sql = 'SELECT path FROM files' + (' WHERE ' + ' AND '.join(clauses) if clauses else '')
+    with Catalog(catalog) as cat:
+        for (path,) in cat.db.execute(sql + ' ORDER BY path', args):
+            print(path)
+
+
+@cli.command()
+@click.argument('query')
+@click.pass_obj
+def sql(catalog, query):
+    '''Run any SQL query on the catalog.'''
+    with Catalog(catalog) as cat:
+        print_rows(cat.db.execute(query))
+
+
+if __name__ == '__main__':
+    cli()
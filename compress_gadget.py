@@ -1,19 +1,33 @@
 #!/usr/bin/env python3
 '''
 Compress Gadget files (IC or snap) to HDF5
+
+The sub-files are read in a thread pool, each straight into its place in the
+output buffer (numpy releases the GIL while copying out of the memory maps),
+and the next block is read while the current one is being compressed.
+
+With `--max-memory`, whole blocks are never held: rows are streamed in slabs,
+and `-s` sorts through ID-range buckets spilled to scratch (see outofcore.py).
 '''
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 from timeit import default_timer
 
 import click
-import h5py
 import hdf5plugin
 import numpy as np
-import readsnap
 
-from compress_hdf5 import TRUNC_LEVELS
+import backends
+import lossy
+from metrics import Metrics, emit
+import outofcore
+import shards
+import spatial
+from compress_hdf5 import TRUNC_LEVELS, apply_tuning, load_tuning, parse_size
+from gadgetfile import GadgetFile
+from lagrangian import encode as lagrangian_encode
 
 
 @click.command()
@@ -27,71 +41,214 @@ from compress_hdf5 import TRUNC_LEVELS
 )
 @click.option('verbose', '-V', is_flag=True, default=False)
 @click.option('sort', '-s', is_flag=True, default=False)
-def compress(src, dst, truncpos, truncvel, verbose=False, sort=False):
+@click.option('nthreads', '-t', default=1,
+    help='Compress chunks in this many threads, using HDF5 direct chunk writes',
+)
+@click.option('tuning', '--tuning', default=None,
+    help='JSON file from tune_compression.py with the codec and chunk settings to use',
+)
+@click.option('sz3', '--sz3', is_flag=True, default=False,
+    help='Compress Coordinates and Velocities with SZ3 to absolute error bounds from BoxSize, n1d and --softening, instead of truncating (see lossy.py)',
+)
+@click.option('softening', '--softening', default=lossy.SOFTENING_FRACTION,
+    help='Softening length as a fraction of the mean interparticle spacing, for the --sz3 error bounds',
+)
+@click.option('lagrangian', '-l', is_flag=True, default=False,
+    help='Store Coordinates as displacements from the initial lattice (needs -s)',
+)
+@click.option('layout', '--layout', default='file', type=click.Choice(['file', 'morton']),
+    help='Particle order: as in the input, or along a Morton curve with a per-chunk spatial index',
+)
+@click.option('shard', '--shard', default=None,
+    help='K/N: compress only the K-th of N slices of the particles, into DST.shards/ (see shards.py)',
+)
+@click.option('max_memory', '--max-memory', '-m', default=None,
+    help='Hold at most about this much particle data (e.g. 4G), streaming rows and sorting (-s) out of core',
+)
+@click.option('scratch', '--scratch', default=None,
+    help='Directory for the sort buckets with --max-memory (default: $TMPDIR)',
+)
+@click.option('read_threads', '--read-threads', default=0,
+    help='Number of threads reading sub-files; 0 for one per sub-file',
+)
+@click.option('prefetch', '--prefetch/--no-prefetch', default=True,
+    help='Read the next block while the current one is compressed (holds one more block in memory)',
+)
+@click.option('backend', '--backend', default='hdf5', type=click.Choice(['hdf5', 'blosc2']),
+    help='Output format: HDF5 with the Blosc filter, or a directory of Blosc2 NDArray (.b2nd) containers (see backends.py)',
+)
+@click.option('metrics_path', '--metrics', default=None,
+    help='Append per-stage timings as a JSON line to this file (or to a per-process file in this directory)',
+)
+@click.option('metrics_info', '--metrics-info', is_flag=True, default=False,
+    help='Also store the timings in /CompressionInfo',
+)
+def compress(src, dst, truncpos, truncvel, verbose=False, sort=False, nthreads=1,
+             tuning=None, sz3=False, softening=lossy.SOFTENING_FRACTION, lagrangian=False, layout='file', shard=None, max_memory=None,
+             scratch=None, read_threads=0, prefetch=True, backend='hdf5', metrics_path=None,
+             metrics_info=False):
     t = -default_timer()
+    m = Metrics()
     dst = Path(dst)
     src = [Path(fn) for fn in src]
     validate_paths(src, dst)
+    if lagrangian and not sort:
+        raise click.UsageError('Lagrangian encoding (-l) needs ID sorting (-s)')
+    if sort and layout != 'file':
+        raise click.UsageError('ID sorting (-s) and --layout are mutually exclusive')
+    if shard is not None:
+        if lagrangian or layout != 'file':
+            raise click.UsageError('-l and --layout need the whole snapshot, so they cannot be used with --shard')
+        shard = shards.parse_shard(shard)
+    if max_memory is not None:
+        if lagrangian or layout != 'file':
+            raise click.UsageError('-l and --layout need whole blocks, so they cannot be used with --max-memory')
+        max_memory = parse_size(max_memory)
+    if backend != 'hdf5' and (layout != 'file' or shard is not None or max_memory is not None):
+        raise click.UsageError('--layout, --shard and --max-memory write HDF5 structures, so they need --backend hdf5')
+    if sz3 and (lagrangian or layout != 'file' or max_memory is not None or backend != 'hdf5'):
+        raise click.UsageError('--sz3 cannot be combined with -l, --layout, --max-memory or --backend blosc2')
+    Output = backends.BACKENDS[backend]
     # dst.parents[1].chmod(0o755)
     dst.parent.mkdir(parents=True, exist_ok=True)
 
-    all_headers = [vars(readsnap.snapshot_header(fn)) for fn in src]
-    validate_headers(all_headers)
-    header = to_hdf5_header(all_headers)
+    with m.stage('header'):
+        gfiles = [GadgetFile(fn) for fn in src]
+        all_headers = [g.header for g in gfiles]
+        validate_headers(all_headers)
+        header = to_hdf5_header(all_headers)
+
+        if tuning is not None:
+            tuning = load_tuning(tuning)
+        compression_opts = get_compression_opts(header, truncpos, truncvel,
+                            sort=sort, tuning=tuning, lagrangian=lagrangian,
+                            layout=layout, sz3=softening if sz3 else None,
+                            )
+        Output.configure(compression_opts)
 
-    compression_opts = get_compression_opts(header, truncpos, truncvel,
-                        sort=sort,
-                        )
+        # the rows of each type that go in this output
+        ntotal = header['NumPart_ThisFile'].copy()
+        window = {i: (0, ntotal[i]) for i in [1,2]}
+        if shard is not None:
+            k, nshard = shard
+            chunkrows = compression_opts['Coordinates']['hdf5']['chunks'][0]
+            window = {i: shards.shard_rows(int(ntotal[i]), k, nshard, chunkrows) for i in [1,2]}
+            header['NumPart_ThisFile'] = np.array([window[i][1] - window[i][0] if i in window else 0
+                                                   for i in range(6)], dtype=ntotal.dtype)
+            header['NumFilesPerSnapshot'] = np.int32(header['NumFilesPerSnapshot'] * nshard)
+            compression_opts['shard'] = dict(index=k, count=nshard)
+            dst = shards.shard_path(dst, k)
+            dst.parent.mkdir(exist_ok=True)
 
     out = dst.with_suffix('.inprogress')
     insize = 0
-    with h5py.File(out, 'w-') as h5out:
-        h5out.create_group('/Header')
-        for k in header:
-            h5out['/Header'].attrs[k] = header[k]
-        h5out.create_group('/CompressionInfo')
-        h5out['/CompressionInfo'].attrs['json'] = json.dumps(compression_opts)
+    copy = m.worker('read', copy_rows)
+    place = m.worker('read', place_block)
+    with Output(out) as output, ThreadPoolExecutor(read_threads or len(gfiles)) as readers:
+        with m.stage('header'):
+            output.set_header(header)
+            output.set_info(compression_opts)
 
         for i in [1,2]:
             if (npart := header['NumPart_ThisFile'][i]) == 0:
                 continue
+            lo, hi = window[i]
+
+            if max_memory is not None:
+                write = outofcore.write_sorted if sort else outofcore.write_rows
+                insize += write(output.h5, gfiles, i, compression_opts, (lo, hi), nthreads,
+                                max_memory, scratch, metrics=m)
+                continue
 
-            for name in ['ParticleIDs', 'Coordinates', 'Velocities']:
+            # With sort, IDs that are a dense permutation of idmin..idmin+N-1
+            # let us place each block directly by ID (O(N), no gather copy).
+            # Otherwise, fall back to argsort.
+            ids, idmin, iord = None, None, None
+            names = ['ParticleIDs', 'Coordinates', 'Velocities']
+            if layout == 'morton':
+                # the order comes from the positions
+                names = ['Coordinates', 'ParticleIDs', 'Velocities']
+
+            def load(name):
+                # start reading every sub-file into its place in a new buffer:
+                # rows lo..hi in file order, or IDs idmin+lo..idmin+hi once
+                # they are known. Sorting by argsort needs all the rows.
                 opts = compression_opts[name]
-                shape = (npart,3) if name in ('Coordinates','Velocities') else (npart,)
+                a, b = (0, ntotal[i]) if sort and idmin is None else (lo, hi)
+                shape = (b - a, 3) if name in ('Coordinates','Velocities') else (b - a,)
                 tmp = np.empty(shape, dtype=opts['hdf5']['dtype'])
-                
-                blockname = opts['blockname']
+                futures = []
                 nwrite = 0
-                for fn in src:
-                    if 'ic' in fn.name:
+                for g in gfiles:
+                    if 'ic' in g.filename.name:
                         assert opts['truncbits'] == 0
-                    block = readsnap.read_block(fn, blockname, parttype=i,
-                        physical_velocities=False,
-                        )
-                    insize += block.nbytes
-
-                    tbits = opts['truncbits']
-                    mask = ~np.uint32((1 << tbits) - 1)
-                    block = (block.view(dtype=np.uint32) & mask).view(dtype=block.dtype)
-
-                    tmp[nwrite : nwrite + len(block)] = block
-                    nwrite += len(block)
-                    del block
-                assert nwrite == shape[0]
-
-                if sort:
-                    if name == 'ParticleIDs':
-                        iord = np.argsort(tmp)
-                    tmp = tmp[iord]
-                h5out.create_dataset(f'/PartType{i}/{name}',
-                    data=tmp,
-                    **opts['hdf5'],
-                    )
-            if sort:
-                del iord
-
-    outsize = out.stat().st_size
+                    n = g.header['npart'][i]
+                    if idmin is not None:
+                        futures += [readers.submit(place, g, opts['blockname'], i,
+                                                   tmp, ids[nwrite : nwrite + n], idmin + a,
+                                                   b - a < ntotal[i])]
+                    elif max(a, nwrite) < min(b, nwrite + n):
+                        first, last = max(a, nwrite), min(b, nwrite + n)
+                        futures += [readers.submit(copy, g, opts['blockname'], i,
+                                                   tmp[first - a : last - a], first - nwrite)]
+                    nwrite += n
+                assert nwrite == ntotal[i]
+                return tmp, futures
+
+            loading = None
+            for k, name in enumerate(names):
+                opts = compression_opts[name]
+                if loading is None:
+                    loading = load(name)
+                tmp, futures = loading
+                loading = None
+                with m.stage('read'):
+                    for fut in futures:
+                        fut.result()
+                insize += tmp.nbytes
+
+                with m.stage('sort'):
+                    if sort and name == 'ParticleIDs':
+                        idmin = dense_id_offset(tmp)
+                        if idmin is not None:
+                            ids = tmp
+                            tmp = np.arange(idmin + lo, idmin + hi, dtype=ids.dtype)
+                        else:
+                            iord = np.argsort(tmp)[lo:hi]
+                    if layout == 'morton' and name == 'Coordinates':
+                        iord, keys = spatial.morton_order(tmp, header['BoxSize'])
+                    if iord is not None:
+                        tmp = tmp[iord]
+                    if layout == 'morton' and name == 'Coordinates':
+                        chunkrows = opts['hdf5']['chunks'][0]
+                        index = spatial.build_index(tmp, keys, chunkrows, opts['truncbits'])
+                        spatial.write_index(output.h5, i, index, chunkrows, header['BoxSize'])
+                        del keys
+                if prefetch and k + 1 < len(names):
+                    # the next block loads while this one is encoded and compressed
+                    loading = load(names[k + 1])
+
+                if name == 'Coordinates' and lagrangian:
+                    if idmin is None:
+                        raise ValueError(f'Lagrangian encoding needs dense IDs (PartType{i})')
+                    n1d = int(round(header['NumPart_Total'][i]**(1/3)))
+                    with m.stage('encode'):
+                        params = lagrangian_encode(tmp, n1d, header['BoxSize'], opts['truncbits'])
+                    opts['lagrangian'][f'PartType{i}'] = params
+                    opts = dict(opts, truncbits=params['truncbits'])
+                output.write(f'/PartType{i}/{name}', tmp, opts, nthreads, metrics=m)
+                del tmp
+            del ids, iord
+
+        # now with the per-type encoding parameters and SZ3 errors
+        output.set_info(compression_opts)
+
+        with m.stage('write'):
+            output.flush()
+
+    for g in gfiles:
+        g.close()
+    outsize = Output.size(out)
     t += default_timer()
     if verbose:
         print(f'Input size:  {insize/1e6:.4g} MB')
@@ -100,14 +257,26 @@ def compress(src, dst, truncpos, truncvel, verbose=False, sort=False):
         print(f'Compression speed: {insize/t/1e6:.3g} MB/s')
         print(f'Options: {compression_opts}')
     
-    if outsize > insize:
+    if outsize > insize and insize:  # an empty shard has only a header
         raise RuntimeError(f'Compressed size {outsize} greater than uncompressed size {insize}')
 
-    out.chmod(0o444)
-    out.rename(out.with_suffix('.hdf5'))
+    if metrics_path is not None or metrics_info:
+        m.bytes_read = insize
+        m.bytes_written = outsize
+        record = m.record(script='compress_gadget', src=[str(fn) for fn in src],
+            dst=str(out.with_suffix(Output.suffix)), input_bytes=insize,
+            nthreads=nthreads, sort=sort, lagrangian=lagrangian, layout=layout,
+            max_memory=max_memory, backend=backend, sz3=sz3,
+            )
+        emit(record, metrics_path)
+        if metrics_info:
+            Output.annotate(out, 'metrics', json.dumps(record))
 
+    Output.finish(out)
 
-def get_compression_opts(header, truncpos, truncvel, clevel=5, sort=False):
+
+def get_compression_opts(header, truncpos, truncvel, clevel=5, sort=False, tuning=None,
+                         lagrangian=False, layout='file', sz3=None):
 
     box = header['BoxSize']
     n1d = int(round(header['NumPart_Total'][1]**(1/3)))
@@ -157,9 +326,56 @@ def get_compression_opts(header, truncpos, truncvel, clevel=5, sort=False):
         sort=sort,
     )
 
+    if tuning is not None:
+        apply_tuning(compression_opts, tuning)
+
+    if sz3 is not None:
+        lossy.apply_sz3(compression_opts, box, n1d, sz3)
+
+    if lagrangian:
+        compression_opts['Coordinates'].update(encoding='lagrangian', lagrangian={})
+    if layout != 'file':
+        compression_opts['layout'] = layout
+
     return compression_opts
 
 
+def copy_rows(g, blockname, parttype, out, start):
+    '''Copy rows start..start+len(out) of one block of the Gadget file `g`
+    into `out`.
+    '''
+    out[...] = g.view_block(blockname, parttype)[start : start + len(out)]
+
+
+def place_block(g, blockname, parttype, out, ids, first, clip=False):
+    '''Copy one block of the Gadget file `g` into `out`, each particle at
+    row ID - first. With `clip`, particles outside of `out` are skipped.
+    '''
+    block = g.view_block(blockname, parttype)
+    if clip:
+        sel = (ids >= first) & (ids < first + len(out))
+        ids, block = ids[sel], block[sel]
+    out[ids - first] = block
+
+
+def dense_id_offset(ids, blocksize=1<<24):
+    '''If `ids` is a permutation of idmin..idmin+len(ids)-1, return idmin.
+    Otherwise, return None. O(N), and processed in blocks to bound temporaries.
+    '''
+    if len(ids) == 0:
+        return None
+    idmin, idmax = ids.min(), ids.max()
+    if int(idmax) - int(idmin) + 1 != len(ids):
+        return None
+
+    seen = np.zeros(len(ids), dtype=bool)
+    for j in range(0, len(ids), blocksize):
+        seen[ids[j : j + blocksize] - idmin] = True
+    if not seen.all():
+        return None
+    return idmin
+
+
 def validate_paths(sources: list[Path], dst: Path):
     for fn in sources:
         if not fn.is_file():
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
 import json
 from pathlib import Path
+import re
+import time
 from timeit import default_timer
 
 import click
@@ -9,6 +15,11 @@ import h5py
 import hdf5plugin
 import numpy as np
 
+import backends
+import lossy
+from metrics import Metrics, emit
+import spatial
+
 
 TRUNC_LEVELS = {
     # (box, n1d): (truncpos, truncvel)
@@ -18,6 +29,8 @@ TRUNC_LEVELS = {
     (25e3,256): (8,11),
     }
 
+DATASETS = ['Coordinates', 'Velocities', 'ParticleIDs']
+
 
 @click.command()
 @click.argument('src', nargs=-1)
@@ -28,48 +41,174 @@ TRUNC_LEVELS = {
 @click.option('--truncvel', '-v', default='auto',
     help='Number of low bits to null out in the velocity data',
 )
+@click.option('--max-memory', '-m', default=None,
+    help='Stream each dataset through a buffer of at most this size (e.g. 512M, 4G) instead of reading it whole',
+)
+@click.option('--nthreads', '-t', default=1,
+    help='Compress chunks in this many threads, using HDF5 direct chunk writes',
+)
+@click.option('--tuning', default=None,
+    help='JSON file from tune_compression.py with the codec and chunk settings to use',
+)
+@click.option('--sz3', is_flag=True, default=False,
+    help='Compress Coordinates and Velocities with SZ3 to absolute error bounds from BoxSize, n1d and --softening, instead of truncating (see lossy.py)',
+)
+@click.option('--softening', default=lossy.SOFTENING_FRACTION,
+    help='Softening length as a fraction of the mean interparticle spacing, for the --sz3 error bounds',
+)
+@click.option('--layout', default='file', type=click.Choice(['file', 'morton']),
+    help='Particle order: as in the input, or along a Morton curve with a per-chunk spatial index',
+)
+@click.option('--merge', default=0,
+    help='Combine the sub-files of one snapshot into this many outputs, each from consecutive sub-files',
+)
+@click.option('--sort', '-s', is_flag=True, default=False,
+    help='Sort the particles of each output by ID',
+)
+@click.option('--prefetch', default=0,
+    help='Read up to this many outputs ahead in a background thread, while the current one is compressed (each is held in memory whole)',
+)
+@click.option('--backend', default='hdf5', type=click.Choice(['hdf5', 'blosc2']),
+    help='Output format: HDF5 with the Blosc filter, or a directory of Blosc2 NDArray (.b2nd) containers (see backends.py)',
+)
+@click.option('--metrics', 'metrics_path', default=None,
+    help='Append per-stage timings of each file as JSON lines to this file (or to a per-process file in this directory)',
+)
+@click.option('--metrics-info', is_flag=True, default=False,
+    help='Also store the timings in /CompressionInfo',
+)
 @click.option('--verbose', '-V', is_flag=True, default=False)
-def compress(src, dst, truncpos='auto', truncvel='auto', verbose=False):
+def compress(src, dst, truncpos='auto', truncvel='auto', max_memory=None,
+             nthreads=1, tuning=None, sz3=False, softening=lossy.SOFTENING_FRACTION,
+             layout='file', merge=0, sort=False, prefetch=0, backend='hdf5', metrics_path=None, metrics_info=False, verbose=False):
     dst = Path(dst)
     src = [Path(fn) for fn in src]
     validate_paths(src, dst)
+    if sort and layout != 'file':
+        raise click.UsageError('ID sorting (-s) and --layout are mutually exclusive')
+    if backend != 'hdf5' and layout != 'file':
+        raise click.UsageError('The spatial index of --layout is only written by --backend hdf5')
+    if sz3 and (layout != 'file' or backend != 'hdf5'):
+        raise click.UsageError('--sz3 needs --layout file and --backend hdf5')
+    if max_memory is not None:
+        if layout != 'file':
+            raise click.UsageError('--layout reorders whole datasets, so it cannot be used with --max-memory')
+        if sort or merge:
+            raise click.UsageError('-s and --merge need whole datasets, so they cannot be used with --max-memory')
+        if prefetch:
+            raise click.UsageError('--prefetch reads whole datasets, so it cannot be used with --max-memory')
+        max_memory = parse_size(max_memory)
+    if tuning is not None:
+        tuning = load_tuning(tuning)
     dst.mkdir(parents=True, exist_ok=True)
+    Output = backends.BACKENDS[backend]
+
+    if merge:
+        groups = merge_groups(src, merge)
+    else:
+        groups = [(fn.name, [fn]) for fn in src]
 
-    for fn in src:
+    for (outname, files), loading in zip(groups, read_ahead(groups, prefetch)):
         t = -default_timer()
-        out = (dst / fn.name).with_suffix('.inprogress')
+        m = Metrics()
+        out = (dst / outname).with_suffix('.inprogress')
 
-        # fail if 'inprogress' exists
-        with h5py.File(fn, 'r') as h5in, h5py.File(out, 'w-') as h5out:
+        with ExitStack() as stack, ThreadPoolExecutor(len(files)) as readers:
+            h5ins = [stack.enter_context(h5py.File(fn, 'r')) for fn in files]
+            h5in = h5ins[0]
+            output = stack.enter_context(Output(out))
 
-            validate_input(h5in)
-            compression_opts = get_compression_opts(h5in['/Header'].attrs,
-                truncpos, truncvel,
-                )
+            with m.stage('header'):
+                for h in h5ins:
+                    validate_input(h)
+                compression_opts = get_compression_opts(h5in['/Header'].attrs,
+                    truncpos, truncvel, tuning=tuning, sz3=softening if sz3 else None,
+                    )
+                Output.configure(compression_opts)
+                if layout != 'file':
+                    compression_opts['layout'] = layout
+                if sort:
+                    compression_opts['sort'] = True
+                if merge:
+                    compression_opts['merged'] = [fn.name for fn in files]
+
+                if merge:
+                    header = dict(h5in['/Header'].attrs)
+                    merge_header(header, [h['/Header'].attrs for h in h5ins], merge)
+                    output.set_header(header)
+                else:
+                    output.set_header(h5in['/Header'])
+                output.set_info(compression_opts)
 
             h5size = 0
-            
-            h5in.copy(h5in['/Header'], h5out['/'], 'Header')
-            h5out.create_group('/CompressionInfo')
-            h5out['/CompressionInfo'].attrs['json'] = json.dumps(compression_opts)
+
+            data = None
+            if loading is not None:
+                # the background read of this output overlapped the previous
+                # one; `read` is only the wait for what it didn't hide
+                with m.stage('read'):
+                    data, wall, cpu = loading.result()
+                m.add('prefetch', wall, cpu)
 
             for i in [1,2]:
-                if f'/PartType{i}' not in h5in:
+                if not any(f'/PartType{i}' in h for h in h5ins):
                     continue
-                # iord = np.argsort(h5in[f'/PartType{i}/ParticleIDs'][:])
-                for name in compression_opts:
-                    p = h5in[f'/PartType{i}/{name}'][:]
 
+                def source(name):
+                    # the sub-files of a merged output are read whole, concurrently
+                    if data is not None:
+                        return data[f'/PartType{i}/{name}']
+                    if len(h5ins) == 1:
+                        return h5in[f'/PartType{i}/{name}']
+                    with m.stage('read'):
+                        return read_merged(files, h5ins, f'/PartType{i}/{name}', readers)
+
+                iord = ids = None
+                if sort:
+                    with m.stage('read'):
+                        ids = source('ParticleIDs')[:]
+                    with m.stage('sort'):
+                        iord = id_order(ids)
+                if layout == 'morton':
+                    box = h5in['/Header'].attrs['BoxSize']
+                    with m.stage('read'):
+                        pos = source('Coordinates')[:]
+                    with m.stage('sort'):
+                        iord, keys = spatial.morton_order(pos, box)
+                    del pos
+
+                for name in DATASETS:
+                    dset = ids if name == 'ParticleIDs' and ids is not None else source(name)
                     tbits = compression_opts[name]['truncbits']
-                    mask = ~np.uint32((1 << tbits) - 1)
-                    p = (p.view(dtype=np.uint32) & mask).view(dtype=p.dtype)
-                    h5out.create_dataset(f'/PartType{i}/{name}', data=p,
-                        **compression_opts[name]['hdf5'],
+                    m.bytes_read += sum(h[f'/PartType{i}/{name}'].id.get_storage_size()
+                                        for h in h5ins if f'/PartType{i}' in h)
+
+                    if iord is not None:
+                        with m.stage('read'):
+                            dset = dset[:]
+                        with m.stage('sort'):
+                            dset = dset[iord]
+                            if name == 'Coordinates' and layout == 'morton':
+                                chunkrows = compression_opts[name]['hdf5']['chunks'][0]
+                                index = spatial.build_index(dset, keys, chunkrows, tbits)
+                                spatial.write_index(output.h5, i, index, chunkrows, box)
+                                del keys
+
+                    output.write(f'/PartType{i}/{name}', dset, compression_opts[name],
+                        nthreads, max_memory, metrics=m,
                         )
-                    h5size += p.nbytes
+                    h5size += dset.nbytes
+                del ids, iord
+            del data, loading
+
+            # now with the SZ3 errors
+            output.set_info(compression_opts)
+
+            with m.stage('write'):
+                output.flush()
 
         #insize = fn.stat().st_size
-        outsize = out.stat().st_size
+        outsize = Output.size(out)
         t += default_timer()
         if verbose:
             print(f'Input size:  {h5size/1e6:.4g} MB')
@@ -81,8 +220,153 @@ def compress(src, dst, truncpos='auto', truncvel='auto', verbose=False):
         if outsize > h5size:
             raise RuntimeError(f'Compressed size {outsize} greater than uncompressed size {h5size}')
 
-        out.chmod(0o444)
-        out.rename(out.with_suffix('.hdf5'))
+        if metrics_path is not None or metrics_info:
+            m.bytes_written = outsize
+            record = m.record(script='compress_hdf5', src=[str(fn) for fn in files],
+                dst=str(out.with_suffix(Output.suffix)), input_bytes=h5size,
+                nthreads=nthreads, max_memory=max_memory, layout=layout, sort=sort,
+                prefetch=prefetch, backend=backend, sz3=sz3,
+                )
+            emit(record, metrics_path)
+            if metrics_info:
+                Output.annotate(out, 'metrics', json.dumps(record))
+
+        Output.finish(out)
+
+
+def parse_size(size):
+    '''Parse a size like "512M" or "4G" into bytes.
+    '''
+    units = dict(K=1<<10, M=1<<20, G=1<<30, T=1<<40)
+    size = str(size).strip().upper().removesuffix('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def merge_groups(src, nout):
+    '''Split all the sub-files of one snapshot (prefix.N.hdf5) into `nout`
+    runs of consecutive sub-files. Returns (output name, sub-files) pairs.
+    '''
+    matches = [re.fullmatch(r'(.*)\.(\d+)\.hdf5', fn.name) for fn in src]
+    if not all(matches) or len({m.group(1) for m in matches}) != 1:
+        raise ValueError('--merge needs the sub-files of one snapshot, named prefix.N.hdf5')
+    prefix = matches[0].group(1)
+    src = [fn for _, fn in sorted(zip([int(m.group(2)) for m in matches], src))]
+
+    with h5py.File(src[0], 'r') as h5:
+        nfiles = int(h5['/Header'].attrs['NumFilesPerSnapshot'])
+    if sorted(int(m.group(2)) for m in matches) != list(range(nfiles)):
+        raise ValueError(f'--merge needs all {nfiles} sub-files of {prefix}')
+    if nfiles % nout:
+        raise ValueError(f'Cannot split {nfiles} sub-files into {nout} outputs')
+
+    per = nfiles // nout
+    if nout == 1:
+        return [(f'{prefix}.hdf5', src)]
+    return [(f'{prefix}.{k}.hdf5', src[k * per : (k + 1) * per]) for k in range(nout)]
+
+
+def merge_header(attrs, headers, nout):
+    '''Set the particle and file counts of a header copied from the first
+    of `headers`, for one of `nout` outputs holding all their particles.
+    '''
+    npart = np.sum([h['NumPart_ThisFile'] for h in headers], axis=0)
+    attrs['NumPart_ThisFile'] = npart.astype(attrs['NumPart_ThisFile'].dtype)
+    attrs['NumFilesPerSnapshot'] = attrs['NumFilesPerSnapshot'].dtype.type(nout)
+
+
+def read_merged(files, h5ins, name, pool):
+    '''Dataset `name` of the open sub-files `h5ins`, concatenated. The
+    sub-files are read concurrently, each into its place in the result.
+    '''
+    dsets = [h[name] if name in h else None for h in h5ins]
+    first = next(d for d in dsets if d is not None)
+    counts = [len(d) if d is not None else 0 for d in dsets]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    out = np.empty((offsets[-1],) + first.shape[1:], dtype=first.dtype.newbyteorder('='))
+
+    futures = [pool.submit(read_whole, fn, d, out[offsets[k] : offsets[k + 1]])
+               for k, (fn, d) in enumerate(zip(files, dsets)) if d is not None]
+    for fut in futures:
+        fut.result()
+    return out
+
+
+def read_output(files):
+    '''All the particle datasets of the sub-files `files` of one output, read
+    whole (and concatenated, if several), for `--prefetch`. Returns them as
+    {name: array}, with the wall and CPU time this took.
+    '''
+    wall, cpu = default_timer(), time.thread_time()
+    with ExitStack() as stack, ThreadPoolExecutor(len(files)) as readers:
+        h5ins = [stack.enter_context(h5py.File(fn, 'r')) for fn in files]
+        data = {}
+        for i in [1,2]:
+            for name in DATASETS:
+                key = f'/PartType{i}/{name}'
+                if any(key in h for h in h5ins):
+                    data[key] = read_merged(files, h5ins, key, readers)
+    return data, default_timer() - wall, time.thread_time() - cpu
+
+
+def read_ahead(groups, depth):
+    '''For each of `groups`, a future of `read_output` of its files, read in
+    one background thread up to `depth` outputs ahead of the one being
+    compressed, which bounds the memory to `depth` + 1 outputs. All None if
+    `depth` is 0.
+    '''
+    if not depth:
+        yield from (None for _ in groups)
+        return
+    with ThreadPoolExecutor(1) as pool:
+        todo = iter(groups)
+        futures = deque(pool.submit(read_output, files) for _, files in islice(todo, depth + 1))
+        try:
+            while futures:
+                fut = futures.popleft()
+                yield fut
+                # the previous output is done with, so read one more
+                del fut
+                for _, files in islice(todo, 1):
+                    futures.append(pool.submit(read_output, files))
+        finally:
+            for fut in futures:
+                fut.cancel()
+
+
+def read_whole(fn, dset, out):
+    '''Read all of `dset` into `out`. A contiguous, unfiltered dataset is
+    read from the file directly, which releases the GIL (h5py does not).
+    '''
+    offset = dset.id.get_offset()
+    if dset.chunks is not None or offset is None or dset.dtype != out.dtype:
+        dset.read_direct(out)
+        return
+    buf = memoryview(out).cast('B')
+    with open(fn, 'rb', buffering=0) as fp:
+        fp.seek(offset)
+        n = 0
+        while n < len(buf):
+            k = fp.readinto(buf[n:])
+            if not k:
+                raise EOFError(f'{fn}: {dset.name} ends early')
+            n += k
+
+
+def id_order(ids):
+    '''The permutation that sorts `ids`. O(N) if they are a dense range.
+    '''
+    n = len(ids)
+    if n == 0:
+        return np.arange(0)
+    idmin, idmax = int(ids.min()), int(ids.max())
+    if idmax - idmin + 1 == n:
+        iord = np.full(n, -1, dtype=np.int64)
+        iord[ids - idmin] = np.arange(n)
+        if (iord >= 0).all():
+            return iord
+    return np.argsort(ids, kind='stable')
 
 
 def nearest_boxsize(box):
@@ -93,7 +377,7 @@ def nearest_boxsize(box):
     return 2**np.round(np.log2(box/1e6))*1e6
 
 
-def get_compression_opts(attrs, truncpos, truncvel, clevel=5):
+def get_compression_opts(attrs, truncpos, truncvel, clevel=5, tuning=None, sz3=None):
 
     box = attrs['BoxSize']
     rounded_box = nearest_boxsize(box)
@@ -113,7 +397,7 @@ def get_compression_opts(attrs, truncpos, truncvel, clevel=5):
                                    shuffle=hdf5plugin.Blosc.BITSHUFFLE,
                                    ),
             ),
-            truncbits=truncpos,
+            truncbits=int(truncpos),
         ),
         Velocities=dict(
             hdf5=dict(
@@ -123,7 +407,7 @@ def get_compression_opts(attrs, truncpos, truncvel, clevel=5):
                                    shuffle=hdf5plugin.Blosc.BITSHUFFLE,
                                    ),
             ),
-            truncbits=truncvel,
+            truncbits=int(truncvel),
         ),
         ParticleIDs=dict(
             hdf5=dict(
@@ -137,9 +421,69 @@ def get_compression_opts(attrs, truncpos, truncvel, clevel=5):
         ),
     )
 
+    if tuning is not None:
+        apply_tuning(compression_opts, tuning)
+
+    if sz3 is not None:
+        lossy.apply_sz3(compression_opts, box, n1d, sz3)
+
     return compression_opts
 
 
+SHUFFLES = dict(
+    blosc=dict(noshuffle=hdf5plugin.Blosc.NOSHUFFLE,
+               shuffle=hdf5plugin.Blosc.SHUFFLE,
+               bitshuffle=hdf5plugin.Blosc.BITSHUFFLE,
+               ),
+    blosc2=dict(noshuffle=hdf5plugin.Blosc2.NOFILTER,
+                shuffle=hdf5plugin.Blosc2.SHUFFLE,
+                bitshuffle=hdf5plugin.Blosc2.BITSHUFFLE,
+                delta=hdf5plugin.Blosc2.DELTA,
+                ),
+)
+
+
+def filter_opts(spec, rowshape):
+    '''HDF5 dataset options for a codec spec from tune_compression.py, like
+    {"filter": "blosc", "cname": "zstd", "clevel": 5, "shuffle": "bitshuffle",
+    "chunkrows": 65536, "blocksize": 0}.
+    '''
+    if spec['filter'] == 'blosc':
+        f = hdf5plugin.Blosc(cname=spec['cname'],
+                             clevel=spec['clevel'],
+                             shuffle=SHUFFLES['blosc'][spec['shuffle']],
+                             )
+    elif spec['filter'] == 'blosc2':
+        f = hdf5plugin.Blosc2(cname=spec['cname'],
+                              clevel=spec['clevel'],
+                              filters=SHUFFLES['blosc2'][spec['shuffle']],
+                              )
+    else:
+        raise ValueError(spec['filter'])
+    return dict(chunks=(spec['chunkrows'],) + tuple(rowshape), **f)
+
+
+def load_tuning(fn):
+    with open(fn) as fp:
+        return json.load(fp)['recommended']
+
+
+def apply_tuning(compression_opts, tuning):
+    '''Replace the codec and chunking of each dataset named in `tuning` with
+    the recommended spec. Truncation and anything else are kept.
+    '''
+    for name, spec in tuning.items():
+        if name not in compression_opts:
+            continue
+        opts = compression_opts[name]
+        hdf5_opts = filter_opts(spec, opts['hdf5']['chunks'][1:])
+        if 'dtype' in opts['hdf5']:
+            hdf5_opts['dtype'] = opts['hdf5']['dtype']
+        opts['hdf5'] = hdf5_opts
+        if spec.get('blocksize'):
+            opts['blocksize'] = spec['blocksize']
+
+
 def validate_paths(sources: list[Path], dst):
     for fn in sources:
         if not fn.is_file():
@@ -0,0 +1,187 @@
+'''
+Multi-threaded compression engine that bypasses the HDF5 filter pipeline.
+
+The HDF5 Blosc filter compresses one chunk at a time on one core. Here, we
+compress chunks in a thread pool and write them with HDF5 direct chunk writes.
+The compression calls go through ctypes (which releases the GIL) into the very
+c-blosc library that hdf5plugin registers as the filter, with the same
+parameters as the filter. So the file is byte-identical to one written through
+h5py, and can be read by any h5py+hdf5plugin reader.
+
+`blosc_decompress()` is the reverse, used by reader.py to decompress chunks
+read with HDF5 direct chunk reads.
+
+Bit truncation is fused into the per-chunk kernel: each worker masks its chunk
+while copying it into a padded chunk buffer, so no full-array temporary is made.
+`truncate()` is the plain in-place version, used by the other write paths.
+'''
+
+import ctypes
+from concurrent.futures import ThreadPoolExecutor
+
+import hdf5plugin
+import numpy as np
+
+from metrics import Metrics
+
+BLOSC_FILTER_ID = 32001
+BLOSC_CNAMES = ['blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd']
+
+libblosc = ctypes.CDLL(hdf5plugin.get_config().registered_filters['blosc'])
+libblosc.blosc_compress_ctx.argtypes = [
+    ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_size_t,
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+    ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int,
+    ]
+libblosc.blosc_decompress_ctx.argtypes = [
+    ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+    ]
+
+
+def truncate(p, tbits):
+    '''Null out the low `tbits` bits of each 32-bit element of `p`, in place.
+    '''
+    if tbits:
+        mask = ~np.uint32((1 << tbits) - 1)
+        u = p.view(dtype=np.uint32)
+        np.bitwise_and(u, mask, out=u)
+    return p
+
+
+def blosc_params(opts):
+    '''The c-blosc arguments equivalent to the `hdf5plugin.Blosc` filter in
+    `opts['hdf5']`. An optional `opts['blocksize']` sets the Blosc block size,
+    which the filter always chooses automatically; chunks written with it are
+    still readable through the filter.
+    '''
+    hdf5_opts = opts['hdf5']
+    if hdf5_opts.get('compression') != BLOSC_FILTER_ID:
+        raise ValueError(f'Direct chunk writes need the Blosc filter, not {hdf5_opts.get("compression")}')
+    clevel, shuffle, compcode = hdf5_opts['compression_opts'][4:7]
+    return dict(clevel=int(clevel), shuffle=int(shuffle),
+                cname=BLOSC_CNAMES[int(compcode)],
+                blocksize=int(opts.get('blocksize', 0)),
+                )
+
+
+def blosc_compress(buf, clevel, shuffle, cname, blocksize=0):
+    '''Compress `buf` exactly as the HDF5 Blosc filter does. Returns None if
+    the result would not be smaller than the input.
+    '''
+    dest = np.empty(buf.nbytes, dtype=np.uint8)
+    n = libblosc.blosc_compress_ctx(clevel, shuffle, buf.itemsize, buf.nbytes,
+        buf.ctypes.data, dest.ctypes.data, buf.nbytes,
+        cname.encode(), blocksize, 1,
+        )
+    if n < 0:
+        raise RuntimeError(f'blosc compression failed with code {n}')
+    if n == 0:
+        return None
+    return dest[:n]
+
+
+def blosc_decompress(src, dest):
+    '''Decompress the Blosc buffer `src` (bytes) into the contiguous array
+    `dest`, which must be exactly the uncompressed size. Releases the GIL.
+    '''
+    n = libblosc.blosc_decompress_ctx(src, dest.ctypes.data, dest.nbytes, 1)
+    if n != dest.nbytes:
+        raise RuntimeError(f'blosc decompression failed with code {n}')
+    return dest
+
+
+def compress_chunk(slab, tbits, chunkshape, dtype, params):
+    '''Truncate and compress one chunk of rows from `slab`.
+
+    Returns the bytes to store and the HDF5 filter mask. Like the filter, a
+    chunk that blosc cannot shrink is stored raw with the filter skipped.
+    Edge chunks are zero-padded to the full chunk shape, as HDF5 does.
+    '''
+    buf = np.zeros(chunkshape, dtype=dtype)
+    n = len(slab)
+    if tbits:
+        mask = ~np.uint32((1 << tbits) - 1)
+        np.bitwise_and(slab.view(dtype=np.uint32), mask,
+            out=buf[:n].view(dtype=np.uint32),
+            )
+    else:
+        buf[:n] = slab
+
+    comp = blosc_compress(buf, **params)
+    if comp is None:
+        return buf, 1
+    return comp, 0
+
+
+def write_dataset(h5out, name, source, opts, nthreads, max_memory=None, metrics=None):
+    '''Compress `source` into a new dataset `h5out[name]` using `nthreads`
+    compression threads.
+
+    `source` can be a numpy array or an h5py Dataset. A Dataset is read one
+    slab at a time into two alternating buffers of at most `max_memory` bytes
+    in total, so the next slab is read while the current one is compressed.
+    Truncation is applied according to `opts['truncbits']`. Stage timings go
+    to `metrics` (see metrics.py), if given.
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    hdf5_opts = opts['hdf5']
+    params = blosc_params(opts)
+    chunkshape = hdf5_opts['chunks']
+    chunkrows = chunkshape[0]
+    tbits = opts['truncbits']
+
+    dtype = np.dtype(hdf5_opts.get('dtype', source.dtype))
+    out = h5out.create_dataset(name, shape=source.shape,
+        **{**hdf5_opts, 'dtype': dtype},
+        )
+    nrows = len(source)
+
+    rowbytes = dtype.itemsize * int(np.prod(source.shape[1:]))
+    if max_memory is None:
+        slabchunks = 4 * nthreads
+    else:
+        slabchunks = max(1, max_memory // 2 // (chunkrows * rowbytes))
+    slabrows = slabchunks * chunkrows
+
+    if isinstance(source, np.ndarray):
+        def read_slab(start, n, j):
+            return source[start:start + n]
+    else:
+        nbuf = min(slabrows, max(nrows, 1))
+        bufs = [np.empty((nbuf,) + source.shape[1:], dtype=source.dtype)
+                for _ in range(2)]
+
+        def read_slab(start, n, j):
+            slab = bufs[j % 2][:n]
+            with metrics.stage('read'):
+                source.read_direct(slab, np.s_[start:start + n], np.s_[0:n])
+            return slab
+
+    compress = metrics.worker('compress', compress_chunk)
+
+    def submit(pool, start, slab):
+        return [(start + k, pool.submit(compress, slab[k:k + chunkrows],
+                    tbits, chunkshape, dtype, params))
+                for k in range(0, len(slab), chunkrows)]
+
+    def drain(futures):
+        for row, fut in futures:
+            with metrics.stage('compress'):
+                comp, filter_mask = fut.result()
+            offset = (row,) + (0,) * (len(chunkshape) - 1)
+            with metrics.stage('write'):
+                out.id.write_direct_chunk(offset, comp, filter_mask=filter_mask)
+
+    starts = range(0, nrows, slabrows)
+    with ThreadPoolExecutor(nthreads) as pool:
+        pending = []
+        for j, start in enumerate(starts):
+            # read the next slab while the previous one is being compressed
+            slab = read_slab(start, min(slabrows, nrows - start), j)
+            drain(pending)
+            with metrics.stage('compress'):
+                pending = submit(pool, start, slab)
+        drain(pending)
+
+    return out
@@ -0,0 +1,185 @@
+'''
+Memory-mapped reader for Gadget format-1 and format-2 files, and `create()`
+to lay out new ones (used by restore.py).
+
+Each file is mapped once, and its Fortran record markers are scanned once to
+build an index of block offsets. Reads are then plain slices of the map,
+copied (and byte-swapped, if needed) straight into the caller's buffer.
+
+This replaces `readsnap.snapshot_header` and `readsnap.read_block`, which
+reopen and rescan the file for every block and particle type.
+'''
+
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# block order for format-1 files, which have no block labels
+FORMAT1_BLOCKS = ['HEAD', 'POS ', 'VEL ', 'ID  ']
+
+# per-particle element type and shape, keyed by element size
+BLOCK_TYPES = {
+    'POS ': ({4: 'f4', 8: 'f8'}, (3,)),
+    'VEL ': ({4: 'f4', 8: 'f8'}, (3,)),
+    'ID  ': ({4: 'u4', 8: 'u8'}, ()),
+}
+
+HEADER_DTYPE = np.dtype([
+    ('npart', 'i4', 6),
+    ('massarr', 'f8', 6),
+    ('time', 'f8'),
+    ('redshift', 'f8'),
+    ('sfr', 'i4'),
+    ('feedback', 'i4'),
+    ('nall', 'u4', 6),
+    ('cooling', 'i4'),
+    ('filenum', 'i4'),
+    ('boxsize', 'f8'),
+    ('omega_m', 'f8'),
+    ('omega_l', 'f8'),
+    ('hubble', 'f8'),
+])
+
+
+class GadgetFile:
+    '''One Gadget file. `header` has the same keys as
+    `vars(readsnap.snapshot_header(fn))`, and `blocks` maps block names to
+    (offset, nbytes) of the record payloads.
+    '''
+
+    def __init__(self, fn):
+        self.filename = Path(fn)
+        self.mm = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        self.endian, self.format = detect_format(self.mm)
+        self.blocks = scan_blocks(self.mm, self.endian, self.format)
+
+        offset, nbytes = self.blocks['HEAD']
+        h = np.frombuffer(self.mm, dtype=HEADER_DTYPE.newbyteorder(self.endian),
+            count=1, offset=offset,
+            )[0]
+        self.header = dict(filename=self.filename,
+                           format=self.format,
+                           swap=int(self.endian != '<'),
+                           )
+        for k in HEADER_DTYPE.names:
+            v = h[k]
+            self.header[k] = v.astype(v.dtype.newbyteorder('='))
+
+    def block_layout(self, block, parttype):
+        '''(file offset, number of rows, dtype in the file's byte order, row
+        shape) of `block` for `parttype`.
+        '''
+        npart = self.header['npart']
+        offset, nbytes = self.blocks[block]
+        if nbytes % npart.sum():
+            raise ValueError(f'{self.filename}: block {block!r} size {nbytes} does not divide {npart.sum()} particles')
+        rowbytes = nbytes // npart.sum()
+
+        itemtypes, rowshape = BLOCK_TYPES[block]
+        itemsize = rowbytes // int(np.prod(rowshape))
+        dtype = np.dtype(itemtypes[itemsize]).newbyteorder(self.endian)
+
+        start = offset + int(npart[:parttype].sum()) * rowbytes
+        return start, int(npart[parttype]), dtype, rowshape
+
+    def view_block(self, block, parttype):
+        '''A read-only view of `block` for `parttype` in the file's byte
+        order, without copying.
+        '''
+        start, n, dtype, rowshape = self.block_layout(block, parttype)
+        nbytes = n * dtype.itemsize * int(np.prod(rowshape))
+        return self.mm[start : start + nbytes].view(dtype=dtype).reshape((n,) + rowshape)
+
+    def read_rows(self, block, parttype, start, stop):
+        '''Rows start..stop of `block` for `parttype`, in the file's byte
+        order. Read from the file rather than the map, so that the pages
+        don't count towards this process's memory.
+        '''
+        offset, n, dtype, rowshape = self.block_layout(block, parttype)
+        stop = min(stop, n)
+        rowitems = int(np.prod(rowshape))
+        out = np.fromfile(self.filename, dtype=dtype, count=max(stop - start, 0) * rowitems,
+                          offset=offset + start * dtype.itemsize * rowitems)
+        return out.reshape((-1,) + rowshape)
+
+    def read_block(self, block, parttype, out=None):
+        '''Read `block` for `parttype` into `out` (allocated if None), in the
+        same layout and dtype as `readsnap.read_block`.
+        '''
+        src = self.view_block(block, parttype)
+        if out is None:
+            out = np.empty(src.shape, dtype=src.dtype.newbyteorder('='))
+        out[...] = src
+        return out
+
+    def close(self):
+        # the map is released once no views of it remain
+        self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def create(fn, header, blocks, format=1, endian='<'):
+    '''Create the Gadget file `fn`, with `header` (a dict of the HEADER_DTYPE
+    fields) and the record markers of `blocks`, a list of (name, nbytes). The
+    block payloads are left for the caller to fill in. Returns {name: offset}
+    of the payloads.
+    '''
+    h = np.zeros((), dtype=HEADER_DTYPE.newbyteorder(endian))
+    for k in HEADER_DTYPE.names:
+        h[k] = header[k]
+
+    offsets = {}
+    with open(fn, 'xb') as fp:
+        for name, nbytes in [('HEAD', 256)] + list(blocks):
+            if format == 2:
+                fp.write(struct.pack(endian + 'i4sii', 8, name.encode(), nbytes + 8, 8))
+            fp.write(struct.pack(endian + 'I', nbytes))
+            offsets[name] = fp.tell()
+            if name == 'HEAD':
+                fp.write(h.tobytes().ljust(256, b'\0'))
+            else:
+                fp.seek(nbytes, 1)
+            fp.write(struct.pack(endian + 'I', nbytes))
+    return offsets
+
+
+def detect_format(mm):
+    '''The byte order and format (1 or 2) of a file, from its first marker.
+    '''
+    for endian in '<>':
+        first, = struct.unpack_from(endian + 'i', mm, 0)
+        if first == 256:
+            return endian, 1
+        if first == 8:
+            return endian, 2
+    raise ValueError('Not a Gadget file: bad first record marker')
+
+
+def scan_blocks(mm, endian, format):
+    '''Walk the record markers once and return {name: (offset, nbytes)}.
+    '''
+    blocks = {}
+    pos = 0
+    i = 0
+    while pos < len(mm):
+        if format == 2:
+            name = bytes(mm[pos + 4 : pos + 8]).decode()
+            pos += 16
+        else:
+            name = FORMAT1_BLOCKS[i] if i < len(FORMAT1_BLOCKS) else f'BLK{i}'
+
+        nbytes, = struct.unpack_from(endian + 'I', mm, pos)
+        end, = struct.unpack_from(endian + 'I', mm, pos + 4 + nbytes)
+        if end != nbytes:
+            raise ValueError(f'Mismatched record markers for block {name!r} at offset {pos}')
+        blocks[name] = (pos + 4, nbytes)
+        pos += nbytes + 8
+        i += 1
+
+    return blocks
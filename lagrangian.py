@@ -0,0 +1,140 @@
+'''
+Lagrangian displacement encoding of ID-sorted Coordinates.
+
+In an ID-sorted snapshot, row i holds the particle that started at lattice site
+i. Its position is close to that site, so we store the periodic-wrapped
+displacement from the site instead of the position. Displacements are much
+smaller than positions, so their high bits are nearly constant and they
+compress much better with bitshuffle+zstd.
+
+Truncation is applied to the displacement at the same absolute precision as
+the position truncation it replaces. Positions up to the box size, truncated by
+`truncbits`, are accurate to `bound = 2**(floor(log2(box)) - 23 + truncbits)`.
+Truncating the bits of a float keeps a relative precision, which would spend
+bits on small displacements. Instead, we round displacements to multiples of
+`bound`, which is a power of two, so the low mantissa bits are zero at any
+magnitude. Decoded positions are within `bound` of the originals, including
+the final rounding to float32.
+
+Files written this way have `"encoding": "lagrangian"` and a per-particle-type
+`"lagrangian"` dict in the Coordinates entry of `/CompressionInfo['json']`.
+Use `read_coordinates()` to read Coordinates from any compressed file.
+'''
+
+import itertools
+import json
+
+import numpy as np
+
+SLAB = 1 << 20  # rows per slab, to bound temporaries
+
+
+def lattice(i, n1d, box, axes, offset):
+    '''Lattice sites (float64) of the lattice indices `i`.
+
+    Index i has digits (i // n1d**2, i // n1d % n1d, i % n1d); digit k is
+    the grid coordinate along axis `axes[k]`. `offset` is the site position
+    within its cell, in units of the cell size.
+    '''
+    i = np.asarray(i, dtype=np.int64)
+    digits = (i // n1d**2, i // n1d % n1d, i % n1d)
+    q = np.empty((len(i), 3))
+    for k in range(3):
+        q[:, axes[k]] = (digits[k] + offset) * (box / n1d)
+    return q
+
+
+def wrap(d, box):
+    '''Wrap displacements into [-box/2, box/2).
+    '''
+    d -= box * np.floor(d / box + 0.5)
+    return d
+
+
+def detect_lattice(pos, n1d, box, nsample=1 << 16):
+    '''Find the digit-to-axis assignment and cell offset that put the lattice
+    closest to the particles, from an evenly spaced sample of rows.
+    '''
+    rows = np.linspace(0, len(pos) - 1, min(nsample, len(pos))).astype(np.int64)
+    best = None
+    for axes in itertools.permutations(range(3)):
+        for offset in (0., 0.5):
+            q = lattice(rows, n1d, box, axes, offset)
+            err = np.abs(wrap(pos[rows] - q, box)).mean()
+            if best is None or err < best[0]:
+                best = (err, list(axes), offset)
+    return best[1], best[2]
+
+
+def position_error_bound(box, truncbits):
+    '''Max absolute error of truncating `truncbits` of float32 positions in [0, box).
+    '''
+    return 2.**(np.floor(np.log2(box)) - 23 + truncbits)
+
+
+def encode(pos, n1d, box, truncbits):
+    '''Replace ID-sorted positions `pos` (float32, one row per lattice site) by
+    their displacements from the lattice, in place.
+
+    Returns the parameters needed to decode. The displacements are already
+    quantized, so no further truncation should be applied.
+    '''
+    if truncbits == 0:
+        raise ValueError('Lagrangian encoding is lossy; it needs position truncation > 0')
+    if len(pos) != n1d**3:
+        raise ValueError(f'Lagrangian encoding needs the full lattice ({n1d}^3 particles), got {len(pos)}')
+
+    # rounding costs at most step/2, and the float32 rounding of the decoded
+    # position at most 2**(floor(log2(box)) - 24) <= step/4
+    step = position_error_bound(box, truncbits)
+
+    axes, offset = detect_lattice(pos, n1d, box)
+    maxdisp = 0.
+    for start in range(0, len(pos), SLAB):
+        p = pos[start : start + SLAB]
+        q = lattice(np.arange(start, start + len(p)), n1d, box, axes, offset)
+        d = wrap(p - q, box)
+        p[:] = np.round(d / step) * step
+        maxdisp = max(maxdisp, float(np.abs(p).max()))
+
+    return dict(n1d=n1d, box=float(box), axes=axes, offset=offset,
+                maxdisp=maxdisp, step=step, truncbits=0,
+                error_bound=step,
+                )
+
+
+def decode(disp, start, params, out=None):
+    '''Positions (float32) from displacements `disp` of lattice indices
+    start..start+len(disp)-1. `out` may be `disp` itself.
+    '''
+    if out is None:
+        out = np.empty(disp.shape, dtype=np.float32)
+    box = params['box']
+    for s in range(0, len(disp), SLAB):
+        d = disp[s : s + SLAB]
+        q = lattice(np.arange(start + s, start + s + len(d)), params['n1d'], box,
+                    params['axes'], params['offset'],
+                    )
+        q += d
+        q %= box
+        o = out[s : s + SLAB]
+        o[:] = q
+        # float32 rounding can land exactly on box
+        o[o >= box] -= box
+    return out
+
+
+def read_coordinates(h5, parttype, rows=slice(None)):
+    '''Read `/PartTypeN/Coordinates[rows]` from a compressed file, decoding
+    Lagrangian displacements if needed.
+    '''
+    dset = h5[f'/PartType{parttype}/Coordinates']
+    start, stop, step = rows.indices(len(dset))
+    if step != 1:
+        raise ValueError('Only contiguous row ranges are supported')
+
+    out = dset[start:stop]
+    info = json.loads(h5['/CompressionInfo'].attrs['json'])['Coordinates']
+    if info.get('encoding') == 'lagrangian':
+        decode(out, start, info['lagrangian'][f'PartType{parttype}'], out=out)
+    return out
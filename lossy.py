@@ -0,0 +1,167 @@
+'''
+Error-bounded lossy compression of Coordinates and Velocities with SZ3
+(`--sz3`).
+
+Bit truncation bounds the relative error of each value. SZ3 instead
+predicts each value from its neighbours and quantizes the residual to an
+absolute error bound, which usually compresses better at the same physical
+accuracy. The bounds come from the simulation, like `TRUNC_LEVELS`: the
+softening length is `softening * BoxSize / n1d` (`SOFTENING_FRACTION` of the
+mean interparticle spacing, by default), and
+    - Coordinates are kept to `ERROR_FRACTIONS['Coordinates']` of it
+    - Velocities are kept to `ERROR_FRACTIONS['Velocities']` of the Hubble
+      velocity across it
+in the Gadget units of the snapshots (kpc/h and km/s). Decoded positions can
+be up to the bound outside [0, BoxSize).
+
+The HDF5 SZ3 filter compresses one chunk at a time on one core, and SZ3 is
+slow, so chunks are compressed in a pool of `nthreads` processes instead
+(h5py serializes HDF5 calls, so threads would not help). The HDF5 backend
+starts the pool for its first SZ3 dataset and shuts it down when the output
+is closed. Each worker runs the filter itself, on a one-chunk dataset in an
+in-memory HDF5 file with the same chunk shape, and returns the raw chunk,
+which is written to the output with an HDF5 direct chunk write. So the file
+reads through the filter as usual.
+The worker also decodes the chunk and measures its max error, so the bound
+that was achieved is checked while compressing, and recorded per particle
+type in `max_error` of the dataset's `"sz3"` entry in `/CompressionInfo`.
+'''
+
+from concurrent.futures import Future, ProcessPoolExecutor
+import io
+import multiprocessing
+
+import h5py
+import hdf5plugin
+import numpy as np
+
+from metrics import Metrics
+
+# softening length, as a fraction of the mean interparticle spacing
+SOFTENING_FRACTION = 1/40
+
+# absolute error bounds, as fractions of the softening length (Coordinates)
+# and of the Hubble velocity across it (Velocities)
+ERROR_FRACTIONS = dict(Coordinates=1/10, Velocities=1/100)
+
+# H0, in km/s per kpc/h
+HUBBLE = 0.1
+
+# rows per chunk: SZ3 compresses better on larger chunks
+CHUNKROWS = 1 << 18
+
+
+def error_bounds(box, n1d, softening=SOFTENING_FRACTION):
+    '''The absolute error bounds of each dataset.
+    '''
+    eps = softening * box / n1d
+    return dict(Coordinates=ERROR_FRACTIONS['Coordinates'] * eps,
+                Velocities=ERROR_FRACTIONS['Velocities'] * HUBBLE * eps,
+                )
+
+
+def apply_sz3(compression_opts, box, n1d, softening=SOFTENING_FRACTION):
+    '''Switch Coordinates and Velocities in `compression_opts` to SZ3, with
+    the bounds of `error_bounds()` and no truncation.
+    '''
+    for name, bound in error_bounds(box, n1d, softening).items():
+        opts = compression_opts[name]
+        hdf5_opts = dict(chunks=(CHUNKROWS,) + tuple(opts['hdf5']['chunks'][1:]),
+                         **hdf5plugin.SZ3(absolute=bound),
+                         )
+        if 'dtype' in opts['hdf5']:
+            hdf5_opts['dtype'] = opts['hdf5']['dtype']
+        opts['hdf5'] = hdf5_opts
+        opts['truncbits'] = 0
+        opts.pop('blocksize', None)
+        opts['sz3'] = dict(absolute=float(bound), softening=softening, max_error={})
+
+
+def compress_chunk(slab, chunkshape, hdf5_opts):
+    '''Compress one chunk of rows from `slab` through the HDF5 filter in
+    `hdf5_opts`. Edge chunks are padded with their last row.
+
+    Returns the bytes to store, the HDF5 filter mask, and the max absolute
+    error of the decoded rows.
+    '''
+    buf = np.empty(chunkshape, dtype=slab.dtype)
+    n = len(slab)
+    buf[:n] = slab
+    buf[n:] = slab[n - 1]
+
+    opts = {k: v for k, v in hdf5_opts.items() if k != 'dtype'}
+    with h5py.File(io.BytesIO(), 'w') as h5:
+        dset = h5.create_dataset('chunk', data=buf, **opts)
+        filter_mask, comp = dset.id.read_direct_chunk((0,) * len(chunkshape))
+        decoded = dset[:n]
+    err = np.abs(decoded.astype(np.float64) - slab).max(initial=0.)
+    return comp, filter_mask, float(err)
+
+
+def make_pool(nprocs):
+    '''A pool of `nprocs` worker processes for `write_dataset()`. Starting the
+    workers (which import h5py and the filter) is slow, so the caller keeps
+    one for all the datasets of an output, and shuts it down when done.
+    '''
+    return ProcessPoolExecutor(nprocs, mp_context=multiprocessing.get_context('spawn'))
+
+
+def submit(pool, fn, *args):
+    '''Run `fn` in `pool`, or right away without one.
+    '''
+    if pool is not None:
+        return pool.submit(fn, *args)
+    fut = Future()
+    fut.set_result(fn(*args))
+    return fut
+
+
+def write_dataset(h5out, name, source, opts, nthreads=1, max_memory=None, metrics=None,
+                  pool=None):
+    '''Compress `source` (a numpy array or h5py Dataset) into a new SZ3
+    dataset `h5out[name]`, in the `make_pool(nthreads)` pool `pool`, or in
+    this process without one. A Dataset is read one slab of whole chunks at a
+    time, of at most `max_memory` bytes.
+
+    Records the max error in `opts['sz3']['max_error']`, under the particle
+    type of `name`, and raises if it exceeds the bound.
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    hdf5_opts = opts['hdf5']
+    chunkshape = hdf5_opts['chunks']
+    chunkrows = chunkshape[0]
+    dtype = np.dtype(hdf5_opts.get('dtype', source.dtype))
+    out = h5out.create_dataset(name, shape=source.shape,
+        **{**hdf5_opts, 'dtype': dtype},
+        )
+    nrows = len(source)
+
+    rowbytes = dtype.itemsize * int(np.prod(source.shape[1:]))
+    slabchunks = 2 * nthreads
+    if max_memory is not None:
+        slabchunks = max(1, min(slabchunks, max_memory // (chunkrows * rowbytes)))
+    slabrows = slabchunks * chunkrows
+
+    maxerr = 0.
+    for start in range(0, nrows, slabrows):
+        n = min(slabrows, nrows - start)
+        with metrics.stage('read'):
+            slab = np.ascontiguousarray(source[start:start + n], dtype=dtype)
+        with metrics.stage('compress'):
+            futures = [(start + k, submit(pool, compress_chunk, slab[k:k + chunkrows],
+                                          chunkshape, hdf5_opts))
+                       for k in range(0, n, chunkrows)]
+            results = [(row, fut.result()) for row, fut in futures]
+        with metrics.stage('write'):
+            for row, (comp, filter_mask, err) in results:
+                out.id.write_direct_chunk((row,) + (0,) * (len(chunkshape) - 1), comp,
+                                          filter_mask=filter_mask)
+                maxerr = max(maxerr, err)
+        del slab, futures, results
+
+    parttype = name.strip('/').split('/')[0]
+    opts['sz3']['max_error'][parttype] = maxerr
+    if maxerr > opts['sz3']['absolute']:
+        raise RuntimeError(f'{name}: SZ3 error {maxerr} exceeds the bound {opts["sz3"]["absolute"]}')
+    return maxerr
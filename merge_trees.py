@@ -2,71 +2,63 @@
 '''
 Copy any extra files from the tape staging area that were not compressed by
 these scripts.  This includes parameter files, log files, power spectra, etc.
+
+Both trees are listed in parallel and diffed in memory, and the copies run in
+a thread pool; see treesync.py.
 '''
 
-import os
-import re
-import shutil
 from pathlib import Path
 from timeit import default_timer
 
 import click
 from tqdm import tqdm
 
+import treescan
+import treesync
+
 
 @click.command()
 @click.argument('src')
 @click.argument('dst')
 @click.option('--verbose', '-V', is_flag=True, default=False)
 @click.option('--dryrun', '-d', is_flag=True, default=False)
-def compress(src, dst, verbose=False, dryrun=False):
+@click.option('--threads', '-j', default=32,
+    help='Number of concurrent directory scans and file copies',
+)
+@click.option('--pack', is_flag=True, default=False,
+    help='Pack the leftover files of each simulation into one archive (see simarchive.py)',
+)
+def compress(src, dst, verbose=False, dryrun=False, threads=32, pack=False):
     t = -default_timer()
     src = Path(src).resolve()
     dst = Path(dst).resolve()
 
-    if dryrun:
-        # shutil.copy = lambda src,dst: print(f'Copy: {src} -> {dst}')
-        # shutil.copytree = lambda src,dst: print(f'Copy tree: {src} -> {dst}')
-        shutil.copy = lambda src,dst: print(src)
-        shutil.copytree = lambda src,dst: print(src)
+    plan = treesync.diff(src, dst,
+        skip_file=treescan.skip_default,
+        threads=threads, pack=pack,
+        )
+    tscan = t + default_timer()
 
-        chmod = lambda p,m: None
+    if dryrun:
+        for s, _, _ in plan.files:
+            print(s)
+        for s, _ in plan.trees:
+            print(s)
+        for _, members in plan.packs:
+            for _, s, _ in members:
+                print(s)
+        nfiles = nbytes = 0
     else:
-        chmod = lambda p,m: p.chmod(m)
-
-    i = 0
-    for srcpath, dns, fns in tqdm(os.walk(src), unit=' path'):
-        srcpath = Path(srcpath)
-        dns[:] = [d for d in dns if not re.match(r'snapdir_\d+', d)]
-
-        dstpath = dst / srcpath.relative_to(src)
-
-        if dstpath.exists():
-            chmod(dstpath, 0o755)
-            for fn in fns:
-                if re.match(r'ics\.\d+', fn):
-                    continue
-                if not (dstpath / fn).exists() or \
-                    ((dstpath / fn).stat().st_size != (srcpath / fn).stat().st_size):
-                    assert not fn.endswith('.hdf5')
-                    shutil.copy(srcpath / fn, dstpath / fn)
-                    chmod(dstpath / fn, 0o444)
-            chmod(dstpath, 0o555)
-        else:
-            assert not re.match(r'snapdir_\d+', dstpath.name)
-            chmod(dstpath.parent, 0o755)
-            shutil.copytree(srcpath, dstpath)
-            chmod(dstpath, 0o555)
-            chmod(dstpath.parent, 0o555)
-            dns.clear()
-
-        i += 1
+        with tqdm(unit='B', unit_scale=True) as progress:
+            nfiles, nbytes = treesync.sync(plan, threads=threads, progress=progress)
 
     t += default_timer()
     if verbose:
-        print(f'Time: {t:.4g} sec')
-        print(f'Files: {i:.4g}')
-        print(f'Rate: {i/t:.4g} files/sec')
+        print(f'Time: {t:.4g} sec (scan {tscan:.4g} sec)')
+        print(f'Dirs: {plan.ndirs:.4g}')
+        print(f'Rate: {plan.ndirs/tscan:.4g} dirs/sec scanned')
+        print(f'Copied: {nfiles} files, {nbytes/1e6:.4g} MB')
+        print(f'Rate: {nfiles/(t - tscan):.4g} files/sec, {nbytes/(t - tscan)/1e6:.4g} MB/sec')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+'''
+Per-stage timings and metrics of compression tasks, and a report over a job.
+
+compress_hdf5.py and compress_gadget.py time each stage of each output file:
+header, read, sort, spill (with `--max-memory`, see outofcore.py), encode,
+truncate, compress and write. A stage's `wall` is
+the time the main thread spent in it or waiting on it. Its `cpu` is the CPU
+time spent on it by all threads, so compression in a thread pool (`-t`) shows
+up as more CPU than wall, and truncation, fused into it, is counted there.
+With one thread, the HDF5 filter compresses and writes in the same call, which
+is counted as `compress`; `write` is then only the final flush. Bytes read are
+the stored size of the source datasets or Gadget blocks; bytes written are the
+size of the output file. Peak RSS is that of the process so far.
+
+With `compress_hdf5.py --prefetch`, an output's datasets are read in the
+background while the previous output is compressed. That read is recorded as
+the `prefetch` stage of the output, and its `read` is only the time spent
+waiting for it, so the difference is the read time hidden by the overlap.
+
+With `--metrics PATH`, one JSON line per output file is appended to PATH, or,
+if PATH is a directory, to `PATH/<host>-<pid>.jsonl`, so that concurrent tasks
+never share a file. With `--metrics-info`, the same record is also stored in
+the `metrics` attribute of `/CompressionInfo`.
+
+Run this script on a job's metrics directory (or on .jsonl files) for
+throughput histograms and the slowest files:
+
+    metrics.py job01/metrics --top 20
+'''
+
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import resource
+import socket
+import threading
+import time
+from timeit import default_timer
+
+import click
+import numpy as np
+
+
+class Metrics:
+    '''Stage timings and byte counts of one output file.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.wall = -default_timer()
+        self.cpu = -time.process_time()
+
+    def add(self, name, wall=0., cpu=0.):
+        with self.lock:
+            s = self.stages.setdefault(name, dict(wall=0., cpu=0.))
+            s['wall'] += wall
+            s['cpu'] += cpu
+
+    @contextmanager
+    def stage(self, name):
+        '''Time the body as stage `name`, with this thread's CPU time.
+        '''
+        wall, cpu = default_timer(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, default_timer() - wall, time.thread_time() - cpu)
+
+    def worker(self, name, fn):
+        '''Wrap `fn`, to be run in a pool, so that its CPU time counts
+        towards stage `name`. Its wall time is not added: the main thread
+        times its wait for the result instead.
+        '''
+        def timed(*args, **kwargs):
+            cpu = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, cpu=time.thread_time() - cpu)
+        return timed
+
+    def record(self, **fields):
+        '''The JSON-able record, stamped now. `fields` are added as is.
+        '''
+        return dict(
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            start=self.start,
+            wall=self.wall + default_timer(),
+            cpu=self.cpu + time.process_time(),
+            stages=self.stages,
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            **fields,
+        )
+
+
+def sidecar_path(path):
+    path = Path(path)
+    if path.is_dir():
+        return path / f'{socket.gethostname()}-{os.getpid()}.jsonl'
+    return path
+
+
+def emit(record, path=None):
+    '''Append `record` to the sidecar `path`, if given.
+    '''
+    if path is not None:
+        with open(sidecar_path(path), 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+
+
+def load(paths):
+    '''All records in the given .jsonl files, or under the given directories.
+    '''
+    records = []
+    for p in paths:
+        p = Path(p)
+        for fn in sorted(p.rglob('*.jsonl')) if p.is_dir() else [p]:
+            with open(fn) as fp:
+                records += [json.loads(line) for line in fp if line.strip()]
+    return records
+
+
+def histogram(values, bins, width=50):
+    '''Text histogram of positive `values` in log-spaced bins.
+    '''
+    values = np.asarray(values, dtype=float)
+    values = values[values > 0]
+    if len(values) == 0:
+        return []
+    lo, hi = values.min(), values.max()
+    edges = np.geomspace(lo, hi * 1.0001, bins + 1) if hi > lo else np.array([lo, lo * 1.0001])
+    counts, edges = np.histogram(values, edges)
+    scale = width / counts.max()
+    return [f'{a:10.4g} - {b:<10.4g} {c:6d} {"#" * int(round(c * scale))}'
+            for a, b, c in zip(edges[:-1], edges[1:], counts)]
+
+
+@click.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--top', '-n', default=20, help='Number of slowest files to list')
+@click.option('--bins', default=16, help='Number of histogram bins')
+def report(paths, top, bins):
+    '''Summarize the metrics records of a job, from its metrics directory or
+    .jsonl files.
+    '''
+    records = load(paths)
+    if not records:
+        raise click.ClickException('No metrics records found')
+
+    by_script = {}
+    for r in records:
+        by_script.setdefault(r.get('script', '?'), []).append(r)
+
+    for script, recs in sorted(by_script.items()):
+        wall = sum(r['wall'] for r in recs)
+        cpu = sum(r['cpu'] for r in recs)
+        nin = sum(r['input_bytes'] for r in recs)
+        nout = sum(r['bytes_written'] for r in recs)
+        print(f'== {script}: {len(recs)} files, {nin/1e9:.4g} GB in, {nout/1e9:.4g} GB out '
+              f'({nin/nout:.3g}x), {wall/3600:.4g} h wall, {cpu/3600:.4g} h CPU')
+        print(f'   aggregate {nin/wall/1e6:.4g} MB/s per task; '
+              f'peak RSS up to {max(r["peak_rss"] for r in recs)/2**30:.3g} GiB')
+
+        print(f'{"stage":>10} {"wall (h)":>10} {"wall %":>7} {"cpu (h)":>10} {"cpu/wall":>9}')
+        stages = {}
+        for r in recs:
+            for name, s in r['stages'].items():
+                t = stages.setdefault(name, dict(wall=0., cpu=0.))
+                t['wall'] += s['wall']
+                t['cpu'] += s['cpu']
+        for name, s in sorted(stages.items(), key=lambda kv: -kv[1]['wall']):
+            print(f'{name:>10} {s["wall"]/3600:10.4g} {100*s["wall"]/wall:6.1f}% '
+                  f'{s["cpu"]/3600:10.4g} {s["cpu"]/max(s["wall"], 1e-9):9.3g}')
+        if 'prefetch' in stages:
+            ahead = stages['prefetch']['wall']
+            waited = stages.get('read', {}).get('wall', 0.)
+            print(f'   prefetch: {ahead/3600:.4g} h of reads in the background, {waited/3600:.4g} h '
+                  f'waited for ({100*max(ahead - waited, 0)/max(ahead, 1e-9):.3g}% hidden)')
+
+        print('Throughput per file (input MB/s):')
+        for line in histogram([r['input_bytes'] / r['wall'] / 1e6 for r in recs], bins):
+            print('  ' + line)
+        print()
+
+    print(f'Slowest {min(top, len(records))} files:')
+    print(f'{"wall (s)":>10} {"MB/s":>8} {"ratio":>6} {"RSS GiB":>8}  output')
+    for r in sorted(records, key=lambda r: -r['wall'])[:top]:
+        print(f'{r["wall"]:10.4g} {r["input_bytes"]/r["wall"]/1e6:8.4g} '
+              f'{r["input_bytes"]/r["bytes_written"]:6.3g} {r["peak_rss"]/2**30:8.3g}  {r["dst"]}')
+
+
+if __name__ == '__main__':
+    report()
@@ -0,0 +1,321 @@
+'''
+Out-of-core compression of Gadget blocks, for `compress_gadget.py --max-memory`.
+
+Sorting in memory holds each whole block, its sorted copy and the int64
+argsort index: tens of GB per task at 1024^3. Here, with `-s`, the particles
+are instead partitioned into ID-range buckets that each fit in the memory
+cap, in three streaming passes over the sub-files, one slab of rows at a time:
+
+1. the range of the IDs;
+2. a histogram of the IDs, from which the bucket boundaries are chosen so
+   that no bucket holds more rows than fit in the cap;
+3. the IDs, Coordinates and Velocities of each slab are scattered to their
+   buckets, in one scratch file per block in which each bucket has its own
+   region (its size is known from the histogram).
+
+Then the buckets are loaded back one at a time, in ID order, sorted (placed
+by ID if they are a dense range, as in memory, else by argsort) and appended
+to the output datasets. Without `-s`, the rows are copied straight from the
+sub-files, a slab at a time, with no scratch files.
+
+Rows are appended to the datasets in whole chunks only (see `ChunkWriter`),
+so the chunks are the same as with the in-memory path. Only their order in
+the file differs, as the three datasets grow together.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+
+import direct_chunk
+from direct_chunk import truncate
+from metrics import Metrics
+
+NAMES = ['ParticleIDs', 'Coordinates', 'Velocities']
+
+# Bytes held per particle: the ID, a sort index, and a raw and a sorted row
+# of one 3-vector block
+ROWBYTES = 40
+
+HIST_BINS = 1 << 20
+
+
+class ChunkWriter:
+    '''Append rows to a new dataset, compressing whole chunks only: a partial
+    chunk is carried over to the next append, or written by `close()`.
+    '''
+
+    def __init__(self, h5out, name, shape, opts, pool=None, metrics=None):
+        hdf5_opts = opts['hdf5']
+        self.out = h5out.create_dataset(name, shape=shape, **hdf5_opts)
+        self.opts = opts
+        # direct chunk writes need the Blosc filter; others compress through h5py
+        if hdf5_opts.get('compression') != direct_chunk.BLOSC_FILTER_ID:
+            pool = None
+        self.pool = pool
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.chunkshape = hdf5_opts['chunks']
+        self.chunkrows = self.chunkshape[0]
+        if pool is not None:
+            self.params = direct_chunk.blosc_params(opts)
+            self.compress = self.metrics.worker('compress', direct_chunk.compress_chunk)
+        self.carry = np.empty((self.chunkrows,) + tuple(shape[1:]), dtype=self.out.dtype)
+        self.ncarry = 0
+        self.start = 0
+
+    def append(self, rows):
+        if self.ncarry:
+            k = min(len(rows), self.chunkrows - self.ncarry)
+            self.carry[self.ncarry : self.ncarry + k] = rows[:k]
+            self.ncarry += k
+            rows = rows[k:]
+            if self.ncarry < self.chunkrows:
+                return
+            self._write(self.carry)
+            self.ncarry = 0
+
+        nwhole = len(rows) // self.chunkrows * self.chunkrows
+        if nwhole:
+            self._write(rows[:nwhole])
+        self.ncarry = len(rows) - nwhole
+        self.carry[:self.ncarry] = rows[nwhole:]
+
+    def close(self):
+        if self.ncarry:
+            self._write(self.carry[:self.ncarry])
+            self.ncarry = 0
+        assert self.start == len(self.out)
+        if self.pool is None:
+            with self.metrics.stage('compress'):
+                # the last chunks are compressed when they leave the chunk cache
+                self.out.id.flush()
+
+    def _write(self, slab):
+        n = len(slab)
+        tbits = self.opts['truncbits']
+        if self.pool is None:
+            with self.metrics.stage('truncate'):
+                truncate(slab, tbits)
+            with self.metrics.stage('compress'):
+                self.out[self.start : self.start + n] = slab
+        else:
+            with self.metrics.stage('compress'):
+                futures = [(self.start + k, self.pool.submit(self.compress,
+                                slab[k : k + self.chunkrows], tbits, self.chunkshape,
+                                self.out.dtype, self.params))
+                           for k in range(0, n, self.chunkrows)]
+            for row, fut in futures:
+                with self.metrics.stage('compress'):
+                    comp, filter_mask = fut.result()
+                offset = (row,) + (0,) * (len(self.chunkshape) - 1)
+                with self.metrics.stage('write'):
+                    self.out.id.write_direct_chunk(offset, comp, filter_mask=filter_mask)
+        self.start += n
+
+
+def write_rows(h5out, gfiles, parttype, compression_opts, window, nthreads, max_memory,
+               scratch=None, metrics=None):
+    '''Write rows `window` (lo, hi) of `parttype`, in file order, holding at
+    most `max_memory` bytes of particle data. Returns the bytes read.
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    lo, hi = window
+    slabrows = max(1, max_memory // ROWBYTES)
+    nread = 0
+    with ThreadPoolExecutor(nthreads) if nthreads > 1 else nullcontext() as pool:
+        for name in NAMES:
+            opts = compression_opts[name]
+            shape = (hi - lo, 3) if name != 'ParticleIDs' else (hi - lo,)
+            writer = ChunkWriter(h5out, f'/PartType{parttype}/{name}', shape, opts, pool, metrics)
+            first = 0
+            for g in gfiles:
+                n = g.header['npart'][parttype]
+                for start in range(max(lo - first, 0), min(hi - first, n), slabrows):
+                    with metrics.stage('read'):
+                        slab = g.read_rows(opts['blockname'], parttype,
+                                           start, min(start + slabrows, hi - first))
+                        slab = slab.astype(writer.out.dtype, copy=False)
+                    writer.append(slab)
+                    nread += slab.nbytes
+                    del slab
+                first += n
+            writer.close()
+    return nread
+
+
+def write_sorted(h5out, gfiles, parttype, compression_opts, window, nthreads, max_memory,
+                 scratch=None, metrics=None):
+    '''Write rows `window` (lo, hi) of `parttype` sorted by ID, holding at most
+    about `max_memory` bytes of particle data, through ID-range buckets
+    spilled to a temporary directory under `scratch`. Returns the bytes read.
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    lo, hi = window
+    cap = max(1, max_memory // ROWBYTES)
+    opts = {name: compression_opts[name] for name in NAMES}
+    dtypes = {name: np.dtype(opts[name]['hdf5']['dtype']) for name in NAMES}
+    rowshape = {name: (3,) if name != 'ParticleIDs' else () for name in NAMES}
+    rowbytes = {name: dtypes[name].itemsize * int(np.prod(rowshape[name])) for name in NAMES}
+
+    def slabs():
+        # a reader of each slab of rows, in file order. The passes over the
+        # sub-files count their reads as part of their own stage.
+        for g in gfiles:
+            for start in range(0, g.header['npart'][parttype], cap):
+                def read(name, g=g, start=start):
+                    data = g.read_rows(opts[name]['blockname'], parttype, start, start + cap)
+                    return data.astype(dtypes[name], copy=False)
+                yield read
+
+    with metrics.stage('sort'):
+        # passes 1 and 2: the ID range, then the histogram, in bins of
+        # 2**shift IDs
+        idmin, idmax = None, None
+        for read in slabs():
+            ids = read('ParticleIDs')
+            if len(ids):
+                idmin = int(ids.min()) if idmin is None else min(idmin, int(ids.min()))
+                idmax = int(ids.max()) if idmax is None else max(idmax, int(ids.max()))
+        span = idmax - idmin + 1
+        shift = max(0, (span - 1) // HIST_BINS).bit_length()
+        nbins = ((span - 1) >> shift) + 1
+        idmin = dtypes['ParticleIDs'].type(idmin)
+
+        def bins(ids):
+            return ((ids - idmin) >> shift).astype(np.intp)
+
+        hist = np.zeros(nbins, dtype=np.int64)
+        for read in slabs():
+            hist += np.bincount(bins(read('ParticleIDs')), minlength=nbins)
+
+        # bucket b holds the IDs in bins edges[b]..edges[b+1]. A single bin
+        # with more than `cap` rows, if any, gets a bucket of its own.
+        cum = np.cumsum(hist)
+        edges = [0]
+        while edges[-1] < nbins:
+            done = cum[edges[-1] - 1] if edges[-1] else 0
+            j = int(np.searchsorted(cum, done + cap, side='right'))
+            edges += [min(max(j, edges[-1] + 1), nbins)]
+        edges = np.array(edges)
+        counts = np.diff(np.concatenate([[0], cum[edges[1:] - 1]]))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        # only the buckets that overlap the window are spilled
+        b0 = int(np.searchsorted(offsets, lo, side='right')) - 1
+        b1 = int(np.searchsorted(offsets, hi, side='left'))
+        del hist, cum
+
+        # the bucket of each bin. Small integers are stable-sorted by radix sort.
+        nbuckets = len(edges) - 1
+        bucket_of = np.repeat(np.arange(nbuckets, dtype=np.uint16 if nbuckets < 1<<16 else np.int64),
+                              np.diff(edges))
+
+    with tempfile.TemporaryDirectory(prefix='compress_gadget-', dir=scratch) as tmpdir:
+        fds = {name: os.open(Path(tmpdir) / name, os.O_RDWR | os.O_CREAT, 0o600) for name in NAMES}
+        try:
+            # pass 3: scatter each slab to its buckets
+            cursor = offsets[b0:b1] - offsets[b0]
+            with metrics.stage('spill'):
+                for read in slabs():
+                    bucket = bucket_of[bins(read('ParticleIDs'))]
+                    order = np.argsort(bucket, kind='stable')
+                    nper = np.bincount(bucket, minlength=nbuckets)
+                    # only rows in buckets b0..b1
+                    order = order[nper[:b0].sum() : len(order) - nper[b1:].sum()]
+                    nper = nper[b0:b1]
+                    del bucket
+                    for name in NAMES:
+                        data = read(name)[order]
+                        k = 0
+                        for b in np.flatnonzero(nper):
+                            pwrite(fds[name], data[k : k + nper[b]],
+                                   int(cursor[b]) * rowbytes[name])
+                            k += nper[b]
+                        del data
+                    cursor += nper
+                    del order
+
+            # then sort each bucket in memory, in ID order
+            nread = 0
+            with ThreadPoolExecutor(nthreads) if nthreads > 1 else nullcontext() as pool:
+                writers = {name: ChunkWriter(h5out, f'/PartType{parttype}/{name}',
+                                             (hi - lo,) + rowshape[name], opts[name], pool, metrics)
+                           for name in NAMES}
+                for b in range(b0, b1):
+                    n = int(counts[b])
+                    # the rows of this bucket that are in the window
+                    a, z = int(max(lo - offsets[b], 0)), int(min(hi - offsets[b], n))
+                    start = int(offsets[b] - offsets[b0])
+
+                    def load(name):
+                        with metrics.stage('read'):
+                            data = np.empty((n,) + rowshape[name], dtype=dtypes[name])
+                            pread(fds[name], data, start * rowbytes[name])
+                        return data
+
+                    ids = load('ParticleIDs')
+                    with metrics.stage('sort'):
+                        first = int(ids.min()) if n else 0
+                        where, iord = None, None
+                        if n and int(ids.max()) - first + 1 == n:
+                            where = ids.astype(np.intp) - first
+                            seen = np.zeros(n, dtype=bool)
+                            seen[where] = True
+                            if not seen.all():
+                                where = None
+                            del seen
+                        if where is not None:
+                            ids = np.arange(first, first + n, dtype=ids.dtype)
+                        else:
+                            iord = np.argsort(ids)
+                            ids = ids[iord]
+                    writers['ParticleIDs'].append(ids[a:z])
+                    del ids
+
+                    for name in NAMES[1:]:
+                        data = load(name)
+                        with metrics.stage('sort'):
+                            if where is not None:
+                                out = np.empty_like(data)
+                                out[where] = data
+                            else:
+                                out = data[iord]
+                            del data
+                        writers[name].append(out[a:z])
+                        del out
+                    del where, iord
+                    nread += (z - a) * sum(rowbytes.values())
+
+                for w in writers.values():
+                    w.close()
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+    return nread
+
+
+def pwrite(fd, data, offset):
+    '''Write all of the contiguous array `data` at `offset`, in as many calls
+    as it takes (one call writes at most 2 GB).
+    '''
+    buf = memoryview(data).cast('B')
+    while len(buf):
+        n = os.pwrite(fd, buf, offset)
+        buf, offset = buf[n:], offset + n
+
+
+def pread(fd, out, offset):
+    '''Fill the contiguous array `out` from `offset`.
+    '''
+    buf = memoryview(out).cast('B')
+    while len(buf):
+        n = os.preadv(fd, [buf], offset)
+        if n == 0:
+            raise EOFError(f'Scratch file ended at {offset}')
+        buf, offset = buf[n:], offset + n
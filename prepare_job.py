@@ -1,12 +1,64 @@
 #!/usr/bin/env python3
+'''
+Prepare a disBatch task list to compress every snapshot and IC file under
+ROOT into OUT.
 
+The sizes and mtimes of the sources, and the outputs that were found complete,
+are kept in an SQLite manifest between runs. Only tasks whose output is
+missing or stale are emitted, so a rerun after a partial failure picks up
+where the last job stopped. An output is stale if its sources changed since
+it was recorded, or are newer than it.
+
+The tree is crawled once, with `os.scandir` in a thread pool. The crawl rate
+is reported at the end.
+
+Each task's cost is estimated from its input size, as `--overhead` seconds
+(interpreter and import startup) plus the bytes at `--rate` per task. Small
+HDF5 files in the same directory are bundled into one compress_hdf5.py
+invocation of up to `--bundle-size` bytes, to amortize the overhead. Tasks are
+emitted largest first, so the biggest files do not start last and straggle
+(`--order found` instead streams them out in crawl order). The predicted
+makespan on `--nodes` x `--tasks-per-node` disBatch slots is reported, from
+the same greedy schedule disBatch follows (not counting the finalize tasks).
+
+Gadget snapshot tasks larger than `--shard-size` are split into shard tasks,
+each compressing a slice of the particles (see shards.py). Their master files
+are written by `shards.py finalize` tasks, after a disBatch barrier. Each
+shard is tracked like an output of its own, so a rerun only emits the shards
+that are missing, and the finalize task once they will all exist.
+
+With `--metrics-dir`, every task
+records its per-stage timings there, for `metrics.py` to summarize; they are
+also the numbers to calibrate `--rate` and `--overhead` with.
+
+A leftover `.inprogress` output (or shard, or master file) makes its task
+fail (the compression scripts refuse to overwrite one). Those older than `--stale-hours` are assumed to be
+from dead jobs: list them with `--list-inprogress`, or delete them and emit
+their tasks with `--clean-inprogress`. Younger ones are assumed to be running,
+and their tasks are skipped.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+import heapq
+import itertools
+import json
+import os
 from pathlib import Path
+import re
+import sqlite3
 import sys
+import time
+from timeit import default_timer
 
 import click
 
+from compress_hdf5 import parse_size
+from shards import shard_path
+
 COMPRESS_HDF5 = (Path(__file__).parent / 'compress_hdf5.py').resolve()
 COMPRESS_GADGET = (Path(__file__).parent / 'compress_gadget.py').resolve()
+SHARDS = (Path(__file__).parent / 'shards.py').resolve()
 
 NOUT_IC = {  8: 8,
             16: 8,
@@ -18,60 +70,329 @@ NOUT_IC = {  8: 8,
 @click.command()
 @click.argument('root')
 @click.argument('out')
-def main(root, out):
-    prepare(root, out)
-    prepare_ic(root, out)
-
-
-def prepare(root, out):
+@click.option('--manifest', '-M', default='prepare_job.sqlite',
+    help='SQLite file recording source and output state between runs',
+)
+@click.option('--all', 'emit_all', is_flag=True, default=False,
+    help='Emit every task, even if its output is up to date',
+)
+@click.option('--list-inprogress', is_flag=True, default=False,
+    help='List stale .inprogress outputs instead of emitting tasks',
+)
+@click.option('--clean-inprogress', is_flag=True, default=False,
+    help='Delete stale .inprogress outputs, and emit their tasks',
+)
+@click.option('--stale-hours', default=24.,
+    help='.inprogress outputs older than this are assumed to be from dead jobs',
+)
+@click.option('--threads', '-j', default=32,
+    help='Number of directories to scan concurrently',
+)
+@click.option('--order', default='size', type=click.Choice(['size', 'found']),
+    help='Emit tasks largest first, or as they are found',
+)
+@click.option('--bundle-size', default='1G',
+    help='Bundle HDF5 files of a directory into tasks of up to this many bytes (0 to disable)',
+)
+@click.option('--nodes', default=1,
+    help='Number of nodes, for the makespan prediction',
+)
+@click.option('--tasks-per-node', default=16,
+    help='Number of concurrent tasks per node, for the makespan prediction',
+)
+@click.option('--rate', default='100M',
+    help='Compression throughput of one task, in bytes per second',
+)
+@click.option('--overhead', default=3.,
+    help='Startup cost of one task, in seconds',
+)
+@click.option('--shard-size', default='0',
+    help='Split Gadget snapshot tasks larger than this (e.g. 4G) into shard tasks, finalized after a barrier (0 to disable)',
+)
+@click.option('--metrics-dir', default=None,
+    help='Have each task write its per-stage timings into this directory (see metrics.py)',
+)
+def main(root, out, manifest, emit_all, list_inprogress, clean_inprogress, stale_hours,
+         threads, order, bundle_size, nodes, tasks_per_node, rate, overhead, shard_size,
+         metrics_dir):
+    t = -default_timer()
     root = Path(root).resolve()
     out = Path(out).resolve()
+    stats = dict(dirs=0, entries=0)
+    rate = parse_size(rate)
+    shard_size = parse_size(shard_size)
+    if metrics_dir is not None:
+        metrics_dir = Path(metrics_dir).resolve()
+        metrics_dir.mkdir(parents=True, exist_ok=True)
 
-    hdf5_tasks = []
-    gadget_tasks = []
-    # N.B. glob('**') does not follow symlinks
-    for fn in root.glob('**/snap_*.*'):
-        if fn.suffix == '.hdf5':
-            hdf5_tasks += [f'{fn} {out/fn.relative_to(root).parent}']
-        else:
-            outfn = out/fn.relative_to(root)
-            outfn = outfn.parent / (outfn.name + '.hdf5')
-            gadget_tasks += [f'{fn} {outfn}']
+    with Manifest(manifest) as db:
+        counts = dict(done=0, running=0, stale=0, todo=0)
 
-    print(rf'#DISBATCH PREFIX {COMPRESS_HDF5} ')
-    for task in hdf5_tasks:
-        print(task)
+        def todo():
+            for task_prefix, src, dst, outfn, srcstats in prepare(root, out, threads, stats):
+                nbytes = sum(st.st_size for st in srcstats)
+                nshard = 1
+                if shard_size and task_prefix == f'{COMPRESS_GADGET} -s':
+                    nshard = -(-nbytes // shard_size)
+                # a sharded task has a state per shard, and one for its master file
+                outfns = [outfn]
+                if nshard > 1:
+                    outfns += [shard_path(outfn, k) for k in range(nshard)]
+                states = (['todo'] * len(outfns) if emit_all
+                          else db.states(src, outfns, stale_hours, srcstats))
+                if states[0] == 'done':
+                    # a finalized master file needs none of its shards
+                    states = states[:1]
 
-    print(rf'#DISBATCH PREFIX {COMPRESS_GADGET} -s ')
-    for task in gadget_tasks:
-        print(task)
+                for k, fn in enumerate(outfns[:len(states)]):
+                    if states[k] == 'stale' and clean_inprogress and not list_inprogress:
+                        fn.with_suffix('.inprogress').unlink()
+                        states[k] = 'todo'
+                    counts[states[k]] += 1
+                    if states[k] == 'stale' and list_inprogress:
+                        print(fn.with_suffix('.inprogress'))
+                if list_inprogress or states[0] == 'done':
+                    continue
 
+                if nshard == 1:
+                    if states[0] == 'todo':
+                        yield task_prefix, src, dst, nbytes, None
+                    continue
+                # only the missing shards; finalize once all of them will exist
+                todo_shards = [k for k, state in enumerate(states[1:]) if state == 'todo']
+                finalize = states[0] == 'todo' and all(state in ('done', 'todo')
+                                                       for state in states[1:])
+                if todo_shards or finalize:
+                    yield task_prefix, src, dst, nbytes, (nshard, todo_shards, finalize)
 
-def prepare_ic(root, out):
-    root = Path(root).resolve()
-    out = Path(out).resolve()
+        tasks = bundle(todo(), parse_size(bundle_size))
+        if order == 'size':
+            tasks = sorted(tasks, key=lambda task: -task[3])
+
+        prefix = None
+        costs = []
+        finalize = []
+        for task_prefix, src, dst, nbytes, shard in tasks:
+            args = ' '.join(str(f) for f in src) + f' {dst}'
+            if shard is None:
+                lines = [args]
+                costs += [overhead + nbytes / rate]
+            else:
+                nshard, todo_shards, needs_finalize = shard
+                lines = [f'--shard {k}/{nshard} {args}' for k in todo_shards]
+                costs += [overhead + nbytes / nshard / rate] * len(todo_shards)
+                if needs_finalize:
+                    finalize += [dst]
+            if lines and task_prefix != prefix:
+                metrics = f' --metrics {metrics_dir}' if metrics_dir is not None else ''
+                print(rf'#DISBATCH PREFIX {task_prefix}{metrics} ')
+                prefix = task_prefix
+            for line in lines:
+                print(line, flush=True)
+
+        if finalize:
+            # the master files of sharded outputs, once all shards are done
+            print('#DISBATCH BARRIER')
+            print(rf'#DISBATCH PREFIX {SHARDS} finalize ')
+            for dst in finalize:
+                print(dst, flush=True)
+
+    t += default_timer()
+    print(f'Crawled {stats["dirs"]} directories, {stats["entries"]} entries in {t:.4g} sec '
+          f'({stats["dirs"]/t:.4g} dirs/sec, {stats["entries"]/t:.4g} entries/sec)',
+          file=sys.stderr)
+    print(f'{counts["todo"]} tasks to do, {counts["done"]} done, '
+          f'{counts["running"]} running, {counts["stale"]} with stale .inprogress outputs',
+          file=sys.stderr)
+    if counts['stale'] and not (clean_inprogress or list_inprogress):
+        print('Tasks with stale .inprogress outputs were skipped; see --list-inprogress '
+              'and --clean-inprogress', file=sys.stderr)
+    if costs:
+        slots = nodes * tasks_per_node
+        print(f'{len(costs)} tasks after bundling; predicted makespan on {slots} slots: '
+              f'{makespan(costs, slots)/3600:.3g} h '
+              f'(total {sum(costs)/3600:.3g} h, longest task {max(costs)/3600:.3g} h)',
+              file=sys.stderr)
+
+
+def bundle(tasks, target):
+    '''Merge runs of compress_hdf5.py tasks into the same directory into
+    tasks of up to `target` bytes. Other tasks pass through. Tasks are
+    (prefix, sources, dst argument, bytes, shards).
+    '''
+    unique = itertools.count()
+
+    def key(task):
+        return (task[0], task[2]) if target and task[0] == str(COMPRESS_HDF5) else next(unique)
+
+    for _, group in itertools.groupby(tasks, key=key):
+        src, nbytes = [], 0
+        for task_prefix, tsrc, dst, tbytes, shard in group:
+            if src and nbytes + tbytes > target:
+                yield task_prefix, src, dst, nbytes, shard
+                src, nbytes = [], 0
+            src += tsrc
+            nbytes += tbytes
+        yield task_prefix, src, dst, nbytes, shard
+
+
+def makespan(costs, slots):
+    '''Finish time of `costs`, each started in order on the first free slot.
+    '''
+    free = [0.] * slots
+    for c in costs:
+        heapq.heappush(free, heapq.heappop(free) + c)
+    return max(free)
+
+
+def prepare(root, out, threads, stats):
+    '''Snapshot and IC tasks under `root`, as (prefix, sources, dst argument,
+    output file, source stats), in the order they are found.
+    '''
+    for d, snaps, ics in crawl(root, threads, stats):
+        hdf5_tasks = []
+        gadget_tasks = []
+        for fn, st in snaps:
+            if fn.suffix == '.hdf5':
+                outdir = out/fn.relative_to(root).parent
+                hdf5_tasks += [(str(COMPRESS_HDF5), [fn], outdir, outdir/fn.name, [st])]
+            else:
+                outfn = out/fn.relative_to(root)
+                outfn = outfn.parent / (outfn.name + '.hdf5')
+                gadget_tasks += [(f'{COMPRESS_GADGET} -s', [fn], outfn, outfn, [st])]
+        yield from hdf5_tasks
+        yield from gadget_tasks
+        if ics:
+            yield from prepare_ic(root, out, d, ics)
+
+
+def prepare_ic(root, out, d, ics):
+    '''The tasks of one ICs directory, given its (ics.N file, stat) pairs.
+    '''
+    ics = sorted(ics, key=lambda f: int(f[0].suffix[1:]))
+    try:
+        nout = NOUT_IC[len(ics)]
+    except KeyError as k:
+        print(d, file=sys.stderr)
+        raise k
+
+    ncat = len(ics)//nout
+    chunks = [ics[ncat*i:ncat*(i+1)] for i in range(nout)]
+    assert sum(len(c) for c in chunks) == len(ics)
+    for i,c in enumerate(chunks):
+        outfn = out/d.relative_to(root)/f"ics.{i}.hdf5"
+        yield (f'{COMPRESS_GADGET} -v 0 -p 0', [f for f, _ in c], outfn, outfn,
+               [st for _, st in c])
+
+
+def scan(d):
+    '''One directory: its subdirectories, its snapshot files and, if it is an
+    ICs directory, its IC files, with their stats. Symlinks are not followed.
+    '''
+    subdirs, snaps, ics = [], [], []
+    nentries = 0
+    with os.scandir(d) as it:
+        for entry in it:
+            nentries += 1
+            if entry.is_dir(follow_symlinks=False):
+                subdirs += [Path(entry.path)]
+            elif fnmatch(entry.name, 'snap_*.*'):
+                snaps += [(Path(entry.path), entry.stat())]
+            elif d.name == 'ICs' and re.fullmatch(r'ics\.\d+', entry.name):
+                ics += [(Path(entry.path), entry.stat())]
+    return subdirs, snaps, ics, nentries
+
+
+def crawl(root, threads, stats):
+    '''Walk `root`, scanning up to `threads` directories at once, and yield
+    (directory, snapshot files, IC files) for each directory with any.
+    Directory and entry counts are accumulated in `stats`.
+    '''
+    with ThreadPoolExecutor(threads) as pool:
+        pending = {pool.submit(scan, root): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                d = pending.pop(fut)
+                subdirs, snaps, ics, nentries = fut.result()
+                stats['dirs'] += 1
+                stats['entries'] += nentries
+                for sub in subdirs:
+                    pending[pool.submit(scan, sub)] = sub
+                if snaps or ics:
+                    yield d, sorted(snaps), ics
+
+
+class Manifest:
+    '''SQLite record of the source files seen, and of the outputs found
+    complete, by path.
+    '''
+
+    def __init__(self, fn):
+        self.db = sqlite3.connect(fn)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS outputs (
+                path TEXT PRIMARY KEY, sources TEXT, size INTEGER, mtime_ns INTEGER);
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.db.commit()
+        self.db.close()
+
+    def states(self, src, outfns, stale_hours, stats):
+        '''The state of each output in `outfns` of the sources `src` (a
+        task's output, or the master file and shards of a sharded task):
+        "done" if it is complete and up to date, "running" or "stale" if
+        there is a recent or old `.inprogress` of it, else "todo".
+        `stats` are the `os.stat` results of `src`.
+        '''
+        changed = False
+        for fn, st in zip(src, stats):
+            row = self.db.execute('SELECT size, mtime_ns FROM sources WHERE path = ?',
+                                  (str(fn),)).fetchone()
+            if row != (st.st_size, st.st_mtime_ns):
+                changed |= row is not None
+                self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)',
+                                (str(fn), st.st_size, st.st_mtime_ns))
+        srcjson = json.dumps([str(fn) for fn in src])
+        return [self.output_state(srcjson, changed, outfn, stale_hours, stats)
+                for outfn in outfns]
+
+    def output_state(self, srcjson, changed, outfn, stale_hours, stats):
+        try:
+            st = outfn.stat()
+        except FileNotFoundError:
+            st = None
 
-    print(rf'#DISBATCH PREFIX {COMPRESS_GADGET} -v 0 -p 0 ')
+        row = self.db.execute('SELECT sources, size, mtime_ns FROM outputs WHERE path = ?',
+                              (str(outfn),)).fetchone()
+        if row is not None and (st is None or row[1:] != (st.st_size, st.st_mtime_ns)):
+            # the output was deleted or replaced since it was recorded
+            self.db.execute('DELETE FROM outputs WHERE path = ?', (str(outfn),))
+            row = None
+        if row is not None and row[0] == srcjson and not changed:
+            return 'done'
 
-    for d in root.glob('**/ICs/'):
-        fns = sorted(d.glob('ics.*'), key=lambda f: int(f.suffix[1:]))
+        if st is not None and changed:
+            # remember that this version of the output is stale (no sources)
+            self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, NULL, ?, ?)',
+                            (str(outfn), st.st_size, st.st_mtime_ns))
+        elif st is not None and st.st_mtime_ns >= max(s.st_mtime_ns for s in stats) \
+                and (row is None or row[0] is not None):
+            self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)',
+                            (str(outfn), srcjson, st.st_size, st.st_mtime_ns))
+            return 'done'
 
-        if len(fns) == 0:
-            continue
-        
         try:
-            nout = NOUT_IC[len(fns)]
-        except KeyError as k:
-            print(d, file=sys.stderr)
-            raise k
-        
-        ncat = len(fns)//nout
-        chunks = [fns[ncat*i:ncat*(i+1)] for i in range(nout)]
-        assert sum(len(c) for c in chunks) == len(fns)
-        for i,c in enumerate(chunks):
-            print(" ".join(str(f) for f in c) + " " + \
-                str(out/d.relative_to(root)/f"ics.{i}.hdf5")
-                )
+            age = time.time() - outfn.with_suffix('.inprogress').stat().st_mtime
+        except FileNotFoundError:
+            return 'todo'
+        return 'stale' if age > stale_hours * 3600 else 'running'
 
 
 if __name__ == '__main__':
@@ -3,54 +3,55 @@
 Prepare a disBatch script to copy files from one directory tree that do not exist in
 another.  In this case, this include includes parameter files, log files, power
 spectra, etc.
+
+Both trees are listed in parallel and diffed in memory; see treesync.py.
 '''
 
-import os
-import re
 from pathlib import Path
 from timeit import default_timer
 
 import click
-from tqdm import tqdm
+
+import treescan
+import treesync
+
+SIMARCHIVE = (Path(__file__).parent / 'simarchive.py').resolve()
 
 @click.command()
 @click.argument('src')
 @click.argument('dst')
 @click.option('--verbose', '-V', is_flag=True, default=False)
-def prepare(src, dst, verbose=False):
+@click.option('--threads', '-j', default=32,
+    help='Number of directories to scan concurrently',
+)
+@click.option('--pack', is_flag=True, default=False,
+    help='Pack the leftover files of each simulation into one archive (see simarchive.py)',
+)
+def prepare(src, dst, verbose=False, threads=32, pack=False):
     t = -default_timer()
     src = Path(src).resolve()
     dst = Path(dst).resolve()
 
-    i = 0
-    for srcpath, dns, fns in tqdm(os.walk(src), unit=' path'):
-        srcpath = Path(srcpath)
-        dns[:] = [d for d in dns if not re.match(r'snapdir_\d+', d)]
-
-        dstpath = dst / srcpath.relative_to(src)
-
-        if dstpath.exists():
-            copyfns = []
-            for fn in fns:
-                if re.match(r'ics\.\d+', fn) or re.match(r'snap_\w*\.\w*', fn):
-                    continue
-                if not (dstpath / fn).exists() or \
-                    ((dstpath / fn).stat().st_size != (srcpath / fn).stat().st_size):
-                    copyfns += [str(srcpath / fn)]
-            if copyfns:
-                print(f'cp -dt {str(dstpath)} {" ".join(copyfns)}')
-        else:
-            assert not re.match(r'snapdir_\d+', dstpath.name)
-            print(f'cp -dr {srcpath} {dstpath}')
-            dns.clear()
-
-        i += 1
+    plan = treesync.diff(src, dst,
+        skip_file=treescan.skip_default,
+        threads=threads, pack=pack,
+        )
+
+    bydir = {}
+    for s, d, _ in plan.files:
+        bydir.setdefault(d.parent, []).append(str(s))
+    for dstpath, copyfns in bydir.items():
+        print(f'cp -dt {str(dstpath)} {" ".join(copyfns)}')
+    for srcpath, dstpath in plan.trees:
+        print(f'cp -dr {srcpath} {dstpath}')
+    for archive, _ in plan.packs:
+        print(f'{SIMARCHIVE} pack {src / archive.parent.relative_to(dst)} {archive}')
 
     t += default_timer()
     if verbose:
         print(f'Time: {t:.4g} sec')
-        print(f'Files: {i:.4g}')
-        print(f'Rate: {i/t:.4g} files/sec')
+        print(f'Files: {plan.ndirs:.4g}')
+        print(f'Rate: {plan.ndirs/t:.4g} files/sec')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,282 @@
+'''
+Parallel random-access reader for snapshots written by compress_hdf5.py and
+compress_gadget.py.
+
+h5py decompresses one chunk at a time, on one core, into a temporary that is
+then copied to the result. Here, the raw chunks are read with HDF5 direct
+chunk reads and decompressed in a thread pool (through the same c-blosc that
+hdf5plugin uses, see direct_chunk.py) straight into their place in the output
+array. A snapshot split over several sub-files (snap_XXX.N.hdf5) reads as one
+array: each sub-file's chunks land at that sub-file's offset in the same
+buffer, so there is no concatenation copy.
+
+Reads can be selected by global row range or by ParticleID range, and can go
+into a user-supplied buffer. `/CompressionInfo` is used to find ID-sorted files
+(ID ranges are then row ranges) and to decode Lagrangian-encoded Coordinates.
+Datasets without the Blosc filter, like the original uncompressed snapshots,
+fall back to plain h5py reads. A sharded snapshot is read from its shards.
+
+    with reader.open_snapshot('snapdir_004/snap_004') as snap:
+        pos = snap.read('Coordinates')
+        ids = snap['PartType1/ParticleIDs'][1000:2000]
+        vel = snap.read('Velocities', ids=(1, 1 + 128**3))
+'''
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import re
+
+import h5py
+import hdf5plugin
+import numpy as np
+
+import direct_chunk
+from lagrangian import SLAB, decode as lagrangian_decode
+
+
+def snapshot_files(path):
+    '''The sub-files of a snapshot, in order, given a directory, a snapshot
+    prefix like `snapdir_004/snap_004`, or any one of the sub-files.
+    '''
+    path = Path(path)
+    if path.is_dir():
+        files = list(path.glob('*.hdf5'))
+    else:
+        m = re.fullmatch(r'(.*)\.\d+\.hdf5', path.name)
+        prefix = m.group(1) if m else path.name.removesuffix('.hdf5')
+        files = list(path.parent.glob(f'{prefix}.*.hdf5')) + list(path.parent.glob(f'{prefix}.hdf5'))
+        files = [fn for fn in files if re.fullmatch(rf'{re.escape(prefix)}(\.\d+)?\.hdf5', fn.name)]
+    if not files:
+        raise FileNotFoundError(f'No snapshot files found for {path}')
+
+    def subfile(fn):
+        m = re.search(r'\.(\d+)\.hdf5$', fn.name)
+        return int(m.group(1)) if m else -1
+
+    return sorted(files, key=subfile)
+
+
+def open_snapshot(path, nthreads=None):
+    return Snapshot(expand_shards(snapshot_files(path)), nthreads=nthreads)
+
+
+def expand_shards(files):
+    '''Replace the master files of sharded snapshots (see shards.py) with
+    their shards, whose chunks can be read directly.
+    '''
+    out = []
+    for fn in files:
+        with h5py.File(fn, 'r') as h5:
+            info = json.loads(h5['/CompressionInfo'].attrs['json']) if 'CompressionInfo' in h5 else {}
+        out += [fn.parent / s for s in info['shards']] if 'shards' in info else [fn]
+    return out
+
+
+def read(path, name, parttype=1, rows=None, ids=None, out=None, nthreads=None):
+    '''Read one dataset of a snapshot; see `Snapshot.read()`.
+    '''
+    with open_snapshot(path, nthreads=nthreads) as snap:
+        return snap.read(name, parttype=parttype, rows=rows, ids=ids, out=out)
+
+
+class Snapshot:
+    '''The sub-files of one snapshot, read as a single snapshot.
+    '''
+
+    def __init__(self, files, nthreads=None):
+        if nthreads is None:
+            nthreads = len(os.sched_getaffinity(0))
+        self.nthreads = nthreads
+        # chunks are read raw, so the chunk cache would only waste memory
+        self.files = [h5py.File(fn, 'r', rdcc_nbytes=0) for fn in files]
+        self.header = dict(self.files[0]['/Header'].attrs)
+        self.info = [json.loads(f['/CompressionInfo'].attrs['json'])
+                     if 'CompressionInfo' in f else {}
+                     for f in self.files]
+        self.pool = ThreadPoolExecutor(nthreads)
+        self._counts = {}
+
+    def close(self):
+        self.pool.shutdown()
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, path):
+        m = re.fullmatch(r'/?PartType(\d+)/(\w+)', path)
+        if not m:
+            raise KeyError(path)
+        return Field(self, int(m.group(1)), m.group(2))
+
+    def counts(self, parttype):
+        '''Number of particles of `parttype` in each sub-file.
+        '''
+        if parttype not in self._counts:
+            self._counts[parttype] = np.array([len(f[f'/PartType{parttype}/ParticleIDs'])
+                                               if f'/PartType{parttype}' in f else 0
+                                               for f in self.files])
+        return self._counts[parttype]
+
+    def dataset_info(self, name, parttype):
+        f = next(f for f in self.files if f'/PartType{parttype}/{name}' in f)
+        dset = f[f'/PartType{parttype}/{name}']
+        return dset.shape[1:], dset.dtype
+
+    def id_rows(self, parttype, lo, hi):
+        '''The global rows of the particles with lo <= ID < hi: a slice if the
+        snapshot is a single ID-sorted file, else an array of rows.
+        '''
+        ids = self[f'PartType{parttype}/ParticleIDs']
+        n = len(ids)
+        if len(self.files) == 1 and self.info[0].get('sort') and n:
+            first, last = ids[0:1][0], ids[n - 1:n][0]
+            if int(last) - int(first) == n - 1:
+                # dense: the ID range is a row range
+                return slice(int(np.clip(lo - int(first), 0, n)), int(np.clip(hi - int(first), 0, n)))
+            allids = ids[:]
+            return slice(int(np.searchsorted(allids, lo)), int(np.searchsorted(allids, hi)))
+        allids = ids[:]
+        return np.flatnonzero((allids >= lo) & (allids < hi))
+
+    def read(self, name, parttype=1, rows=None, ids=None, out=None):
+        '''Read `/PartTypeN/name` across all sub-files.
+
+        `rows` is a slice of the global rows (sub-files concatenated in
+        order), with any step, as in numpy. `ids` is a half-open ParticleID range `(lo, hi)`; in a file
+        that is not ID-sorted, this reads all the IDs to find the rows, and
+        the result is in file order. `out`, if given, must be a C-contiguous
+        array of the right shape and dtype.
+        '''
+        if ids is not None:
+            if rows is not None:
+                raise ValueError('Pass rows or ids, not both')
+            sel = self.id_rows(parttype, *ids)
+            if isinstance(sel, slice):
+                return self.read(name, parttype, rows=sel, out=out)
+            if len(sel) == 0:
+                return self.read(name, parttype, rows=slice(0, 0), out=out)
+            span = self.read(name, parttype, rows=slice(sel[0], sel[-1] + 1))
+            return np.take(span, sel - sel[0], axis=0, out=out)
+
+        counts = self.counts(parttype)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        start, stop, step = (rows or slice(None)).indices(int(offsets[-1]))
+        if step != 1:
+            # read the span of the selected rows, first to last in file order
+            r = range(start, stop, step)
+            if not r:
+                return self.read(name, parttype, rows=slice(0, 0))
+            lo, hi = min(r[0], r[-1]), max(r[0], r[-1]) + 1
+            return self.read(name, parttype, rows=slice(lo, hi))[::step]
+        stop = max(start, stop)
+
+        rowshape, dtype = self.dataset_info(name, parttype)
+        if out is None:
+            out = np.empty((stop - start,) + rowshape, dtype=dtype)
+        elif (out.shape != (stop - start,) + rowshape or out.dtype != dtype
+              or not out.flags.c_contiguous):
+            raise ValueError(f'out must be a C-contiguous {dtype} array of shape '
+                             f'{(stop - start,) + rowshape}')
+
+        pending = deque()
+        for k, f in enumerate(self.files):
+            a = max(start, offsets[k]) - offsets[k]
+            b = min(stop, offsets[k + 1]) - offsets[k]
+            if a >= b:
+                continue
+            dest = out[offsets[k] + a - start : offsets[k] + b - start]
+            self.read_file(f[f'/PartType{parttype}/{name}'], a, b, dest, pending)
+        for fut in pending:
+            fut.result()
+
+        # Lagrangian displacements are decoded once every chunk is in place
+        pending = []
+        for k, info in enumerate(self.info):
+            params = info.get(name, {}).get('lagrangian', {}).get(f'PartType{parttype}')
+            a = max(start, offsets[k]) - offsets[k]
+            b = min(stop, offsets[k + 1]) - offsets[k]
+            if params is None or a >= b:
+                continue
+            dest = out[offsets[k] + a - start : offsets[k] + b - start]
+            for s in range(0, b - a, SLAB):
+                d = dest[s : s + SLAB]
+                pending += [self.submit(lagrangian_decode, d, a + s, params, out=d)]
+        for fut in pending:
+            fut.result()
+
+        return out
+
+    def submit(self, fn, *args, **kwargs):
+        '''Run `fn` in the pool, or right away with a single thread.
+        '''
+        if self.nthreads > 1:
+            return self.pool.submit(fn, *args, **kwargs)
+        fut = Future()
+        fut.set_result(fn(*args, **kwargs))
+        return fut
+
+    def read_file(self, dset, a, b, dest, pending):
+        '''Read rows a..b of `dset` into `dest`, decompressing in the pool.
+        Futures are appended to `pending`, and at most a few per thread are
+        kept in flight, to bound the raw chunks held in memory.
+        '''
+        plist = dset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        if dset.chunks is None or filters != [direct_chunk.BLOSC_FILTER_ID]:
+            dset.read_direct(dest, np.s_[a:b], np.s_[0:b - a])
+            return
+
+        chunkshape = dset.chunks
+        chunkrows = chunkshape[0]
+        for row in range(a - a % chunkrows, b, chunkrows):
+            filter_mask, raw = dset.id.read_direct_chunk((row,) + (0,) * (len(chunkshape) - 1))
+            lo, hi = max(a, row), min(b, row + chunkrows)
+            pending.append(self.submit(decompress_chunk, raw, filter_mask,
+                chunkshape, dset.dtype, lo - row, dest[lo - a : hi - a]))
+            while len(pending) > 4 * self.nthreads:
+                pending.popleft().result()
+
+
+def decompress_chunk(raw, filter_mask, chunkshape, dtype, first, dest):
+    '''Decompress one chunk, and put its rows first..first+len(dest) in
+    `dest`. A whole chunk is decompressed in place.
+    '''
+    if filter_mask & 1:
+        dest[:] = np.frombuffer(raw, dtype=dtype).reshape(chunkshape)[first : first + len(dest)]
+    elif first == 0 and len(dest) == chunkshape[0]:
+        direct_chunk.blosc_decompress(raw, dest)
+    else:
+        buf = np.empty(chunkshape, dtype=dtype)
+        direct_chunk.blosc_decompress(raw, buf)
+        dest[:] = buf[first : first + len(dest)]
+
+
+class Field:
+    '''One dataset of a Snapshot, sliceable by global row like an h5py Dataset.
+    '''
+
+    def __init__(self, snap, parttype, name):
+        self.snap = snap
+        self.parttype = parttype
+        self.name = name
+        rowshape, self.dtype = snap.dataset_info(name, parttype)
+        self.shape = (int(snap.counts(parttype).sum()),) + rowshape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            raise TypeError('Only slices are supported')
+        return self.read(rows=rows)
+
+    def read(self, rows=None, ids=None, out=None):
+        return self.snap.read(self.name, self.parttype, rows=rows, ids=ids, out=out)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''
+Restore a compressed snapshot to its original layout: Gadget format-1 or -2
+files, or plain HDF5, split into `NumFilesPerSnapshot` sub-files, for codes
+that only read the original formats.
+
+    restore.py SnapshotsCompressed/fiducial/0/snapdir_004 restored/snapdir_004/snap_004
+    restore.py -f hdf5 --nfiles 8 snap_004.hdf5 restored/snap_004
+
+The compressed sub-files are read as one snapshot by reader.py, which uses
+`/CompressionInfo` to decode Lagrangian Coordinates and reads sharded
+snapshots from their shards. The rows are then split into the output
+sub-files in order. When the compressed snapshot has `NumFilesPerSnapshot`
+files, as when each sub-file was compressed on its own, each output file
+gets the particles of the matching sub-file. Otherwise (merged outputs, or
+`--nfiles`), the particles are split evenly. The headers get the counts of
+each output file and `NumFilesPerSnapshot`.
+
+Files compressed without `-s` or `--layout` keep the original particle
+order, so restoring them gives the original files, up to the truncated bits.
+ID sorting and the Morton layout do not record the original order, so it
+cannot be restored. Those files are restored in their stored order, with a
+warning.
+
+Each output file is written one slab of rows at a time: the chunks of a slab
+are decompressed in a thread pool straight into one of two buffers, while
+the other buffer is written out by a writer thread. So at most
+`--max-memory` bytes of particle data are held at once, and reading,
+decompression and writing overlap.
+'''
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import sys
+from timeit import default_timer
+
+import click
+import h5py
+import hdf5plugin
+import numpy as np
+
+import gadgetfile
+import reader
+from compress_hdf5 import parse_size
+
+# dataset, Gadget block name
+BLOCKS = [('Coordinates', 'POS '), ('Velocities', 'VEL '), ('ParticleIDs', 'ID  ')]
+
+
+@click.command()
+@click.argument('src')
+@click.argument('dst')
+@click.option('--format', '-f', 'fmt', default='gadget1',
+    type=click.Choice(['gadget1', 'gadget2', 'hdf5']),
+    help='Output format: Gadget format-1 or -2 binary, or plain HDF5',
+)
+@click.option('--nfiles', '-n', default=0,
+    help='Number of output sub-files (default: NumFilesPerSnapshot)',
+)
+@click.option('--nthreads', '-t', default=len(os.sched_getaffinity(0)),
+    help='Number of decompression threads',
+)
+@click.option('--max-memory', '-m', default='1G',
+    help='Particle data held at once, in two slab buffers',
+)
+@click.option('--verbose', '-V', is_flag=True, default=False)
+def restore(src, dst, fmt, nfiles=0, nthreads=1, max_memory='1G', verbose=False):
+    '''Restore the compressed snapshot SRC (a directory, a prefix like
+    snapdir_004/snap_004, or one of its files) to files DST.0, DST.1, ...
+    (DST.N.hdf5 with -f hdf5).
+    '''
+    t = -default_timer()
+    max_memory = parse_size(max_memory)
+    files = reader.snapshot_files(src)
+
+    headers, infos = [], []
+    for fn in files:
+        with h5py.File(fn, 'r') as h5:
+            headers += [dict(h5['/Header'].attrs)]
+            infos += [json.loads(h5['/CompressionInfo'].attrs['json'])
+                      if 'CompressionInfo' in h5 else {}]
+    if any(info.get('sort') or info.get('layout', 'file') != 'file' for info in infos):
+        click.echo(f'{src}: the original particle order was not recorded; restoring in '
+                   'stored order', err=True)
+
+    header = headers[0]
+    nfiles = nfiles or int(header['NumFilesPerSnapshot'])
+    counts = split_rows(np.array([h['NumPart_ThisFile'] for h in headers], dtype=np.int64), nfiles)
+    firsts = np.cumsum(counts, axis=0) - counts
+
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    nbytes = 0
+    with reader.Snapshot(reader.expand_shards(files), nthreads=nthreads) as snap, \
+            ThreadPoolExecutor(1) as writer:
+        for k in range(nfiles):
+            fn = output_name(dst, k, nfiles, fmt)
+            nbytes += restore_file(snap, fn, fmt, header, counts[k], firsts[k], nfiles,
+                                   writer, max_memory)
+            if verbose:
+                print(fn)
+
+    t += default_timer()
+    print(f'Restored {nbytes/1e9:.4g} GB into {nfiles} files in {t:.4g} sec '
+          f'({nbytes/t/1e6:.4g} MB/s)', file=sys.stderr)
+
+
+def split_rows(counts, nfiles):
+    '''Rows of each type in each of `nfiles` output files: those of each
+    compressed file in `counts` (nfiles x 6), if there are as many, else an
+    even split.
+    '''
+    if len(counts) == nfiles:
+        return counts
+    total = counts.sum(axis=0)
+    return np.array([total // nfiles + (k < total % nfiles) for k in range(nfiles)])
+
+
+def output_name(dst, k, nfiles, fmt):
+    if fmt == 'hdf5':
+        return Path(f'{dst}.{k}.hdf5' if nfiles > 1 else f'{dst}.hdf5')
+    return Path(f'{dst}.{k}' if nfiles > 1 else str(dst))
+
+
+def gadget_header(attrs, npart, nfiles):
+    '''The Gadget header fields (see gadgetfile.HEADER_DTYPE) of the HDF5
+    `/Header` attributes, for a file with `npart` particles.
+    '''
+    return dict(
+        npart=npart,
+        massarr=attrs['MassTable'],
+        time=attrs['Time'],
+        redshift=attrs['Redshift'],
+        sfr=attrs.get('Flag_Sfr', 0),
+        feedback=attrs.get('Flag_Feedback', 0),
+        nall=attrs['NumPart_Total'],
+        cooling=attrs.get('Flag_Cooling', 0),
+        filenum=nfiles,
+        boxsize=attrs['BoxSize'],
+        omega_m=attrs['Omega0'],
+        omega_l=attrs['OmegaLambda'],
+        hubble=attrs['HubbleParam'],
+    )
+
+
+class GadgetSink:
+    '''A new Gadget file, whose blocks are filled in by rows at any offset.
+    '''
+
+    def __init__(self, fn, header, npart, nfiles, layout, format):
+        self.fn = fn
+        self.layout = layout
+        blocks = [(blockname, sum(int(npart[i]) * layout[name, i][1] for i in range(6)
+                                  if (name, i) in layout))
+                  for name, blockname in BLOCKS]
+        self.offsets = gadgetfile.create(fn, gadget_header(header, npart, nfiles),
+                                         blocks, format=format)
+        # the payload offset of each (dataset, type)
+        self.starts = {}
+        for name, blockname in BLOCKS:
+            offset = self.offsets[blockname]
+            for i in range(6):
+                if (name, i) in layout:
+                    self.starts[name, i] = offset
+                    offset += int(npart[i]) * layout[name, i][1]
+        self.fd = os.open(fn, os.O_WRONLY)
+
+    def write(self, name, parttype, row, data):
+        buf = memoryview(np.ascontiguousarray(data)).cast('B')
+        offset = self.starts[name, parttype] + row * self.layout[name, parttype][1]
+        while len(buf):
+            n = os.pwrite(self.fd, buf, offset)
+            buf, offset = buf[n:], offset + n
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HDF5Sink:
+    '''A new plain (contiguous, unfiltered) HDF5 snapshot file.
+    '''
+
+    def __init__(self, fn, header, npart, nfiles, layout):
+        self.h5 = h5py.File(fn, 'w-')
+        self.h5.create_group('/Header')
+        attrs = self.h5['/Header'].attrs
+        for k, v in header.items():
+            attrs[k] = v
+        attrs['NumPart_ThisFile'] = np.asarray(npart).astype(header['NumPart_ThisFile'].dtype)
+        attrs['NumFilesPerSnapshot'] = header['NumFilesPerSnapshot'].dtype.type(nfiles)
+        for (name, i), (dtype, rowbytes, rowshape) in layout.items():
+            self.h5.create_dataset(f'/PartType{i}/{name}', shape=(int(npart[i]),) + rowshape,
+                                   dtype=dtype)
+
+    def write(self, name, parttype, row, data):
+        self.h5[f'/PartType{parttype}/{name}'].write_direct(np.ascontiguousarray(data),
+            dest_sel=np.s_[row : row + len(data)])
+
+    def close(self):
+        self.h5.close()
+
+
+def restore_file(snap, fn, fmt, header, npart, first, nfiles, writer, max_memory):
+    '''Write rows first..first+npart (per type) of `snap` to the new file
+    `fn`, through `writer`, a single-thread pool. Returns the bytes written.
+    '''
+    layout = {}
+    for name, _ in BLOCKS:
+        for i in range(6):
+            if npart[i]:
+                rowshape, dtype = snap.dataset_info(name, i)
+                layout[name, i] = (dtype, dtype.itemsize * int(np.prod(rowshape)), rowshape)
+
+    out = Path(f'{fn}.inprogress')
+    if fmt == 'hdf5':
+        sink = HDF5Sink(out, header, npart, nfiles, layout)
+    else:
+        sink = GadgetSink(out, header, npart, nfiles, layout, format=int(fmt[-1]))
+
+    # two slab buffers: one being decompressed into, one being written out
+    slabbytes = max(max_memory // 2, max(rowbytes for _, rowbytes, _ in layout.values()))
+    bufs = [np.empty(slabbytes, dtype=np.uint8) for _ in range(2)]
+    pending = deque()
+    nbytes = 0
+    nslab = 0
+    try:
+        for (name, i), (dtype, rowbytes, rowshape) in layout.items():
+            slabrows = slabbytes // rowbytes
+            if slabrows > 1 << 16:
+                # whole chunks of the compressed files
+                slabrows -= slabrows % (1 << 16)
+            for row in range(0, npart[i], slabrows):
+                n = min(slabrows, npart[i] - row)
+                if len(pending) == 2:
+                    # the write out of this buffer
+                    pending.popleft().result()
+                buf = bufs[nslab % 2][: n * rowbytes].view(dtype).reshape((n,) + rowshape)
+                nslab += 1
+                snap.read(name, i, rows=slice(first[i] + row, first[i] + row + n), out=buf)
+                pending.append(writer.submit(sink.write, name, i, row, buf))
+                nbytes += buf.nbytes
+        while pending:
+            pending.popleft().result()
+    finally:
+        for fut in pending:
+            fut.result()
+        sink.close()
+
+    out.chmod(0o444)
+    out.rename(fn)
+    return nbytes
+
+
+if __name__ == '__main__':
+    restore()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+'''
+Sharded compression of one snapshot across many tasks.
+
+`compress_gadget.py --shard K/N SRC... DST` compresses the K-th of N slices
+of the particles into its own file, `DST.shards/DST.K.hdf5` (e.g.
+`snap_004.shards/snap_004.3.hdf5` for `snap_004.hdf5`). Slices are whole
+chunks of rows, in file order, or of IDs, with `-s`. Each shard is a regular
+compressed file, with its own header (its `NumPart_ThisFile`, and
+`NumFilesPerSnapshot` multiplied by N) and `/CompressionInfo`.
+
+Once all N shards are written, `shards.py finalize DST` writes DST itself: a
+small file with the combined `/Header` and `/CompressionInfo`, in which each
+`/PartTypeN/*` dataset is an HDF5 virtual dataset that maps the shards' rows,
+in order. Readers see one snapshot; h5py reads through to the shards, and
+reader.py reads the shards directly, in parallel. The shards are referenced
+by relative path, so the directory can be moved as a whole.
+'''
+
+import json
+from pathlib import Path
+import re
+
+import click
+import h5py
+import hdf5plugin
+import numpy as np
+
+
+def shard_dir(dst):
+    dst = Path(dst)
+    return dst.parent / f'{dst.stem}.shards'
+
+
+def shard_path(dst, k):
+    dst = Path(dst)
+    return shard_dir(dst) / f'{dst.stem}.{k}.hdf5'
+
+
+def parse_shard(spec):
+    '''"K/N" -> (K, N)
+    '''
+    m = re.fullmatch(r'(\d+)/(\d+)', spec)
+    if not m or not int(m.group(1)) < int(m.group(2)):
+        raise ValueError(f'Bad shard {spec!r}, expected K/N with 0 <= K < N')
+    return int(m.group(1)), int(m.group(2))
+
+
+def shard_rows(n, k, nshard, chunkrows):
+    '''Rows lo..hi of `n` that shard `k` of `nshard` holds, in whole chunks.
+    '''
+    per = -(-n // nshard)
+    per = -(-per // chunkrows) * chunkrows
+    return min(k * per, n), min((k + 1) * per, n)
+
+
+def finalize(dst):
+    '''Write the master file `dst` over its complete set of shards.
+    '''
+    dst = Path(dst)
+    files = list(shard_dir(dst).glob(f'{dst.stem}.*.hdf5'))
+    if not files:
+        raise FileNotFoundError(f'No shards of {dst} in {shard_dir(dst)}')
+
+    shards = {}
+    for fn in files:
+        with h5py.File(fn, 'r') as h5:
+            shard = json.loads(h5['/CompressionInfo'].attrs['json'])['shard']
+            shards[shard['index']] = (fn, shard['count'])
+    nshard = shards[min(shards)][1]
+    if sorted(shards) != list(range(nshard)) or any(c != nshard for _, c in shards.values()):
+        raise ValueError(f'Incomplete shards of {dst}: have {sorted(shards)} of {nshard}')
+    files = [shards[k][0] for k in range(nshard)]
+
+    out = dst.with_suffix('.inprogress')
+    # fail if 'inprogress' exists
+    with h5py.File(out, 'w-') as h5out:
+        h5s = [h5py.File(fn, 'r') for fn in files]
+        try:
+            h5s[0].copy(h5s[0]['/Header'], h5out['/'], 'Header')
+            attrs = h5out['/Header'].attrs
+            npart = np.sum([h['/Header'].attrs['NumPart_ThisFile'] for h in h5s], axis=0)
+            attrs['NumPart_ThisFile'] = npart.astype(attrs['NumPart_ThisFile'].dtype)
+            attrs['NumFilesPerSnapshot'] = attrs['NumFilesPerSnapshot'] // nshard
+
+            infos = [json.loads(h['/CompressionInfo'].attrs['json']) for h in h5s]
+            info = infos[0]
+            del info['shard']
+            # each shard records the SZ3 error it reached; the snapshot's is the largest
+            for name, opts in info.items():
+                if isinstance(opts, dict) and 'sz3' in opts:
+                    maxerr = opts['sz3']['max_error']
+                    for other in infos[1:]:
+                        for parttype, err in other[name]['sz3']['max_error'].items():
+                            maxerr[parttype] = max(maxerr.get(parttype, 0.), err)
+            info['shards'] = [str(fn.relative_to(dst.parent)) for fn in files]
+            h5out.create_group('/CompressionInfo')
+            h5out['/CompressionInfo'].attrs['json'] = json.dumps(info)
+
+            names = sorted({f'{g}/{d}' for h in h5s for g in h if g.startswith('PartType')
+                            for d in h[g]})
+            for name in names:
+                dsets = [h[name] if name in h else None for h in h5s]
+                first = next(d for d in dsets if d is not None)
+                counts = [len(d) if d is not None else 0 for d in dsets]
+                layout = h5py.VirtualLayout(shape=(sum(counts),) + first.shape[1:],
+                                            dtype=first.dtype)
+                offset = 0
+                for fn, d, n in zip(files, dsets, counts):
+                    if n:
+                        layout[offset : offset + n] = h5py.VirtualSource(
+                            str(fn.relative_to(dst.parent)), name, shape=d.shape)
+                    offset += n
+                h5out.create_virtual_dataset(name, layout)
+        finally:
+            for h in h5s:
+                h.close()
+
+    out.chmod(0o444)
+    out.rename(dst)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('finalize')
+@click.argument('dsts', nargs=-1, required=True)
+def finalize_cmd(dsts):
+    '''Write the master file DST of each set of shards.'''
+    for dst in dsts:
+        finalize(dst)
+
+
+if __name__ == '__main__':
+    cli()
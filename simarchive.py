@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''
+Pack the leftover small files of each simulation (parameter files, logs,
+power spectra, ...) into one archive, `extras.zip`, in the simulation's output
+directory, instead of copying thousands of files one by one.
+
+A simulation directory is one with a `snapdir_NNN` or `ICs` subdirectory. Its
+leftover files are everything under it outside the snapdirs, except the IC
+files themselves, stored with paths relative to it. The archive is a plain
+deflate-compressed zip: its central directory is an index of the members, so
+any one member can be listed or extracted without reading the rest, with this
+script or with any unzip tool.
+
+    simarchive.py pack SRC_SIMDIR ARCHIVE
+    simarchive.py list ARCHIVE... [-m PATTERN]
+    simarchive.py extract ARCHIVE... [-m PATTERN] [-C DEST]
+'''
+
+from fnmatch import fnmatch
+import os
+from pathlib import Path
+import zipfile
+
+import click
+
+import treescan
+
+ARCHIVE_NAME = 'extras.zip'
+
+
+def stamp(st):
+    # the member comment: the source mtime, which zip date_time only keeps to 2 s
+    return str(st.st_mtime_ns).encode()
+
+
+def up_to_date(archive, members):
+    '''Whether `archive` exists with exactly these members, at these sizes
+    and mtimes.
+    '''
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            have = {i.filename: (i.file_size, i.comment) for i in zf.infolist()}
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return False
+    return have == {name: (st.st_size, stamp(st)) for name, _, st in members}
+
+
+def pack(archive, members, compresslevel=6):
+    '''Write `members` to `archive`, via an `.inprogress` file, read-only,
+    with each member's source mtime in its comment. Returns the number of
+    bytes packed.
+    '''
+    archive = Path(archive)
+    tmp = archive.with_suffix('.inprogress')
+    tmp.unlink(missing_ok=True)
+    nbytes = 0
+    with zipfile.ZipFile(tmp, 'x', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=compresslevel) as zf:
+        for name, path, st in members:
+            zf.write(path, name)
+            zf.getinfo(name).comment = stamp(st)
+            nbytes += st.st_size
+    tmp.chmod(0o444)
+    tmp.replace(archive)
+    return nbytes
+
+
+def select(zf, patterns):
+    return [i for i in zf.infolist()
+            if not patterns or any(fnmatch(i.filename, p) for p in patterns)]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('pack')
+@click.argument('src')
+@click.argument('archive')
+def pack_cmd(src, archive):
+    '''Pack the leftover files of the simulation directory SRC into ARCHIVE.'''
+    src = Path(src).resolve()
+    tree = treescan.scan_tree(src)
+    m = treescan.members(tree, Path('.'), src)
+    if m and not up_to_date(archive, m):
+        pack(archive, m)
+
+
+@cli.command('list')
+@click.argument('archives', nargs=-1, required=True)
+@click.option('--match', '-m', 'patterns', multiple=True,
+    help='Only members matching this glob pattern (repeatable)',
+)
+@click.option('--long', '-l', is_flag=True, default=False)
+def list_cmd(archives, patterns, long=False):
+    '''List the members of each archive.'''
+    for archive in archives:
+        with zipfile.ZipFile(archive) as zf:
+            for i in select(zf, patterns):
+                if long:
+                    print(f'{i.file_size:12d} {i.compress_size:12d} {archive}:{i.filename}')
+                else:
+                    print(f'{archive}:{i.filename}')
+
+
+@cli.command('extract')
+@click.argument('archives', nargs=-1, required=True)
+@click.option('--match', '-m', 'patterns', multiple=True,
+    help='Only members matching this glob pattern (repeatable)',
+)
+@click.option('--dest', '-C', default=None,
+    help='Where to extract to; by default, next to each archive. With several '
+         'archives, each goes in its directory relative to their common parent',
+)
+def extract_cmd(archives, patterns, dest):
+    '''Extract members of each archive.'''
+    archives = [Path(a).resolve() for a in archives]
+    common = Path(os.path.commonpath([a.parent for a in archives]))
+    for archive in archives:
+        if dest is None:
+            outdir = archive.parent
+        elif len(archives) == 1:
+            outdir = Path(dest)
+        else:
+            outdir = Path(dest) / archive.parent.relative_to(common)
+        with zipfile.ZipFile(archive) as zf:
+            zf.extractall(outdir, members=select(zf, patterns))
+
+
+if __name__ == '__main__':
+    cli()
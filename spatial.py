@@ -0,0 +1,120 @@
+'''
+Space-filling-curve particle ordering, with a per-chunk spatial index for
+sub-volume reads.
+
+With `--layout morton`, particles are reordered along a Morton (Z-order) curve
+with 21 bits per dimension, so each HDF5 chunk holds a compact region of space.
+Neighbouring positions also share their high bits, which helps compression.
+
+For each particle type, the index is stored next to `/CompressionInfo['json']`
+in `/CompressionInfo/SpatialIndex/PartTypeN`:
+    - `bbox`: (nchunks, 2, 3) float32 min and max stored position per chunk
+    - `keys`: (nchunks, 2) uint64 min and max Morton key per chunk
+with attrs `chunkrows`, `bits` and `box`.
+
+`query_box()` uses the index to decompress only the chunks that intersect a
+requested region.
+'''
+
+import numpy as np
+
+BITS = 21
+SLAB = 1 << 20  # rows per slab, to bound temporaries
+
+
+def spread_bits(x):
+    '''Insert two zero bits between each of the low 21 bits of `x` (uint64).
+    '''
+    x = x & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton_keys(pos, box, bits=BITS):
+    '''Morton keys (uint64) of positions in [0, box).
+    '''
+    keys = np.empty(len(pos), dtype=np.uint64)
+    for start in range(0, len(pos), SLAB):
+        p = pos[start : start + SLAB]
+        ijk = np.clip((p / box * (1 << bits)).astype(np.int64), 0, (1 << bits) - 1).astype(np.uint64)
+        keys[start : start + SLAB] = (spread_bits(ijk[:, 0]) << np.uint64(2)
+                                      | spread_bits(ijk[:, 1]) << np.uint64(1)
+                                      | spread_bits(ijk[:, 2]))
+    return keys
+
+
+def morton_order(pos, box):
+    '''The permutation that sorts particles along the Morton curve, and the
+    sorted keys.
+    '''
+    keys = morton_keys(pos, box)
+    iord = np.argsort(keys, kind='stable')
+    return iord, keys[iord]
+
+
+def build_index(pos, keys, chunkrows, truncbits=0):
+    '''Per-chunk bounding boxes and key ranges of Morton-ordered `pos`.
+
+    The boxes are of the positions as stored, i.e. after truncating
+    `truncbits` bits, so that they bound what readers will see.
+    '''
+    nchunks = -(-len(pos) // chunkrows)
+    bbox = np.empty((nchunks, 2, 3), dtype=np.float32)
+    krange = np.empty((nchunks, 2), dtype=np.uint64)
+    mask = ~np.uint32((1 << truncbits) - 1)
+    for c in range(nchunks):
+        p = pos[c * chunkrows : (c + 1) * chunkrows]
+        p = (p.view(dtype=np.uint32) & mask).view(dtype=p.dtype)
+        bbox[c, 0] = p.min(axis=0)
+        bbox[c, 1] = p.max(axis=0)
+        krange[c] = keys[c * chunkrows], keys[min((c + 1) * chunkrows, len(keys)) - 1]
+    return dict(bbox=bbox, keys=krange)
+
+
+def write_index(h5out, parttype, index, chunkrows, box):
+    g = h5out.create_group(f'/CompressionInfo/SpatialIndex/PartType{parttype}')
+    g['bbox'] = index['bbox']
+    g['keys'] = index['keys']
+    g.attrs['chunkrows'] = chunkrows
+    g.attrs['bits'] = BITS
+    g.attrs['box'] = box
+
+
+def query_box(h5, lo, hi, parttype=1, fields=('Coordinates', 'Velocities', 'ParticleIDs')):
+    '''Read the particles with lo <= position < hi (non-periodic, per axis)
+    from a Morton-ordered file, decompressing only the chunks whose bounding
+    box intersects the region.
+
+    Returns a dict of arrays, one per field.
+    '''
+    lo = np.asarray(lo, dtype=np.float32)
+    hi = np.asarray(hi, dtype=np.float32)
+    g = h5[f'/CompressionInfo/SpatialIndex/PartType{parttype}']
+    bbox = g['bbox'][:]
+    chunkrows = int(g.attrs['chunkrows'])
+
+    hit = np.all((bbox[:, 0] < hi) & (bbox[:, 1] >= lo), axis=1)
+
+    # merge runs of consecutive chunks into single reads
+    edges = np.diff(np.concatenate([[0], hit.view(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+
+    out = {name: [] for name in fields}
+    for a, b in zip(starts * chunkrows, stops * chunkrows):
+        pos = h5[f'/PartType{parttype}/Coordinates'][a:b]
+        inside = np.all((pos >= lo) & (pos < hi), axis=1)
+        for name in fields:
+            if name == 'Coordinates':
+                out[name] += [pos[inside]]
+            else:
+                out[name] += [h5[f'/PartType{parttype}/{name}'][a:b][inside]]
+
+    return {name: np.concatenate(v) if v else
+                  np.empty((0,) + h5[f'/PartType{parttype}/{name}'].shape[1:],
+                           dtype=h5[f'/PartType{parttype}/{name}'].dtype)
+            for name, v in out.items()}
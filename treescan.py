@@ -0,0 +1,92 @@
+'''
+Directory listing shared by treesync.py, simarchive.py and catalog.py.
+
+`scan_tree()` lists a tree with `os.scandir`, many directories at once in a
+thread pool, keeping the stat data of each entry, so callers can work on it in
+memory with no further metadata calls. `members()` picks the leftover files of
+a simulation directory from such a listing: everything outside the snapdirs,
+except the snapshot and IC files (`skip_default`).
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+from pathlib import Path
+import re
+
+SNAPDIR = re.compile(r'snapdir_\d+')
+
+
+def is_snapdir(name):
+    return SNAPDIR.match(name) is not None
+
+
+def scan_dir(d):
+    '''Files (name -> stat) and subdirectory names of one directory.
+    Symlinked files are listed with their target's stat, like `shutil.copy`
+    sees them; symlinked directories are not followed.
+    '''
+    files, dirs = {}, []
+    with os.scandir(d) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs += [entry.name]
+            else:
+                try:
+                    files[entry.name] = entry.stat()
+                except FileNotFoundError:
+                    # dangling symlink
+                    files[entry.name] = entry.stat(follow_symlinks=False)
+    return files, dirs
+
+
+def scan_tree(root, prune=is_snapdir, threads=32):
+    '''List the tree under `root`, not descending into directories whose name
+    matches `prune`. Returns {relative dir: (files, subdirs, dir stat)}, or an
+    empty dict if `root` does not exist. Pruned subdirs are still named in
+    their parent's subdirs.
+    '''
+    root = Path(root)
+    try:
+        rootstat = os.stat(root)
+    except FileNotFoundError:
+        return {}
+
+    tree = {}
+    with ThreadPoolExecutor(threads) as pool:
+        pending = {pool.submit(scan_dir, root): (Path('.'), rootstat)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                rel, st = pending.pop(fut)
+                files, dirs = fut.result()
+                tree[rel] = (files, dirs, st)
+                for d in dirs:
+                    if prune is not None and prune(d):
+                        continue
+                    sub = root / rel / d
+                    pending[pool.submit(scan_dir, sub)] = (rel / d, sub.stat(follow_symlinks=False))
+    return tree
+
+
+def is_simulation(dirnames):
+    return any(is_snapdir(d) or d == 'ICs' for d in dirnames)
+
+
+def skip_default(name):
+    return re.match(r'ics\.\d+', name) or re.match(r'snap_\w*\.\w*', name)
+
+
+def members(tree, rel, root, skip_file=skip_default):
+    '''(member name, file, stat) of every leftover file under `tree[rel]`,
+    from a `scan_tree()` listing of `root`.
+    '''
+    out = []
+    files, dirs, _ = tree[rel]
+    for fn, st in sorted(files.items()):
+        if not skip_file(fn):
+            out += [(fn, root / rel / fn, st)]
+    for d in sorted(dirs):
+        if is_snapdir(d) or rel / d not in tree:
+            continue
+        out += [(f'{d}/{name}', path, st) for name, path, st in members(tree, rel / d, root, skip_file)]
+    return out
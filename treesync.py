@@ -0,0 +1,202 @@
+'''
+Tree sync engine for merge_trees.py and prepare_merge_trees.py.
+
+Both trees are listed up front with `treescan.scan_tree()`, many directories at
+once in a thread pool, keeping the stat data of each entry. The diff is then
+done in memory, with no further metadata calls. Copies run in a thread pool with
+`os.copy_file_range` (falling back to `os.sendfile`, then a plain copy), and
+permissions are set on the open file or in one batch per directory at the end,
+skipping any that are already right.
+
+The diff follows the original walk: directories named like `snapdir_NNN` are
+skipped. A directory that exists in the destination gets the source files
+that are missing there or have a different size. A directory that does not is
+copied whole, like `shutil.copytree`.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import os
+from pathlib import Path
+import shutil
+import stat
+
+import simarchive
+import treescan
+
+
+class Plan:
+    '''What it takes to bring `dst` up to date with `src`:
+        - `files`: (src file, dst file, stat) to copy into existing dst dirs
+        - `trees`: (src dir, dst dir) to copy whole
+        - `dirs`: existing dst dirs visited, with their stat
+        - `packs`: (dst archive, [(member name, src file, stat)]) to write
+    '''
+
+    def __init__(self, src, dst):
+        self.src = Path(src)
+        self.dst = Path(dst)
+        self.files = []
+        self.trees = []
+        self.dirs = {}
+        self.packs = []
+        self.ndirs = 0
+
+
+def diff(src, dst, skip_file=lambda name: False, threads=32, pack=False):
+    '''Compare the trees under `src` and `dst`, in memory. Files for which
+    `skip_file(name)` is true are never copied into existing directories.
+
+    With `pack`, the leftover files of each simulation directory that exists
+    in `dst` go into one archive there instead (see simarchive.py), which is
+    only rewritten if its members differ.
+    '''
+    plan = Plan(src, dst)
+    srctree = treescan.scan_tree(src, threads=threads)
+    dsttree = treescan.scan_tree(dst, threads=threads)
+
+    def visit(rel):
+        plan.ndirs += 1
+        files, dirs, _ = srctree[rel]
+        if rel not in dsttree:
+            assert not treescan.is_snapdir(rel.name)
+            plan.trees += [(plan.src / rel, plan.dst / rel)]
+            return
+        dstfiles, _, dststat = dsttree[rel]
+        plan.dirs[plan.dst / rel] = dststat
+        if pack and treescan.is_simulation(dirs):
+            archive = plan.dst / rel / simarchive.ARCHIVE_NAME
+            members = treescan.members(srctree, rel, plan.src, skip_file)
+            if members and not simarchive.up_to_date(archive, members):
+                plan.packs += [(archive, members)]
+            return
+        for fn, st in files.items():
+            if skip_file(fn):
+                continue
+            if fn not in dstfiles or dstfiles[fn].st_size != st.st_size:
+                assert not fn.endswith('.hdf5')
+                plan.files += [(plan.src / rel / fn, plan.dst / rel / fn, st)]
+        for d in dirs:
+            if not treescan.is_snapdir(d):
+                visit(rel / d)
+
+    visit(Path('.'))
+    return plan
+
+
+def copy_file(src, dst, st, mode=None):
+    '''Copy one file in the kernel where possible, then set its mode to
+    `mode`, or to the source's mode and times if None. Symlinks are followed,
+    except dangling ones, which are copied as links.
+    '''
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+        return 0
+
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copy_fd(fin, fout, st.st_size)
+            if mode is None:
+                os.fchmod(fout, stat.S_IMODE(st.st_mode))
+                os.utime(fout, ns=(st.st_atime_ns, st.st_mtime_ns))
+            else:
+                os.fchmod(fout, mode)
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+    return st.st_size
+
+
+def copy_fd(fin, fout, size):
+    for fn in (os.copy_file_range, os.sendfile):
+        try:
+            left = size
+            while left > 0:
+                n = fn(fin, fout, left) if fn is os.copy_file_range else fn(fout, fin, None, left)
+                if n == 0:
+                    break
+                left -= n
+            # the file may have grown since it was listed
+            while (n := os.read(fin, 1 << 20)):
+                os.write(fout, n)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                               errno.ENOTSUP, errno.EBADF):
+                raise
+            os.lseek(fin, 0, os.SEEK_SET)
+            os.lseek(fout, 0, os.SEEK_SET)
+            os.ftruncate(fout, 0)
+    with os.fdopen(os.dup(fin), 'rb') as a, os.fdopen(os.dup(fout), 'wb') as b:
+        shutil.copyfileobj(a, b)
+
+
+def tree_copies(src, dst, threads=32):
+    '''The directories to create and the files to copy for a whole-tree copy
+    of `src` to `dst`.
+    '''
+    tree = treescan.scan_tree(src, prune=None, threads=threads)
+    dirs, files = [], []
+    for rel in sorted(tree, key=lambda r: len(r.parts)):
+        dfiles, _, st = tree[rel]
+        dirs += [(dst / rel, st)]
+        files += [(src / rel / fn, dst / rel / fn, fst) for fn, fst in dfiles.items()]
+    return dirs, files
+
+
+def chmod(path, mode, st=None):
+    '''Set the permission bits of `path`, unless `st` shows they already are.'''
+    if st is None or stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+
+
+def sync(plan, threads=32, progress=None):
+    '''Carry out `plan`: copy files into existing dst dirs (mode 0o444), copy
+    whole trees (keeping modes and times), and leave every dst dir that was
+    visited or created at the top of a tree read-only (0o555), as the
+    original merge_trees.py did. Returns (files copied, bytes copied).
+    '''
+    parents = {d.parent for _, d in plan.trees}
+    writable = {f[1].parent for f in plan.files} | {a.parent for a, _ in plan.packs} | parents
+
+    # open up the dirs we write to, in one batch
+    for d in writable:
+        chmod(d, 0o755, plan.dirs.get(d))
+
+    jobs = [(s, d, st, 0o444) for s, d, st in plan.files]
+    treedirs = []
+    for s, d in plan.trees:
+        dirs, files = tree_copies(s, d, threads)
+        for path, st in dirs:
+            os.mkdir(path, 0o700)
+        treedirs += dirs
+        jobs += [(fs, fd, st, None) for fs, fd, st in files]
+
+    nfiles = nbytes = 0
+    with ThreadPoolExecutor(threads) as pool:
+        for n in pool.map(lambda job: copy_file(*job), jobs):
+            nfiles += 1
+            nbytes += n
+            if progress is not None:
+                progress.update(n)
+        for n in pool.map(lambda p: simarchive.pack(*p), plan.packs):
+            nfiles += 1
+            nbytes += n
+            if progress is not None:
+                progress.update(n)
+
+    # directory modes and times last, deepest first, as copytree does
+    for path, st in sorted(treedirs, key=lambda d: -len(d[0].parts)):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    for _, d in plan.trees:
+        chmod(d, 0o555)
+    for d in parents - plan.dirs.keys():
+        chmod(d, 0o555)
+    for d, st in plan.dirs.items():
+        chmod(d, 0o555, None if d in writable else st)
+
+    return nfiles, nbytes
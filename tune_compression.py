@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Sweep codec, filter, chunk, block size and truncation settings on sample
+snapshot files, and recommend `get_compression_opts` settings.
+
+Each candidate is written to an in-memory HDF5 file and read back, the same
+way the compression scripts and downstream readers would use it. Blosc
+candidates go through direct_chunk.py (the only way to set the Blosc block
+size); the rest go through the HDF5 filter.
+
+The output JSON has every measurement under "report", the Pareto-optimal
+candidates (ratio vs. compress MB/s vs. decompress MB/s) under "pareto", and
+one pick per dataset under "recommended", which compress_hdf5.py and
+compress_gadget.py can load with `--tuning`.
+'''
+
+import itertools
+import json
+from pathlib import Path
+from timeit import default_timer
+
+import click
+import h5py
+import hdf5plugin
+import numpy as np
+
+import direct_chunk
+from compress_hdf5 import TRUNC_LEVELS, filter_opts, nearest_boxsize
+from direct_chunk import truncate
+from gadgetfile import GadgetFile
+
+BLOCKNAMES = dict(Coordinates='POS ', Velocities='VEL ', ParticleIDs='ID  ')
+
+
+def csv(type):
+    return lambda ctx, param, value: [type(v) for v in value.split(',')]
+
+
+@click.command()
+@click.argument('samples', nargs=-1, required=True)
+@click.option('--output', '-o', default='tuning.json',
+    help='Where to write the report and recommendations',
+)
+@click.option('--rows', default=1<<22,
+    help='Number of particles to take from each sample',
+)
+@click.option('--cnames', default='zstd,lz4,lz4hc,blosclz', callback=csv(str))
+@click.option('--clevels', default='1,5,9', callback=csv(int))
+@click.option('--shuffles', default='shuffle,bitshuffle,delta', callback=csv(str),
+    help='Any of noshuffle, shuffle, bitshuffle, delta (delta uses the Blosc2 filter)',
+)
+@click.option('--chunkrows', default='16384,65536,262144', callback=csv(int))
+@click.option('--blocksizes', default='0,262144', callback=csv(int),
+    help='Blosc block sizes in bytes; 0 is automatic, as in the HDF5 filter',
+)
+@click.option('--truncpos', default='auto', callback=csv(str),
+    help='Position truncation bits to try; "auto" is the TRUNC_LEVELS value',
+)
+@click.option('--truncvel', default='auto', callback=csv(str),
+    help='Velocity truncation bits to try; "auto" is the TRUNC_LEVELS value',
+)
+@click.option('--repeat', default=3,
+    help='Time each candidate this many times and keep the fastest',
+)
+@click.option('--min-compress-speed', default=100.,
+    help='Recommend only candidates that compress at least this fast (MB/s)',
+)
+@click.option('--min-decompress-speed', default=300.,
+    help='Recommend only candidates that decompress at least this fast (MB/s)',
+)
+@click.option('--verbose', '-V', is_flag=True, default=False)
+def tune(samples, output, rows, cnames, clevels, shuffles, chunkrows, blocksizes,
+         truncpos, truncvel, repeat, min_compress_speed, min_decompress_speed,
+         verbose=False):
+    report = []
+    for fn in samples:
+        header, data = load_sample(Path(fn), rows)
+        auto = auto_truncbits(header)
+        trunc = dict(Coordinates=truncpos, Velocities=truncvel, ParticleIDs=['0'])
+
+        for name, p in data.items():
+            for tbits in trunc[name]:
+                tbits = auto[name] if tbits == 'auto' else int(tbits)
+                for spec in candidates(cnames, clevels, shuffles, chunkrows, blocksizes):
+                    res = measure(p, tbits, spec, repeat)
+                    res.update(sample=str(fn), dataset=name, truncbits=tbits,
+                               auto_truncbits=tbits == auto[name],
+                               )
+                    report += [res]
+                    if verbose:
+                        print(json.dumps(res))
+
+    pareto = {}
+    recommended = {}
+    for name in BLOCKNAMES:
+        measured = [r for r in report if r['dataset'] == name and r['auto_truncbits']]
+        if not measured:
+            continue
+        summary = summarize(measured)
+        pareto[name] = pareto_front(summary)
+        recommended[name] = recommend(pareto[name], min_compress_speed, min_decompress_speed)
+
+    with open(output, 'w') as fp:
+        json.dump(dict(report=report, pareto=pareto, recommended=recommended), fp, indent=1)
+
+    for name, spec in recommended.items():
+        print(f'{name}: {spec}')
+
+
+def load_sample(fn, rows):
+    '''The header and the first `rows` particles of each PartType1 dataset, from
+    an HDF5 or Gadget snapshot file.
+    '''
+    data = {}
+    if fn.suffix == '.hdf5':
+        with h5py.File(fn, 'r') as h5:
+            attrs = h5['/Header'].attrs
+            header = dict(box=attrs['BoxSize'], ntot=attrs['NumPart_Total'][1])
+            for name in BLOCKNAMES:
+                data[name] = h5[f'/PartType1/{name}'][:rows]
+    else:
+        with GadgetFile(fn) as g:
+            header = dict(box=g.header['boxsize'], ntot=g.header['nall'][1])
+            for name, blockname in BLOCKNAMES.items():
+                src = g.view_block(blockname, 1)[:rows]
+                data[name] = src.astype(src.dtype.newbyteorder('='))
+    return header, data
+
+
+def auto_truncbits(header):
+    n1d = int(round(header['ntot']**(1/3)))
+    truncpos, truncvel = TRUNC_LEVELS[(nearest_boxsize(header['box']), n1d)]
+    return dict(Coordinates=truncpos, Velocities=truncvel, ParticleIDs=0)
+
+
+def candidates(cnames, clevels, shuffles, chunkrows, blocksizes):
+    for cname, clevel, shuffle, crows, bsize in itertools.product(
+            cnames, clevels, shuffles, chunkrows, blocksizes):
+        filter = 'blosc2' if shuffle == 'delta' else 'blosc'
+        if filter == 'blosc2' and bsize:
+            continue  # the Blosc2 filter picks its own block size
+        yield dict(filter=filter, cname=cname, clevel=clevel, shuffle=shuffle,
+                   chunkrows=crows, blocksize=bsize,
+                   )
+
+
+def measure(p, tbits, spec, repeat):
+    '''Compress ratio, compress MB/s and decompress MB/s of one candidate.
+    '''
+    p = truncate(p.copy(), tbits)
+    opts = dict(hdf5=filter_opts(spec, p.shape[1:]), truncbits=0)
+    if spec['blocksize']:
+        opts['blocksize'] = spec['blocksize']
+
+    tc = td = np.inf
+    for _ in range(repeat):
+        # no chunk cache, so that reads really decompress
+        with h5py.File('tune.hdf5', 'w', driver='core', backing_store=False,
+                       rdcc_nbytes=0) as h5:
+            t = -default_timer()
+            if spec['filter'] == 'blosc':
+                dset = direct_chunk.write_dataset(h5, 'p', p, opts, 1)
+            else:
+                dset = h5.create_dataset('p', data=p, **opts['hdf5'])
+            h5.flush()
+            t += default_timer()
+            tc = min(tc, t)
+
+            t = -default_timer()
+            dset[:]
+            t += default_timer()
+            td = min(td, t)
+
+            stored = dset.id.get_storage_size()
+
+    return dict(spec=spec,
+                ratio=p.nbytes / stored,
+                compress_MBps=p.nbytes / tc / 1e6,
+                decompress_MBps=p.nbytes / td / 1e6,
+                )
+
+
+def summarize(report):
+    '''Average each spec's measurements over the samples.
+    '''
+    bykey = {}
+    for r in report:
+        bykey.setdefault(json.dumps(r['spec'], sort_keys=True), []).append(r)
+
+    summary = []
+    for rs in bykey.values():
+        summary += [dict(spec=rs[0]['spec'],
+                         ratio=float(np.mean([r['ratio'] for r in rs])),
+                         compress_MBps=float(np.mean([r['compress_MBps'] for r in rs])),
+                         decompress_MBps=float(np.mean([r['decompress_MBps'] for r in rs])),
+                         )]
+    return summary
+
+
+def pareto_front(summary):
+    '''The candidates that no other candidate beats on all three metrics.
+    '''
+    keys = ('ratio', 'compress_MBps', 'decompress_MBps')
+
+    def dominates(a, b):
+        return all(a[k] >= b[k] for k in keys) and any(a[k] > b[k] for k in keys)
+
+    front = [s for s in summary if not any(dominates(o, s) for o in summary)]
+    return sorted(front, key=lambda s: -s['ratio'])
+
+
+def recommend(front, min_compress_speed, min_decompress_speed):
+    '''The best ratio on the front that meets both speed floors, or the fastest
+    compressor if none does.
+    '''
+    ok = [s for s in front
+          if s['compress_MBps'] >= min_compress_speed
+          and s['decompress_MBps'] >= min_decompress_speed]
+    if ok:
+        return max(ok, key=lambda s: s['ratio'])['spec']
+    return max(front, key=lambda s: s['compress_MBps'])['spec']
+
+
+if __name__ == '__main__':
+    tune()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+'''
+Verify compressed outputs against their original files before the originals
+go to tape.
+
+Takes the same arguments as a compression task (`SRC... DST`), or a whole
+disBatch task list from prepare_job.py with `--tasks`. HDF5 sources are
+checked against `DST/<name>`, and Gadget sources against the single `DST` file
+they were merged into. HDF5 sources merged with `compress_hdf5.py --merge`
+are checked by passing their output file as `DST`.
+
+For each output, the header is checked against the source header(s). Then
+every particle is checked, in row ranges spread over a process pool:
+    - ParticleIDs must match exactly
+    - Coordinates and Velocities must be within the truncation bound recorded
+      in `/CompressionInfo['json']`: less than 2**truncbits units in the last
+      place of the original value, the recorded bound for Lagrangian
+      Coordinates (up to periodic wrapping), or the absolute SZ3 bound
+
+Outputs that were reordered (ID-sorted with `-s`, or `--layout morton`) are
+matched to the source particles by ID. This needs one pass over the IDs per
+output to build the permutation, which is stored in `--scratch` while that
+output is being checked. Sources are read through zero-copy memory maps where
+possible (Gadget files, and contiguous uncompressed HDF5 datasets), so only
+the rows being checked are touched.
+
+One JSON line per output is written to the manifest, with "status": "pass" or
+"fail", the errors found and the max error per dataset. The exit status is
+nonzero if any output failed.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+from timeit import default_timer
+
+import click
+import h5py
+import hdf5plugin
+import numpy as np
+
+from compress_gadget import dense_id_offset, to_hdf5_header
+from compress_hdf5 import DATASETS
+from gadgetfile import GadgetFile
+from lagrangian import read_coordinates, wrap
+
+BLOCKNAMES = dict(Coordinates='POS ', Velocities='VEL ', ParticleIDs='ID  ')
+
+
+@click.command()
+@click.argument('paths', nargs=-1)
+@click.option('--tasks', '-T', default=None,
+    help='disBatch task list from prepare_job.py; verify every task in it',
+)
+@click.option('--manifest', '-o', default='verify_manifest.jsonl',
+    help='Where to write one JSON line per output',
+)
+@click.option('--nprocs', '-j', default=len(os.sched_getaffinity(0)),
+    help='Number of worker processes',
+)
+@click.option('--rows', default=1<<22,
+    help='Particles per unit of work',
+)
+@click.option('--scratch', default=tempfile.gettempdir(),
+    help='Directory for the ID-matching permutations of reordered outputs',
+)
+@click.option('--verbose', '-V', is_flag=True, default=False)
+def verify(paths, tasks, manifest, nprocs, rows, scratch, verbose=False):
+    t = -default_timer()
+    if tasks is not None:
+        if paths:
+            raise click.UsageError('Pass either SRC... DST or --tasks, not both')
+        pairs = list(read_tasks(tasks))
+    else:
+        if len(paths) < 2:
+            raise click.UsageError('Need SRC... DST')
+        pairs = task_pairs([Path(p) for p in paths[:-1]], Path(paths[-1]))
+
+    npass = nfail = nparticles = 0
+    with open(manifest, 'w') as fp, ProcessPoolExecutor(nprocs) as pool:
+        for res in run(pool, pairs, rows, Path(scratch), maxpairs=nprocs):
+            fp.write(json.dumps(res) + '\n')
+            fp.flush()
+            npass += res['status'] == 'pass'
+            nfail += res['status'] == 'fail'
+            nparticles += res['nparticles']
+            if verbose or res['status'] == 'fail':
+                print(f'{res["status"].upper()} {res["output"]}', *res['errors'], sep='\n    ')
+
+    t += default_timer()
+    print(f'{npass} passed, {nfail} failed, {nparticles/t/1e6:.4g} M particles/s')
+    if nfail:
+        sys.exit(1)
+
+
+def read_tasks(fn):
+    '''(sources, output) pairs of every task in a disBatch task list.
+    '''
+    seen = set()
+    with open(fn) as fp:
+        for line in fp:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            if '--shard' in words:
+                # one of several tasks writing the same output
+                k = words.index('--shard')
+                del words[k : k + 2]
+            if len(words) < 2:
+                # shards.py finalize
+                continue
+            for pair in task_pairs([Path(w) for w in words[:-1]], Path(words[-1])):
+                if pair[1] not in seen:
+                    seen.add(pair[1])
+                    yield pair
+
+
+def task_pairs(src, dst):
+    '''(sources, output) pairs of one compression task, as compress_hdf5.py
+    and compress_gadget.py name their outputs.
+    '''
+    if all(fn.suffix == '.hdf5' for fn in src) and dst.suffix != '.hdf5':
+        return [([str(fn)], str(dst / fn.name)) for fn in src]
+    return [([str(fn) for fn in src], str(dst))]
+
+
+def run(pool, pairs, rows, scratch, maxpairs):
+    '''Verify `pairs` in `pool`, yielding one result per output as it completes.
+    At most `maxpairs` outputs are in flight, to bound scratch space.
+    '''
+    pairs = iter(pairs)
+    pending = {}
+    results = {}
+
+    def start_next():
+        pair = next(pairs, None)
+        if pair is None:
+            return
+        key = pair[1]
+        results[key] = dict(output=key, sources=pair[0], status='pass', errors=[],
+                            nparticles=0, datasets={}, nunits=0, perms=[],
+                            )
+        pending[pool.submit(plan, pair, rows, scratch)] = ('plan', key)
+
+    for _ in range(maxpairs):
+        start_next()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            kind, key = pending.pop(fut)
+            res = results[key]
+            try:
+                out = fut.result()
+            except Exception as e:
+                res['errors'] += [f'{kind}: {type(e).__name__}: {e}']
+                out = None
+
+            if kind == 'plan' and out is not None:
+                res['errors'] += out['errors']
+                res['perms'] = [u[4] for u in out['units'] if u[4] is not None]
+                for unit in out['units']:
+                    pending[pool.submit(check, *unit)] = ('check', key)
+                    res['nunits'] += 1
+            elif kind == 'check':
+                res['nunits'] -= 1
+                if out is not None:
+                    merge(res, out)
+
+            if not any(k == key for _, k in pending.values()):
+                for fn in set(res.pop('perms')):
+                    Path(fn).unlink(missing_ok=True)
+                del res['nunits']
+                if res['errors']:
+                    res['status'] = 'fail'
+                yield results.pop(key)
+                start_next()
+
+
+def merge(res, out):
+    res['nparticles'] += out['nparticles']
+    res['errors'] += out['errors']
+    for path, d in out['datasets'].items():
+        r = res['datasets'].setdefault(path, dict(nbad=0, max_error=0., max_error_ratio=0.))
+        r['nbad'] += d['nbad']
+        r['max_error'] = max(r['max_error'], d['max_error'])
+        r['max_error_ratio'] = max(r['max_error_ratio'], d['max_error_ratio'])
+
+
+def plan(pair, rows, scratch):
+    '''Check the header and dataset shapes of one output, and split its
+    particles into units of work. Builds the ID-matching permutation of
+    reordered outputs.
+    '''
+    src, dst = pair
+    src = [Path(fn) for fn in src]
+    errors = []
+    units = []
+    if not Path(dst).is_file():
+        return dict(errors=[f'missing output {dst}'], units=[])
+
+    with ExitStack() as stack:
+        files = open_sources(src, stack)
+        h5 = stack.enter_context(h5py.File(dst, 'r'))
+        info = json.loads(h5['/CompressionInfo'].attrs['json'])
+        errors += check_header(files, h5['/Header'].attrs)
+        reordered = bool(info.get('sort')) or info.get('layout', 'file') != 'file'
+
+        for i in [1, 2]:
+            counts = source_counts(files, i)
+            if f'/PartType{i}' not in h5:
+                if counts.sum():
+                    errors += [f'PartType{i}: missing from output']
+                continue
+            n = len(h5[f'/PartType{i}/ParticleIDs'])
+            shape_errors = [f'PartType{i}/{name}: {len(h5[f"/PartType{i}/{name}"])} '
+                            f'particles, expected {counts.sum()}'
+                            for name in DATASETS
+                            if len(h5[f'/PartType{i}/{name}']) != counts.sum()]
+            if shape_errors:
+                errors += shape_errors
+                continue
+
+            perm = None
+            if reordered:
+                perm = build_perm(files, counts, i, h5[f'/PartType{i}/ParticleIDs'][:], scratch)
+            units += [(pair, i, a, min(a + rows, n), perm) for a in range(0, n, rows)]
+
+    return dict(errors=errors, units=units)
+
+
+def check_header(files, attrs):
+    '''Compare the output header with the one expected from the open sources.
+    '''
+    if isinstance(files[0], h5py.File):
+        expected = dict(files[0]['/Header'].attrs)
+        if len(files) > 1:
+            # merged with compress_hdf5.py --merge
+            npart = 0
+            for h5in in files:
+                npart = npart + h5in['/Header'].attrs['NumPart_ThisFile']
+            expected['NumPart_ThisFile'] = npart
+            expected['NumFilesPerSnapshot'] = expected['NumFilesPerSnapshot'] // len(files)
+    else:
+        expected = to_hdf5_header([g.header for g in files])
+
+    errors = []
+    for k in sorted(set(expected) | set(attrs)):
+        if k not in attrs or k not in expected:
+            errors += [f'Header/{k}: only in {"output" if k in attrs else "source"}']
+        elif not np.array_equal(expected[k], attrs[k]):
+            errors += [f'Header/{k}: {attrs[k]} != {expected[k]}']
+    return errors
+
+
+def open_sources(src, stack):
+    '''Open each source file once, as an h5py File or a GadgetFile, for the
+    lifetime of the ExitStack `stack`.
+    '''
+    return [stack.enter_context(h5py.File(fn, 'r') if fn.suffix == '.hdf5' else GadgetFile(fn))
+            for fn in src]
+
+
+def source_counts(files, parttype):
+    counts = []
+    for f in files:
+        if isinstance(f, h5py.File):
+            key = f'/PartType{parttype}/ParticleIDs'
+            counts += [len(f[key]) if key in f else 0]
+        else:
+            counts += [int(f.header['npart'][parttype])]
+    return np.array(counts, dtype=np.int64)
+
+
+def source_view(f, name, parttype):
+    '''One dataset of an open source file, as a read-only memory map where
+    possible.
+    '''
+    if isinstance(f, h5py.File):
+        dset = f[f'/PartType{parttype}/{name}']
+        offset = dset.id.get_offset()
+        if dset.chunks is None and offset is not None:
+            return np.memmap(f.filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        return dset[:]
+    return f.view_block(BLOCKNAMES[name], parttype)
+
+
+def read_source(files, counts, name, parttype, rows):
+    '''Rows `rows` (global over the concatenated sources) of one dataset,
+    from the open source `files` with `counts` particles of `parttype`.
+    '''
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    views = [source_view(f, name, parttype) if c else None for f, c in zip(files, counts)]
+    rowshape = next(v for v in views if v is not None).shape[1:]
+    dtype = next(v for v in views if v is not None).dtype.newbyteorder('=')
+    out = np.empty((len(rows),) + rowshape, dtype=dtype)
+
+    k = np.searchsorted(offsets, rows, side='right') - 1
+    for j, v in enumerate(views):
+        sel = k == j
+        if v is not None and sel.any():
+            out[sel] = v[rows[sel] - offsets[j]]
+    return out
+
+
+def build_perm(files, counts, parttype, outids, scratch):
+    '''Save, to a file in `scratch`, the global source row of each output row,
+    matched by ParticleID.
+    '''
+    n = len(outids)
+    srcids = read_source(files, counts, 'ParticleIDs', parttype, np.arange(n))
+    dtype = np.uint32 if n < 1 << 32 else np.int64
+
+    idmin = dense_id_offset(srcids)
+    if idmin is not None:
+        # O(N) scatter; IDs outside the range are caught by the ID check
+        loc = np.zeros(n, dtype=dtype)
+        loc[srcids - idmin] = np.arange(n, dtype=dtype)
+        k = outids.astype(np.int64) - int(idmin)
+        perm = loc[np.clip(k, 0, n - 1)]
+    else:
+        iord = np.argsort(srcids)
+        k = np.searchsorted(srcids[iord], outids)
+        perm = iord[np.clip(k, 0, n - 1)].astype(dtype)
+    del srcids
+
+    fd, fn = tempfile.mkstemp(suffix='.npy', prefix='verify_perm_', dir=scratch)
+    os.close(fd)
+    np.save(fn, perm)
+    return fn
+
+
+def check(pair, parttype, a, b, perm):
+    '''Compare rows a..b of one particle type of an output with the source.
+    '''
+    src, dst = pair
+    src = [Path(fn) for fn in src]
+    if perm is None:
+        rows = np.arange(a, b)
+    else:
+        rows = np.load(perm, mmap_mode='r')[a:b].astype(np.int64)
+
+    errors = []
+    datasets = {}
+    with ExitStack() as stack:
+        files = open_sources(src, stack)
+        counts = source_counts(files, parttype)
+        h5 = stack.enter_context(h5py.File(dst, 'r'))
+        info = json.loads(h5['/CompressionInfo'].attrs['json'])
+        for name in DATASETS:
+            path = f'PartType{parttype}/{name}'
+            if name == 'Coordinates':
+                out = read_coordinates(h5, parttype, slice(a, b))
+            else:
+                out = h5[path][a:b]
+            orig = read_source(files, counts, name, parttype, rows)
+
+            opts = info[name]
+            params = opts.get('lagrangian', {}).get(f'PartType{parttype}')
+            if name == 'ParticleIDs':
+                err = (out != orig).astype(np.float64)
+                bound = np.full(len(out), 0.5)
+            elif params is not None:
+                err = np.abs(wrap(out.astype(np.float64) - orig, params['box']))
+                bound = np.full(out.shape, params['error_bound'])
+            elif 'sz3' in opts:
+                err = np.abs(out.astype(np.float64) - orig)
+                bound = np.full(out.shape, opts['sz3']['absolute'])
+            else:
+                err = np.abs(out.astype(np.float64) - orig)
+                bound = truncation_bound(orig, int(opts['truncbits']))
+
+            # a truncation error is strictly less than its bound
+            strict = params is None and 'sz3' not in opts and name != 'ParticleIDs'
+            bad = (err >= bound) & (err > 0) if strict else err > bound
+            bad = bad.reshape(len(bad), -1).any(axis=1)
+            nbad = int(bad.sum())
+            if nbad:
+                first = a + int(np.flatnonzero(bad)[0])
+                errors += [f'{path}: {nbad} particles out of bounds, first at row {first}']
+            datasets[path] = dict(nbad=nbad,
+                                  max_error=float(err.max(initial=0.)) if name != 'ParticleIDs' else 0.,
+                                  max_error_ratio=float((err / bound).max(initial=0.)),
+                                  )
+
+    return dict(nparticles=b - a, errors=errors, datasets=datasets)
+
+
+def truncation_bound(p, tbits):
+    '''Max error of nulling `tbits` low mantissa bits of each float32 in `p`:
+    2**tbits units in the last place.
+    '''
+    _, e = np.frexp(p)
+    return np.ldexp(1., e - 24 + tbits)
+
+
+if __name__ == '__main__':
+    verify()